@@ -159,6 +159,44 @@ class MetricLogger(object):
             header, total_time_str, total_time / len(iterable)))
 
 
+# ---------------------- Mixed precision ----------------------
+## Mixed precision policy
+class PrecisionPolicy(object):
+    """
+        Mixed precision policy shared by the trainers, built on torch.autocast:
+        'fp32', 'fp16' (with a GradScaler) or 'bf16', on both the GPU and the CPU.
+    """
+    def __init__(self, precision='fp32', device=torch.device('cpu')):
+        assert precision in ['fp32', 'fp16', 'bf16']
+        self.device_type = torch.device(device).type
+        if precision == 'fp16' and self.device_type == 'cpu':
+            print('fp16 autocast is not supported on the CPU, use bf16 instead.')
+            precision = 'bf16'
+        self.precision = precision
+        self.dtype = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}[precision]
+        # Only fp16 needs the loss scaling, as bf16 has the dynamic range of fp32
+        self.scaler = torch.cuda.amp.GradScaler(enabled=precision == 'fp16')
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype, enabled=self.precision != 'fp32')
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def unscale_(self, optimizer):
+        self.scaler.unscale_(optimizer)
+
+    def step(self, optimizer):
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def state_dict(self):
+        return self.scaler.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.scaler.load_state_dict(state_dict)
+
+
 # ---------------------- Model functions ----------------------
 def load_model(args, model, optimizer, lr_scheduler):
     if args.resume and args.resume.lower() != 'none':
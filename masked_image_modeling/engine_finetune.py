@@ -2,7 +2,7 @@ import sys
 import math
 import torch
 
-from utils.misc import MetricLogger, SmoothedValue, accuracy
+from utils.misc import MetricLogger, SmoothedValue, PrecisionPolicy, accuracy
 
 
 def train_one_epoch(args,
@@ -13,6 +13,7 @@ def train_one_epoch(args,
                     epoch,
                     lr_scheduler_warmup,
                     criterion,
+                    precision: PrecisionPolicy,
                     ):
     model.train(True)
     metric_logger = MetricLogger(delimiter="  ")
@@ -40,10 +41,11 @@ def train_one_epoch(args,
         targets = targets.to(device, non_blocking=True)
 
         # Inference
-        output = model(images)
+        with precision.autocast():
+            output = model(images)
 
-        # Compute loss
-        loss = criterion(output, targets)
+        # Compute loss in fp32
+        loss = criterion(output.float(), targets)
 
         # Check loss
         loss_value = loss.item()
@@ -52,10 +54,10 @@ def train_one_epoch(args,
             sys.exit(1)
 
         # Backward
-        loss.backward()
+        precision.backward(loss)
 
         # Optimize
-        optimizer.step()
+        precision.step(optimizer)
         optimizer.zero_grad()
 
         # Logs
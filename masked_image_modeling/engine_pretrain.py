@@ -1,7 +1,7 @@
 import sys
 import math
 
-from utils.misc import MetricLogger, SmoothedValue
+from utils.misc import MetricLogger, SmoothedValue, PrecisionPolicy
 
 
 def train_one_epoch(args,
@@ -11,6 +11,7 @@ def train_one_epoch(args,
                     optimizer,
                     epoch,
                     lr_scheduler_warmup,
+                    precision: PrecisionPolicy,
                     ):
     model.train(True)
     metric_logger = MetricLogger(delimiter="  ")
@@ -35,7 +36,8 @@ def train_one_epoch(args,
         images = images.to(device, non_blocking=True)
 
         # Inference
-        output = model(images)
+        with precision.autocast():
+            output = model(images)
 
         # Compute loss
         loss = output["loss"]
@@ -47,10 +49,10 @@ def train_one_epoch(args,
             sys.exit(1)
 
         # Backward
-        loss.backward()
+        precision.backward(loss)
 
         # Optimize
-        optimizer.step()
+        precision.step(optimizer)
         optimizer.zero_grad()
 
         # Logs
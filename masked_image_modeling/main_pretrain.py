@@ -14,6 +14,7 @@ from data import build_dataset, build_dataloader
 from models import build_model
 
 # ---------------- Utils compoments ----------------
+from utils.misc import PrecisionPolicy
 from utils.misc import setup_seed
 from utils.misc import load_model, save_model, unpatchify
 from utils.optimizer import build_optimizer
@@ -30,6 +31,8 @@ def parse_args():
                         help='random seed.')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='use cuda')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                        help='training precision: fp32, fp16 (with grad scaler) or bf16.')
     parser.add_argument('--batch_size', type=int, default=256,
                         help='batch size on all GPUs')
     parser.add_argument('--num_workers', type=int, default=4,
@@ -131,12 +134,13 @@ def main():
         return
 
     # ------------------------- Training Pipeline -------------------------
+    precision = PrecisionPolicy(args.precision, device)
     start_time = time.time()
     print("=================== Start training for {} epochs ===================".format(args.max_epoch))
     for epoch in range(args.start_epoch, args.max_epoch):
         # Train one epoch
         train_one_epoch(args, device, model, train_dataloader,
-                        optimizer, epoch, lr_scheduler_warmup)
+                        optimizer, epoch, lr_scheduler_warmup, precision)
 
         # LR scheduler
         if (epoch + 1) > args.wp_epoch:
@@ -274,8 +274,9 @@ class ViTforMaskedAutoEncoder(nn.Module):
         pred: [B, N, C], C = p*p*3
         mask: [B, N], 0 is keep, 1 is remove, 
         """
-        target = self.patchify(x, self.mae_encoder.patch_size)
-        pred, mask = output["x_pred"], output["mask"]
+        # the loss is computed in fp32 under autocast
+        target = self.patchify(x.float(), self.mae_encoder.patch_size)
+        pred, mask = output["x_pred"].float(), output["mask"]
         loss = (pred - target) ** 2
         loss = loss.mean(dim=-1)  # [B, N], mean loss per patch
         loss = (loss * mask).sum() / mask.sum()  # mean loss on removed patches
@@ -40,6 +40,9 @@ class DetrBaseConfig(object):
         self.matcher_hpy = {'cost_class': 1.0,
                             'cost_bbox':  5.0,
                             'cost_giou':  2.0,
+                            'solver': 'hungarian',    # 'hungarian' (scipy), 'auction' or 'sinkhorn' (on device)
+                            'num_workers': 4,         # threads solving the per-image assignments
+                            'reuse_for_aux': False,   # aux layers reuse the matching of the last layer
                               }
 
         # --------- Loss weight ---------
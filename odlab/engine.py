@@ -1,10 +1,11 @@
 import math
 import sys
+import time
 from typing import Iterable
 
 import torch
-from utils import distributed_utils
-from utils.misc import MetricLogger, SmoothedValue
+from utils.distributed_utils import GradAccumulator
+from utils.misc import MetricLogger, SmoothedValue, PrecisionPolicy, targets_to_device
 from utils.vis_tools import vis_data
 
 
@@ -17,6 +18,7 @@ def train_one_epoch(cfg,
                     epoch       : int,
                     vis_target  : bool,
                     warmup_lr_scheduler,
+                    precision   : PrecisionPolicy,
                     debug       :bool = False
                     ):
     model.train()
@@ -29,6 +31,13 @@ def train_one_epoch(cfg,
 
     optimizer.zero_grad()
 
+    # Time cost of the Hungarian matching (DETR-style matchers only)
+    matcher = getattr(criterion, 'matcher', None)
+    if hasattr(matcher, 'match_time'):
+        matcher.match_time = 0.
+    start_time = time.time()
+    accumulator = GradAccumulator(model, cfg.grad_accumulate)
+
     for iter_i, (samples, targets) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
         ni = iter_i + epoch * epoch_size
         # WarmUp
@@ -44,41 +53,42 @@ def train_one_epoch(cfg,
         images, masks = samples
         images = images.to(device)
         masks  = masks.to(device)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+        targets = targets_to_device(targets, device)
 
         # Visualize train targets
         if vis_target:
             vis_data(images, targets, masks, cfg.class_labels, cfg.normalize_coords, cfg.box_format)
 
-        # Inference
-        outputs = model(images, masks)
-
-        # Compute loss
-        loss_dict = criterion(outputs, targets)
-        losses = loss_dict["losses"]# sum(loss_dict[k] * loss_weight_dict[k] for k in loss_dict.keys() if k in loss_weight_dict)
-        loss_value = losses.item()
-        losses /= cfg.grad_accumulate
+        # The gradients are only all-reduced at the last micro-batch of a step
+        with accumulator.no_sync(iter_i):
+            # Inference
+            with precision.autocast():
+                outputs = model(images, masks)
 
-        # Reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = distributed_utils.reduce_dict(loss_dict)
+                # Compute loss
+                loss_dict = criterion(outputs, targets)
+            losses = loss_dict["losses"]# sum(loss_dict[k] * loss_weight_dict[k] for k in loss_dict.keys() if k in loss_weight_dict)
+            loss_value = losses.item()
+            losses = accumulator.scale(losses)
 
-        # Check loss
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            print(loss_dict_reduced)
-            sys.exit(1)
+            # Check loss
+            if not math.isfinite(loss_value):
+                print("Loss is {}, stopping training".format(loss_value))
+                print(loss_dict)
+                sys.exit(1)
 
-        # Backward
-        losses.backward()
+            # Backward
+            precision.backward(losses)
 
         # Optimize
-        if (iter_i + 1) % cfg.grad_accumulate == 0:
+        if accumulator.is_boundary(iter_i):
             if cfg.clip_max_norm > 0:
+                precision.unscale_(optimizer)
                 torch.nn.utils.clip_grad_norm_(model.parameters(), cfg.clip_max_norm)
-            optimizer.step()
+            precision.step(optimizer)
             optimizer.zero_grad()
 
-        metric_logger.update(loss=loss_value, **loss_dict_reduced)
+        metric_logger.update(loss=loss_value, **loss_dict)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
 
         if debug:
@@ -88,5 +98,9 @@ def train_one_epoch(cfg,
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
+    if hasattr(matcher, 'match_time'):
+        total_time = time.time() - start_time
+        print('Matching time: {:.1f}s ({:.1f}% of the epoch)'.format(
+            matcher.match_time, matcher.match_time / max(total_time, 1e-6) * 100))
 
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
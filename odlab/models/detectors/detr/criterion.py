@@ -11,7 +11,8 @@ import torch.nn.functional as F
 
 from utils.box_ops import box_cxcywh_to_xyxy, generalized_box_iou
 from utils.distributed_utils import get_world_size, is_dist_avail_and_initialized
-from .matcher import HungarianMatcher
+from utils.misc import force_fp32
+from .matcher import HungarianMatcher, BatchAssignMatcher
 
 
 # --------------- Criterion for DETR ---------------
@@ -34,7 +35,13 @@ class SetCriterion(nn.Module):
         
         # -------- Matcher --------
         matcher_hpy = cfg.matcher_hpy
-        self.matcher = HungarianMatcher(matcher_hpy['cost_class'], matcher_hpy['cost_bbox'], matcher_hpy['cost_giou'])
+        if matcher_hpy['solver'] == 'hungarian':
+            self.matcher = HungarianMatcher(matcher_hpy['cost_class'], matcher_hpy['cost_bbox'], matcher_hpy['cost_giou'],
+                                            matcher_hpy['num_workers'])
+        else:
+            self.matcher = BatchAssignMatcher(matcher_hpy['cost_class'], matcher_hpy['cost_bbox'], matcher_hpy['cost_giou'],
+                                              matcher_hpy['solver'])
+        self.reuse_matching_for_aux = matcher_hpy['reuse_for_aux']
 
     def loss_labels(self, outputs, targets, indices, num_boxes):
         assert 'pred_logits' in outputs
@@ -80,11 +87,17 @@ class SetCriterion(nn.Module):
         }
         return loss_map[loss](outputs, targets, indices, num_boxes, **kwargs)
 
+    @force_fp32
     def forward(self, outputs, targets):
         outputs_without_aux = {k: v for k, v in outputs.items() if 'aux' not in k}
 
-        # Retrieve the matching between the outputs of the last layer and the targets
-        indices = self.matcher(outputs_without_aux, targets)
+        # Retrieve the matching between the outputs of the last layer and the targets.
+        # The auxiliary layers are matched together with the last layer, or reuse its matching.
+        if 'aux_outputs' in outputs and not self.reuse_matching_for_aux:
+            indices, *aux_indices = self.matcher.batch_forward([outputs_without_aux] + outputs['aux_outputs'], targets)
+        else:
+            indices = self.matcher(outputs_without_aux, targets)
+            aux_indices = [indices] * len(outputs.get('aux_outputs', []))
 
         # Compute the average number of target boxes accross all nodes, for normalization purposes
         num_boxes = sum(len(t["labels"]) for t in targets)
@@ -102,8 +115,7 @@ class SetCriterion(nn.Module):
 
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
         if 'aux_outputs' in outputs:
-            for i, aux_outputs in enumerate(outputs['aux_outputs']):
-                indices = self.matcher(aux_outputs, targets)
+            for i, (aux_outputs, indices) in enumerate(zip(outputs['aux_outputs'], aux_indices)):
                 for loss in self.losses:
                     l_dict = self.get_loss(loss, aux_outputs, targets, indices, num_boxes)
                     l_dict = {k: l_dict[k] * self.weight_dict[k] for k in l_dict if k in self.weight_dict}
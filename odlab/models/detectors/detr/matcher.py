@@ -1,26 +1,53 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 # https://github.com/facebookresearch/detr
 
+import time
 import torch
 import torch.nn as nn
+from concurrent.futures import ThreadPoolExecutor
 from scipy.optimize import linear_sum_assignment
-from utils.box_ops import box_cxcywh_to_xyxy, generalized_box_iou
+from utils.box_ops import box_cxcywh_to_xyxy, generalized_box_iou, batch_generalized_box_iou
+from utils.misc import pad_targets, batch_auction_assignment, batch_sinkhorn_assignment
 
 
 class HungarianMatcher(nn.Module):
-    def __init__(self, cost_class: float = 1, cost_bbox: float = 1, cost_giou: float = 1):
+    def __init__(self, cost_class: float = 1, cost_bbox: float = 1, cost_giou: float = 1, num_workers: int = 0):
         super().__init__()
         self.cost_class = cost_class
         self.cost_bbox = cost_bbox
         self.cost_giou = cost_giou
+        # The per-image assignments are solved in a thread pool,
+        # as scipy releases the GIL in linear_sum_assignment.
+        self.num_workers = num_workers
+        self.pool = None
+        # Accumulated time cost of the matching, in seconds.
+        self.match_time = 0.
+
+    def start_timer(self, device):
+        # the kernels queued before the matching are waited for, as the .cpu() of the matching
+        # would wait for them, so that the match_time is not overstated on CUDA
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        return time.time()
 
     @torch.no_grad()
     def forward(self, outputs, targets):
-        bs, num_queries = outputs["pred_logits"].shape[:2]
+        return self.batch_forward([outputs], targets)[0]
+
+    @torch.no_grad()
+    def batch_forward(self, outputs_list, targets):
+        """
+            Match the outputs of several decoder layers at once.
+            outputs_list: (List) [dict{'pred_logits': [B, Nq, C], 'pred_boxes': [B, Nq, 4]}, ...]
+            Return the matched indices of each layer.
+        """
+        t0 = self.start_timer(outputs_list[0]["pred_logits"].device)
+        num_layers = len(outputs_list)
+        bs, num_queries = outputs_list[0]["pred_logits"].shape[:2]
 
-        # [B * num_queries, C] = [N, C]
-        out_prob = outputs["pred_logits"].flatten(0, 1).softmax(-1)
-        out_bbox = outputs["pred_boxes"].flatten(0, 1)
+        # [L * B * num_queries, C] = [N, C]
+        out_prob = torch.stack([outputs["pred_logits"] for outputs in outputs_list]).flatten(0, 2).softmax(-1)
+        out_bbox = torch.stack([outputs["pred_boxes"] for outputs in outputs_list]).flatten(0, 2)
 
         # [M,] where M is number of all targets in this batch
         tgt_ids = torch.cat([v["labels"] for v in targets])
@@ -38,14 +65,132 @@ class HungarianMatcher(nn.Module):
 
         # Final cost matrix: [N, M]
         C = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou
-        # [N, M] -> [B, num_queries, M]
-        C = C.view(bs, num_queries, -1).cpu()
+        # [N, M] -> [L * B, num_queries, M]
+        C = C.view(num_layers * bs, num_queries, -1).cpu()
 
         # Optimziee cost
         sizes = [len(v["boxes"]) for v in targets]
-        indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
+        C = [c.numpy() for c in C.split(sizes, -1)]
+        costs = [C[i][l * bs + i] for l in range(num_layers) for i in range(bs)]
+        if self.num_workers > 0 and len(costs) > 1:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.num_workers)
+            indices = list(self.pool.map(linear_sum_assignment, costs))
+        else:
+            indices = [linear_sum_assignment(c) for c in costs]
+        indices = [(torch.as_tensor(i, dtype=torch.int64),   # tgt indexes
+                    torch.as_tensor(j, dtype=torch.int64))   # pred indexes
+                    for i, j in indices]
+        self.match_time += time.time() - t0
+
+        return [indices[l * bs: (l + 1) * bs] for l in range(num_layers)]
+
+
+class BatchAssignMatcher(HungarianMatcher):
+    """
+        Device-resident matcher: the padded [B, Nq, M] costs of the whole batch are solved at once
+        by the auction algorithm ('auction') or its entropic approximation ('sinkhorn').
+    """
+    def __init__(self, cost_class: float = 1, cost_bbox: float = 1, cost_giou: float = 1, solver: str = 'auction'):
+        super().__init__(cost_class, cost_bbox, cost_giou)
+        assert solver in ['auction', 'sinkhorn']
+        self.solver = solver
+
+    @torch.no_grad()
+    def batch_forward(self, outputs_list, targets):
+        t0 = self.start_timer(outputs_list[0]["pred_logits"].device)
+        num_layers = len(outputs_list)
+        bs, num_queries = outputs_list[0]["pred_logits"].shape[:2]
+        device = outputs_list[0]["pred_logits"].device
+
+        # [L * B, num_queries, C]
+        out_prob = torch.stack([outputs["pred_logits"] for outputs in outputs_list]).flatten(0, 1).softmax(-1)
+        out_bbox = torch.stack([outputs["pred_boxes"] for outputs in outputs_list]).flatten(0, 1)
+
+        # [B, M] -> [L * B, M]
+        tgt_labels, tgt_bboxes, tgt_mask = pad_targets(targets, device)
+        tgt_labels = tgt_labels.repeat(num_layers, 1)
+        tgt_bboxes = tgt_bboxes.repeat(num_layers, 1, 1)
+        tgt_mask   = tgt_mask.repeat(num_layers, 1)
+
+        # [L * B, num_queries, M]
+        cost_class = -out_prob.gather(2, tgt_labels[:, None, :].expand(-1, num_queries, -1))
+        cost_bbox = torch.cdist(out_bbox, tgt_bboxes, p=1)
+        cost_giou = -batch_generalized_box_iou(box_cxcywh_to_xyxy(out_bbox), box_cxcywh_to_xyxy(tgt_bboxes))
+        C = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou
+        C = C.masked_fill(~tgt_mask[:, None, :], 0.)
+
+        # [L * B, M], matched query of each target
+        if self.solver == 'auction':
+            assignment = batch_auction_assignment(C, tgt_mask)
+        else:
+            assignment = batch_sinkhorn_assignment(C, tgt_mask)
+        assignment = assignment.cpu()
+
+        indices = []
+        sizes = [len(v["boxes"]) for v in targets]
+        for k, query_inds in enumerate(assignment):
+            query_inds = query_inds[:sizes[k % bs]]
+            tgt_inds = torch.arange(len(query_inds))[query_inds >= 0]
+            query_inds = query_inds[query_inds >= 0]
+            # sorted by the query index, as the scipy solver does
+            query_inds, order = query_inds.sort()
+            indices.append((query_inds, tgt_inds[order]))
+        self.match_time += time.time() - t0
+
+        return [indices[l * bs: (l + 1) * bs] for l in range(num_layers)]
+
+
+if __name__ == "__main__":
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    torch.manual_seed(0)
+
+    def scipy_assignment(cost, gt_mask):
+        assignment = torch.full(gt_mask.shape, -1, dtype=torch.long)
+        for i, (c, m) in enumerate(zip(cost.cpu(), gt_mask.cpu())):
+            query_inds, gt_inds = linear_sum_assignment(c[:, m].numpy())
+            valid_inds = m.nonzero().squeeze(1)
+            assignment[i, valid_inds[gt_inds]] = torch.as_tensor(query_inds, dtype=torch.long)
+        return assignment
+
+    def total_cost(cost, gt_mask, assignment):
+        assignment = assignment.to(cost.device)
+        # every valid GT is matched to a different query
+        assert ((assignment >= 0) == gt_mask).all()
+        for a, m in zip(assignment, gt_mask):
+            assert len(a[m].unique()) == int(m.sum())
+        matched = cost.gather(1, assignment.clamp(min=0)[:, None, :])[:, 0]
+        return (matched * gt_mask).sum(-1)
 
-        return [(torch.as_tensor(i, dtype=torch.int64),   # tgt indexes
-                 torch.as_tensor(j, dtype=torch.int64))   # pred indexes
-                 for i, j in indices]
+    # ---------------- Optimality gap ----------------
+    scale = 1000
+    for num_queries, num_gts in [(10, 10), (100, 7), (300, 100)]:
+        cost = torch.rand(4, num_queries, num_gts, device=device) * 10
+        gt_mask = torch.rand(4, num_gts, device=device) < 0.8
+        gt_mask[0] = True
+        gt_mask[-1] = False
+        optimal = total_cost(cost, gt_mask, scipy_assignment(cost, gt_mask))
+        auction = total_cost(cost, gt_mask, batch_auction_assignment(cost, gt_mask, scale=scale))
+        sinkhorn = total_cost(cost, gt_mask, batch_sinkhorn_assignment(cost, gt_mask))
+        # the rounding of the cost costs at most 1 / scale per GT
+        assert ((auction - optimal) <= gt_mask.sum(-1) / scale + 1e-3).all()
+        print('Q = {}, G = {}: auction gap {:.4f}, sinkhorn gap {:.4f}'.format(
+            num_queries, num_gts, (auction - optimal).max().item(), (sinkhorn - optimal).max().item()))
 
+    # ---------------- Latency: 300 queries x 100 GTs ----------------
+    bs, num_queries, num_gts = 8, 300, 100
+    cost = torch.rand(bs, num_queries, num_gts, device=device) * 10
+    gt_mask = torch.ones(bs, num_gts, dtype=torch.bool, device=device)
+    solvers = {'scipy':    scipy_assignment,
+               'auction':  batch_auction_assignment,
+               'sinkhorn': batch_sinkhorn_assignment}
+    for name, solver in solvers.items():
+        solver(cost, gt_mask)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        t0 = time.time()
+        for _ in range(10):
+            solver(cost, gt_mask)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        print('{}: {:.2f} ms / batch of {} images'.format(name, (time.time() - t0) / 10 * 1000, bs))
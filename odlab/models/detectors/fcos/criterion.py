@@ -3,10 +3,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from utils.box_ops import get_ious
-from utils.misc import sigmoid_focal_loss
+from utils.misc import sigmoid_focal_loss, pad_targets, force_fp32
 from utils.distributed_utils import get_world_size, is_dist_avail_and_initialized
 
-from .matcher import FcosMatcher, AlignedOTAMatcher
+from .matcher import BatchFcosMatcher, BatchAlignedOTAMatcher
 
 
 class SetCriterion(nn.Module):
@@ -25,17 +25,17 @@ class SetCriterion(nn.Module):
             self.weight_dict = {'loss_cls': cfg.loss_cls_weight,
                                 'loss_reg': cfg.loss_reg_weight,
                                 'loss_ctn': cfg.loss_ctn_weight}
-            self.matcher = FcosMatcher(cfg.num_classes,
-                                       self.matcher_cfg['center_sampling_radius'],
-                                       self.matcher_cfg['object_sizes_of_interest'],
-                                       [1., 1., 1., 1.]
-                                       )
+            self.matcher = BatchFcosMatcher(cfg.num_classes,
+                                            self.matcher_cfg['center_sampling_radius'],
+                                            self.matcher_cfg['object_sizes_of_interest'],
+                                            [1., 1., 1., 1.]
+                                            )
         elif cfg.matcher == 'simota':
             self.weight_dict = {'loss_cls': cfg.loss_cls_weight,
                                 'loss_reg': cfg.loss_reg_weight}
-            self.matcher = AlignedOTAMatcher(cfg.num_classes,
-                                             self.matcher_cfg['soft_center_radius'],
-                                             self.matcher_cfg['topk_candidates'])
+            self.matcher = BatchAlignedOTAMatcher(cfg.num_classes,
+                                                  self.matcher_cfg['soft_center_radius'],
+                                                  self.matcher_cfg['topk_candidates'])
         else:
             raise NotImplementedError("Unknown matcher: {}.".format(cfg.matcher))
 
@@ -143,7 +143,8 @@ class SetCriterion(nn.Module):
         masks = ~torch.cat(outputs['mask'], dim=1).view(-1)
 
         # -------------------- Label Assignment --------------------
-        gt_classes, gt_deltas, gt_centerness = self.matcher(fpn_strides, anchors, targets)
+        tgt_labels, tgt_bboxes, tgt_masks = pad_targets(targets, device)
+        gt_classes, gt_deltas, gt_centerness = self.matcher(fpn_strides, anchors, tgt_labels, tgt_bboxes, tgt_masks)
         gt_classes = gt_classes.flatten().to(device)
         gt_deltas = gt_deltas.view(-1, 4).to(device)
         gt_centerness = gt_centerness.view(-1, 1).to(device)
@@ -199,7 +200,6 @@ class SetCriterion(nn.Module):
                                  'orig_size': ...}, ...]
         """
         # -------------------- Pre-process --------------------
-        bs          = outputs['pred_cls'][0].shape[0]
         device      = outputs['pred_cls'][0].device
         fpn_strides = outputs['strides']
         anchors     = outputs['anchors']
@@ -210,34 +210,26 @@ class SetCriterion(nn.Module):
         masks = ~torch.cat(outputs['mask'], dim=1).view(-1)
 
         # -------------------- Label Assignment --------------------
-        cls_targets = []
-        box_targets = []
-        assign_metrics = []
-        for batch_idx in range(bs):
-            tgt_labels = targets[batch_idx]["labels"].to(device)  # [N,]
-            tgt_bboxes = targets[batch_idx]["boxes"].to(device)   # [N, 4]
-            # refine target
-            tgt_boxes_wh = tgt_bboxes[..., 2:] - tgt_bboxes[..., :2]
-            min_tgt_size = torch.min(tgt_boxes_wh, dim=-1)[0]
-            keep = (min_tgt_size >= 8)
-            tgt_bboxes = tgt_bboxes[keep]
-            tgt_labels = tgt_labels[keep]
-            # label assignment
-            assigned_result = self.matcher(fpn_strides=fpn_strides,
-                                           anchors=anchors,
-                                           pred_cls=cls_preds[batch_idx].detach(),
-                                           pred_box=box_preds[batch_idx].detach(),
-                                           gt_labels=tgt_labels,
-                                           gt_bboxes=tgt_bboxes
-                                           )
-            cls_targets.append(assigned_result['assigned_labels'])
-            box_targets.append(assigned_result['assigned_bboxes'])
-            assign_metrics.append(assigned_result['assign_metrics'])
-
-        # List[B, M, C] -> Tensor[BM, C]
-        cls_targets = torch.cat(cls_targets, dim=0)
-        box_targets = torch.cat(box_targets, dim=0)
-        assign_metrics = torch.cat(assign_metrics, dim=0)
+        # [B, N], [B, N, 4], [B, N]
+        tgt_labels, tgt_bboxes, tgt_masks = pad_targets(targets, device)
+        # refine target
+        tgt_boxes_wh = tgt_bboxes[..., 2:] - tgt_bboxes[..., :2]
+        min_tgt_size = torch.min(tgt_boxes_wh, dim=-1)[0]
+        tgt_masks = tgt_masks & (min_tgt_size >= 8)
+        # label assignment
+        assigned_result = self.matcher(fpn_strides=fpn_strides,
+                                       anchors=anchors,
+                                       pred_cls=cls_preds.detach(),
+                                       pred_box=box_preds.detach(),
+                                       gt_labels=tgt_labels,
+                                       gt_bboxes=tgt_bboxes,
+                                       gt_mask=tgt_masks
+                                       )
+
+        # [B, M, C] -> [BM, C]
+        cls_targets = assigned_result['assigned_labels'].flatten()
+        box_targets = assigned_result['assigned_bboxes'].view(-1, 4)
+        assign_metrics = assigned_result['assign_metrics'].flatten()
 
         valid_idxs = (cls_targets >= 0) & masks
         foreground_idxs = (cls_targets >= 0) & (cls_targets != self.num_classes)
@@ -268,6 +260,7 @@ class SetCriterion(nn.Module):
 
         return loss_dict
     
+    @force_fp32
     def forward(self, outputs, targets):
         """
             outputs['pred_cls']: (Tensor) [B, M, C]
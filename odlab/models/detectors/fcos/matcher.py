@@ -221,6 +221,105 @@ class FcosMatcher(object):
         return torch.stack(gt_classes), torch.stack(gt_anchors_deltas), torch.stack(gt_centerness)
 
 
+class BatchFcosMatcher(FcosMatcher):
+    """
+        Batched version of the FcosMatcher. The in-box, in-center-radius and scale-range masks
+        and the min-area selection are computed for all the images at once on the padded targets.
+    """
+    @torch.no_grad()
+    def __call__(self, fpn_strides, anchors, gt_labels, gt_bboxes, gt_mask):
+        """
+            fpn_strides: (List) List[8, 16, 32, ...] stride of network output.
+            anchors: (List of Tensor) List[F, M, 2], F = num_fpn_levels
+            gt_labels: (Tensor) [B, N]
+            gt_bboxes: (Tensor) [B, N, 4]
+            gt_mask:   (Tensor) [B, N], True for the valid targets
+        """
+        device = anchors[0].device
+        gt_labels = gt_labels.to(device)
+        gt_bboxes = gt_bboxes.to(device)
+        gt_mask = gt_mask.to(device)
+
+        # List[F, M, 2] -> [M, 2]
+        anchors_over_all_feature_maps = torch.cat(anchors, dim=0)
+        # [M, 2], M = M1 + M2 + ... + MF
+        object_sizes_of_interest = torch.cat([anchors_i.new_tensor(scale_range).unsqueeze(0).expand(anchors_i.size(0), -1) 
+                                              for anchors_i, scale_range in zip(anchors, self.object_sizes_of_interest)], dim=0)
+        # [M,]
+        strides = torch.cat([torch.ones_like(anchors_i[:, 0]) * stride
+                             for stride, anchors_i in zip(fpn_strides, anchors)], dim=0)
+
+        # [1, 1, M, 2] & [B, N, 1, 4]
+        anchors_ = anchors_over_all_feature_maps[None, None]
+        tgt_box_ = gt_bboxes.unsqueeze(2)
+        # [B, N, M, 4], M = M1 + M2 + ... + MF
+        deltas = self.get_deltas(anchors_, tgt_box_)
+
+        if self.center_sampling_radius > 0:
+            # bbox centers: [B, N, 1, 2]
+            centers = (tgt_box_[..., :2] + tgt_box_[..., 2:]) * 0.5
+            # [1, 1, M, 1]
+            radius = (strides * self.center_sampling_radius)[None, None, :, None]
+            # [B, N, M, 4]
+            center_boxes = torch.cat((
+                torch.max(centers - radius, tgt_box_[..., :2]),
+                torch.min(centers + radius, tgt_box_[..., 2:]),
+            ), dim=-1)
+            center_deltas = self.get_deltas(anchors_, center_boxes)
+            # [B, N, M]
+            is_in_boxes = center_deltas.min(dim=-1).values > 0
+            del centers, center_boxes, center_deltas
+        else:
+            # no center sampling, it will use all the locations within a ground-truth box
+            is_in_boxes = deltas.min(dim=-1).values > 0
+        # [B, N, M]
+        max_deltas = deltas.max(dim=-1).values
+        # limit the regression range for each location
+        is_cared_in_the_level = \
+            (max_deltas >= object_sizes_of_interest[None, None, :, 0]) & \
+            (max_deltas <= object_sizes_of_interest[None, None, :, 1])
+        del deltas, max_deltas
+
+        # [B, N]
+        tgt_box_area = (gt_bboxes[..., 2] - gt_bboxes[..., 0]) * (gt_bboxes[..., 3] - gt_bboxes[..., 1])
+        # [B, N, M]
+        is_pos_positions = is_in_boxes & is_cared_in_the_level & gt_mask.unsqueeze(-1)
+        gt_positions_area = torch.where(is_pos_positions, tgt_box_area.unsqueeze(-1),
+                                        torch.full_like(tgt_box_area, math.inf).unsqueeze(-1))
+
+        # if there are still more than one objects for a position,
+        # we choose the one with minimal area
+        # [B, M], each element is the index of ground-truth
+        positions_min_area, gt_matched_idxs = gt_positions_area.min(dim=1)
+
+        # ground truth box regression
+        # [B, M, 4]
+        matched_tgt_box = gt_bboxes.gather(1, gt_matched_idxs.unsqueeze(-1).expand(-1, -1, 4))
+        gt_anchors_reg_deltas = self.get_deltas(anchors_over_all_feature_maps[None], matched_tgt_box)
+
+        # [B, M], anchors with area inf are treated as background.
+        gt_classes = gt_labels.gather(1, gt_matched_idxs)
+        gt_classes[positions_min_area == math.inf] = self.num_classes
+
+        # ground truth centerness
+        left_right = gt_anchors_reg_deltas[..., [0, 2]]
+        top_bottom = gt_anchors_reg_deltas[..., [1, 3]]
+        # [B, M]
+        gt_centerness = torch.sqrt(
+            (left_right.min(dim=-1).values / left_right.max(dim=-1).values).clamp_(min=0)
+            * (top_bottom.min(dim=-1).values / top_bottom.max(dim=-1).values).clamp_(min=0)
+        )
+
+        # the image without gt has zero regression & centerness targets
+        has_gt = gt_mask.any(dim=1)[:, None]
+        gt_anchors_reg_deltas = torch.where(has_gt.unsqueeze(-1), gt_anchors_reg_deltas,
+                                            torch.zeros_like(gt_anchors_reg_deltas))
+        gt_centerness = torch.where(has_gt, gt_centerness, torch.zeros_like(gt_centerness))
+
+        # [B, M], [B, M, 4], [B, M]
+        return gt_classes.long(), gt_anchors_reg_deltas.float(), gt_centerness.float()
+
+
 class AlignedOTAMatcher(object):
     """
     This code referenced to https://github.com/open-mmlab/mmyolo/models/task_modules/assigners/batch_dsl_assigner.py
@@ -375,4 +474,204 @@ class AlignedOTAMatcher(object):
         matched_gt_inds = matching_matrix[:, fg_mask_inboxes].argmax(0)
 
         return matched_pred_ious, matched_gt_inds, fg_mask_inboxes
-        
\ No newline at end of file
+
+
+class BatchAlignedOTAMatcher(AlignedOTAMatcher):
+    """
+        Batched version of the AlignedOTAMatcher. The cost matrices of all the images are
+        computed at once on the padded targets, [B, N, M], and the dynamic-k matching is
+        done by one sort-and-threshold instead of the per-image and per-gt loops. It gives
+        the same assignment as the AlignedOTAMatcher.
+    """
+    @torch.no_grad()
+    def __call__(self, 
+                 fpn_strides, 
+                 anchors, 
+                 pred_cls, 
+                 pred_box,
+                 gt_labels,
+                 gt_bboxes,
+                 gt_mask):
+        """
+            pred_cls:  (Tensor) [B, M, C]
+            pred_box:  (Tensor) [B, M, 4]
+            gt_labels: (Tensor) [B, N]
+            gt_bboxes: (Tensor) [B, N, 4]
+            gt_mask:   (Tensor) [B, N], True for the valid targets
+        """
+        # [M,]
+        strides = torch.cat([torch.ones_like(anchor_i[:, 0]) * stride_i
+                                for stride_i, anchor_i in zip(fpn_strides, anchors)], dim=-1)
+        # List[F, M, 2] -> [M, 2]
+        num_gt = gt_labels.shape[1]
+        anchors = torch.cat(anchors, dim=0)
+        
+        # get inside points: [B, N, M]
+        is_in_gt = self.find_batch_inside_points(gt_bboxes, anchors) & gt_mask.unsqueeze(-1)
+        valid_mask = is_in_gt.sum(dim=1) > 0  # [B, M]
+
+        # ----------------------------------- soft center prior -----------------------------------
+        gt_center = (gt_bboxes[..., :2] + gt_bboxes[..., 2:]) / 2.0
+        distance = (anchors[None, None] - gt_center.unsqueeze(2)
+                    ).pow(2).sum(-1).sqrt() / strides[None, None]  # [B, N, M]
+        distance = distance * valid_mask.unsqueeze(1)
+        soft_center_prior = torch.pow(10, distance - self.soft_center_radius)
+
+        # ----------------------------------- regression cost -----------------------------------
+        pair_wise_ious, _ = batch_box_iou(gt_bboxes, pred_box)  # [B, N, M]
+        pair_wise_ious = pair_wise_ious.masked_fill(~gt_mask.unsqueeze(-1), 0.)
+        pair_wise_ious_loss = -torch.log(pair_wise_ious + 1e-8) * 3.0
+
+        # ----------------------------------- classification cost -----------------------------------
+        ## select the predicted scores corresponded to the gt_labels
+        pairwise_pred_scores = pred_cls.permute(0, 2, 1)  # [B, M, C] -> [B, C, M]
+        gt_inds = gt_labels.long().unsqueeze(-1).expand(-1, -1, pairwise_pred_scores.shape[-1])
+        pairwise_pred_scores = pairwise_pred_scores.gather(1, gt_inds).float()   # [B, N, M]
+        ## scale factor
+        scale_factor = (pair_wise_ious - pairwise_pred_scores.sigmoid()).abs().pow(2.0)
+        ## cls cost
+        pair_wise_cls_loss = F.binary_cross_entropy_with_logits(
+            pairwise_pred_scores, pair_wise_ious,
+            reduction="none") * scale_factor # [B, N, M]
+            
+        del pairwise_pred_scores
+
+        ## foreground cost matrix
+        cost_matrix = pair_wise_cls_loss + pair_wise_ious_loss + soft_center_prior
+        cost_matrix = cost_matrix.masked_fill(~valid_mask.unsqueeze(1), 1e9)
+        # the padded targets never win any anchor
+        cost_matrix = cost_matrix.masked_fill(~gt_mask.unsqueeze(-1), float('inf'))
+
+        # ----------------------------------- dynamic label assignment -----------------------------------
+        matched_pred_ious, matched_gt_inds, fg_mask_inboxes = self.batch_dynamic_k_matching(
+            cost_matrix, pair_wise_ious, gt_mask, num_gt)
+        del pair_wise_cls_loss, cost_matrix, pair_wise_ious, pair_wise_ious_loss
+
+        # -----------------------------------process assigned labels -----------------------------------
+        assigned_labels = gt_labels.gather(1, matched_gt_inds)          # [B, M]
+        assigned_labels = torch.where(fg_mask_inboxes, assigned_labels,
+                                      torch.full_like(assigned_labels, self.num_classes))
+        assigned_labels = assigned_labels.long()  # [B, M]
+
+        gt_inds = matched_gt_inds.unsqueeze(-1).expand(-1, -1, 4)
+        assigned_bboxes = gt_bboxes.gather(1, gt_inds)                      # [B, M, 4]
+        assigned_bboxes = assigned_bboxes * fg_mask_inboxes.unsqueeze(-1)   # [B, M, 4]
+
+        assign_metrics = matched_pred_ious * fg_mask_inboxes                # [B, M]
+
+        assigned_dict = dict(
+            assigned_labels=assigned_labels,
+            assigned_bboxes=assigned_bboxes,
+            assign_metrics=assign_metrics
+            )
+        
+        return assigned_dict
+
+    def find_batch_inside_points(self, gt_bboxes, anchors):
+        """
+            gt_bboxes: Tensor -> [B, N, 4]
+            anchors:   Tensor -> [M, 2]
+        """
+        # offset: [B, N, M, 2]
+        lt = anchors[None, None] - gt_bboxes[..., None, :2]
+        rb = gt_bboxes[..., None, 2:] - anchors[None, None]
+        bbox_deltas = torch.cat([lt, rb], dim=-1)
+
+        is_in_gts = bbox_deltas.min(dim=-1).values > 0
+
+        return is_in_gts
+    
+    def batch_dynamic_k_matching(self, cost_matrix, pairwise_ious, gt_mask, num_gt):
+        """Batched dynamic_k_matching.
+
+        Args:
+            cost_matrix (Tensor): Cost matrix, [B, N, M].
+            pairwise_ious (Tensor): Pairwise iou matrix, [B, N, M].
+            gt_mask (Tensor): Mask for valid gts, [B, N].
+            num_gt (int): Number of the padded gts.
+        Returns:
+            tuple: matched ious, gt indexes and foreground mask, [B, M].
+        """
+        # select candidate topk ious for dynamic-k calculation
+        candidate_topk = min(self.topk_candidates, pairwise_ious.size(-1))
+        topk_ious, _ = torch.topk(pairwise_ious, candidate_topk, dim=-1)
+        # calculate dynamic k for each gt, the padded gts match nothing
+        dynamic_ks = torch.clamp(topk_ious.sum(-1).int(), min=1) * gt_mask
+
+        # rank of each anchor in the cost order of each gt: [B, N, M]
+        _, sorted_indices = torch.sort(cost_matrix, dim=-1, stable=True)
+        ranks = torch.empty_like(sorted_indices).scatter_(
+            -1, sorted_indices,
+            torch.arange(cost_matrix.shape[-1], device=cost_matrix.device).expand_as(sorted_indices))
+        matching_matrix = ranks < dynamic_ks.unsqueeze(-1)
+
+        del topk_ious, dynamic_ks, sorted_indices, ranks
+
+        # the anchor matched by multiple gts is assigned to the gt with the min cost
+        prior_match_gt_mask = matching_matrix.sum(1, keepdim=True) > 1  # [B, 1, M]
+        cost_argmin = torch.argmin(cost_matrix, dim=1)                   # [B, M]
+        min_cost_matrix = F.one_hot(cost_argmin, num_gt).permute(0, 2, 1).bool()
+        matching_matrix = torch.where(prior_match_gt_mask, min_cost_matrix, matching_matrix)
+        matching_matrix = matching_matrix.to(torch.uint8)
+
+        # get foreground mask inside box and center prior
+        fg_mask_inboxes = matching_matrix.sum(1) > 0                   # [B, M]
+        matched_pred_ious = (matching_matrix * pairwise_ious).sum(1)   # [B, M]
+        matched_gt_inds = matching_matrix.argmax(1)                    # [B, M]
+
+        return matched_pred_ious, matched_gt_inds, fg_mask_inboxes
+
+
+if __name__ == "__main__":
+    # Check the batched matcher against the per-image matcher on a random fixture.
+    torch.manual_seed(0)
+    bs, num_classes, img_size = 4, 20, 320
+    fpn_strides = [8, 16, 32]
+    anchors = []
+    for stride in fpn_strides:
+        fmp_size = img_size // stride
+        anchor_y, anchor_x = torch.meshgrid([torch.arange(fmp_size), torch.arange(fmp_size)], indexing="ij")
+        anchors.append((torch.stack([anchor_x, anchor_y], dim=-1).float().view(-1, 2) + 0.5) * stride)
+    num_anchors = sum([anchor_i.shape[0] for anchor_i in anchors])
+
+    pred_cls = torch.randn(bs, num_anchors, num_classes)
+    pred_ctr = torch.cat(anchors, dim=0)[None] + torch.randn(bs, num_anchors, 2) * 4
+    pred_wh  = torch.rand(bs, num_anchors, 2) * 128 + 8
+    pred_box = torch.cat([pred_ctr - pred_wh * 0.5, pred_ctr + pred_wh * 0.5], dim=-1)
+
+    targets = []
+    for batch_idx in range(bs):
+        num_tgt = batch_idx * 3
+        tgt_x1y1 = torch.rand(num_tgt, 2) * img_size * 0.6
+        tgt_wh = torch.rand(num_tgt, 2) * img_size * 0.4 + 16
+        targets.append({"labels": torch.randint(0, num_classes, [num_tgt]),
+                        "boxes": torch.cat([tgt_x1y1, tgt_x1y1 + tgt_wh], dim=-1)})
+
+    matcher = AlignedOTAMatcher(num_classes, 3.0, 13)
+    batch_matcher = BatchAlignedOTAMatcher(num_classes, 3.0, 13)
+
+    gt_labels = torch.zeros(bs, max([len(tgt["labels"]) for tgt in targets]), dtype=torch.long)
+    gt_bboxes = torch.zeros(*gt_labels.shape, 4)
+    gt_mask = torch.zeros(*gt_labels.shape, dtype=torch.bool)
+    for batch_idx, tgt in enumerate(targets):
+        gt_labels[batch_idx, :len(tgt["labels"])] = tgt["labels"]
+        gt_bboxes[batch_idx, :len(tgt["labels"])] = tgt["boxes"]
+        gt_mask[batch_idx, :len(tgt["labels"])] = True
+    batch_result = batch_matcher(fpn_strides, anchors, pred_cls, pred_box, gt_labels, gt_bboxes, gt_mask)
+
+    for batch_idx, tgt in enumerate(targets):
+        result = matcher(fpn_strides, anchors, pred_cls[batch_idx], pred_box[batch_idx], tgt["labels"], tgt["boxes"])
+        assert torch.equal(result['assigned_labels'], batch_result['assigned_labels'][batch_idx])
+        assert torch.allclose(result['assigned_bboxes'], batch_result['assigned_bboxes'][batch_idx])
+        assert torch.allclose(result['assign_metrics'], batch_result['assign_metrics'][batch_idx])
+    print("BatchAlignedOTAMatcher matches AlignedOTAMatcher on {} images.".format(bs))
+
+    fcos_matcher = FcosMatcher(num_classes, 1.5, [[-1, 64], [64, 128], [128, float('inf')]])
+    batch_fcos_matcher = BatchFcosMatcher(num_classes, 1.5, [[-1, 64], [64, 128], [128, float('inf')]])
+    gt_classes, gt_deltas, gt_centerness = fcos_matcher(fpn_strides, anchors, targets)
+    batch_gt_classes, batch_gt_deltas, batch_gt_centerness = batch_fcos_matcher(
+        fpn_strides, anchors, gt_labels, gt_bboxes, gt_mask)
+    assert torch.equal(gt_classes, batch_gt_classes)
+    assert torch.allclose(gt_deltas, batch_gt_deltas)
+    assert torch.allclose(gt_centerness, batch_gt_centerness, equal_nan=True)
+    print("BatchFcosMatcher matches FcosMatcher on {} images.".format(bs))
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 
 from utils.box_ops import get_ious
 from utils.distributed_utils import get_world_size, is_dist_avail_and_initialized
+from utils.misc import force_fp32
 
 from .matcher import AlignedOTAMatcher
 
@@ -142,6 +143,7 @@ class SetCriterion(nn.Module):
 
         return loss_dict
     
+    @force_fp32
     def forward(self, outputs, targets):
         """
             outputs['pred_cls']: (Tensor) [B, M, C]
@@ -2,10 +2,10 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from utils.box_ops import *
-from utils.misc import sigmoid_focal_loss
+from utils.misc import sigmoid_focal_loss, pad_targets, force_fp32
 from utils.distributed_utils import get_world_size, is_dist_avail_and_initialized
 
-from .matcher import UniformMatcher
+from .matcher import BatchUniformMatcher
 
 
 class SetCriterion(nn.Module):
@@ -25,7 +25,7 @@ class SetCriterion(nn.Module):
                             'loss_reg': cfg.loss_reg_weight}
         # ------------- Matcher -------------
         self.matcher_cfg = cfg.matcher_hpy
-        self.matcher = UniformMatcher(self.matcher_cfg['topk_candidates'])
+        self.matcher = BatchUniformMatcher(self.matcher_cfg['topk_candidates'])
 
     def loss_labels(self, pred_cls, tgt_cls, num_boxes):
         """
@@ -49,6 +49,7 @@ class SetCriterion(nn.Module):
 
         return loss_reg.sum() / num_boxes
 
+    @force_fp32
     def forward(self, outputs, targets):
         """
             outputs['pred_cls']: (Tensor) [B, M, C]
@@ -66,49 +67,38 @@ class SetCriterion(nn.Module):
         B = len(targets)
 
         # -------------------- Label assignment --------------------
-        indices = self.matcher(pred_box, anchor_boxes, targets)
+        # [B, N], [B, N, 4], [B, N]
+        tgt_labels, tgt_bboxes, tgt_masks = pad_targets(targets, device)
+        # [B, 2KN], K = match_times
+        src_idx, tgt_idx, match_mask = self.matcher(pred_box, anchor_boxes, tgt_bboxes, tgt_masks)
+        batch_idx = torch.arange(B, device=device).unsqueeze(-1).expand_as(src_idx)
 
         # [M, 4] -> [1, M, 4] -> [B, M, 4]
         anchor_boxes = box_cxcywh_to_xyxy(anchor_boxes)
         anchor_boxes = anchor_boxes[None].repeat(B, 1, 1)
 
-        ious = []
-        pos_ious = []
-        for i in range(B):
-            src_idx, tgt_idx = indices[i]
-            # iou between predbox and tgt box
-            iou, _ = box_iou(pred_box[i, ...], (targets[i]['boxes']).clone())
-            if iou.numel() == 0:
-                max_iou = iou.new_full((iou.size(0),), 0)
-            else:
-                max_iou = iou.max(dim=1)[0]
-            # iou between anchorbox and tgt box
-            a_iou, _ = box_iou(anchor_boxes[i], (targets[i]['boxes']).clone())
-            if a_iou.numel() == 0:
-                pos_iou = a_iou.new_full((0,), 0)
-            else:
-                pos_iou = a_iou[src_idx, tgt_idx]
-            ious.append(max_iou)
-            pos_ious.append(pos_iou)
-
-        ious = torch.cat(ious)
+        # iou between predbox and tgt box: [B, M, N] -> [BM,]
+        ious, _ = batch_box_iou(pred_box, tgt_bboxes)
+        ious = ious.masked_fill(~tgt_masks.unsqueeze(1), 0.)
+        ious = ious.max(dim=-1)[0].flatten()
         ignore_idx = ious > self.matcher_cfg['ignore_thresh']
-        pos_ious = torch.cat(pos_ious)
+        # iou between anchorbox and tgt box: [B, M, N] -> [P,], P = num of matches
+        a_ious, _ = batch_box_iou(anchor_boxes, tgt_bboxes)
+        pos_ious = a_ious[batch_idx, src_idx, tgt_idx][match_mask]
         pos_ignore_idx = pos_ious < self.matcher_cfg['iou_thresh']
 
-        src_idx = torch.cat(
-            [src + idx * anchor_boxes[0].shape[0] for idx, (src, _) in
-             enumerate(indices)])
+        # [P,]
+        src_idx = (src_idx + batch_idx * anchor_boxes[0].shape[0])[match_mask]
         # [BM,]
         gt_cls = torch.full(pred_cls.shape[:1],
                                 self.num_classes,
                                 dtype=torch.int64,
                                 device=device)
         gt_cls[ignore_idx] = -1
-        tgt_cls_o = torch.cat([t['labels'][J] for t, (_, J) in zip(targets, indices)])
+        tgt_cls_o = tgt_labels[batch_idx, tgt_idx][match_mask]
         tgt_cls_o[pos_ignore_idx] = -1
 
-        gt_cls[src_idx] = tgt_cls_o.to(device)
+        gt_cls[src_idx] = tgt_cls_o
 
         foreground_idxs = (gt_cls >= 0) & (gt_cls != self.num_classes)
         num_foreground = foreground_idxs.sum()
@@ -124,9 +114,9 @@ class SetCriterion(nn.Module):
         loss_labels = self.loss_labels(pred_cls[valid_idxs], gt_cls_target[valid_idxs], num_foreground)
 
         # -------------------- Regression loss --------------------
-        tgt_boxes = torch.cat([t['boxes'][i] for t, (_, i) in zip(targets, indices)], dim=0).to(device)
+        tgt_boxes = tgt_bboxes[batch_idx, tgt_idx][match_mask]
         tgt_boxes = tgt_boxes[~pos_ignore_idx]
-        matched_pred_box = pred_box.reshape(-1, 4)[src_idx[~pos_ignore_idx.cpu()]]
+        matched_pred_box = pred_box.reshape(-1, 4)[src_idx[~pos_ignore_idx]]
         loss_bboxes = self.loss_bboxes(matched_pred_box, tgt_boxes, num_foreground)
 
         total_loss = loss_labels * self.weight_dict["loss_cls"] + \
@@ -101,3 +101,74 @@ class UniformMatcher(nn.Module):
 
         return [(torch.as_tensor(i, dtype=torch.int64), 
                  torch.as_tensor(j, dtype=torch.int64)) for i, j in all_indices]
+
+
+class BatchUniformMatcher(UniformMatcher):
+    """
+        Batched version of the UniformMatcher working on the padded targets.
+    """
+    @torch.no_grad()
+    def forward(self, pred_boxes, anchor_boxes, tgt_bboxes, tgt_mask):
+        """
+            pred_boxes:   (Tensor) -> [B, num_queries, 4]
+            anchor_boxes: (Tensor) -> [num_queries, 4]
+            tgt_bboxes:   (Tensor) -> [B, N, 4]
+            tgt_mask:     (Tensor) -> [B, N], True for the valid targets
+            Return:
+                src_idx:   (Tensor) -> [B, 2 * match_times * N], the index of queries
+                tgt_idx:   (Tensor) -> [B, 2 * match_times * N], the index of targets
+                match_mask (Tensor) -> [B, 2 * match_times * N], True for the valid matches
+            For each image, the matches are ordered in the same way as the UniformMatcher.
+        """
+        bs, num_queries = pred_boxes.shape[:2]
+        num_tgt = tgt_bboxes.shape[1]
+
+        # Compute the L1 cost between boxes
+        # Note that we use anchors and predict boxes both
+        # [B, num_queries, N]
+        tgt_bboxes = box_xyxy_to_cxcywh(tgt_bboxes)
+        cost_bbox = torch.cdist(box_xyxy_to_cxcywh(pred_boxes), tgt_bboxes, p=1)
+        cost_bbox_anchors = torch.cdist(anchor_boxes[None].expand(bs, -1, -1), tgt_bboxes, p=1)
+
+        # positive indices when matching predict & anchor boxes with gt boxes: [B, K, N]
+        match_times = min(self.match_times, num_queries)
+        indices = torch.topk(cost_bbox, k=match_times, dim=1, largest=False)[1]
+        indices1 = torch.topk(cost_bbox_anchors, k=match_times, dim=1, largest=False)[1]
+
+        # [B, K, 2, N] -> [B, 2KN]
+        src_idx = torch.stack([indices, indices1], dim=2).flatten(1)
+        tgt_idx = torch.arange(num_tgt, device=pred_boxes.device).expand_as(src_idx.view(bs, -1, num_tgt))
+        tgt_idx = tgt_idx.flatten(1)
+        match_mask = tgt_mask.gather(1, tgt_idx)
+
+        return src_idx, tgt_idx, match_mask
+
+
+if __name__ == "__main__":
+    # Check the batched matcher against the per-image matcher on a random fixture.
+    torch.manual_seed(0)
+    bs, num_queries = 4, 500
+    anchor_boxes = torch.cat([torch.rand(num_queries, 2) * 640, torch.rand(num_queries, 2) * 256 + 16], dim=-1)
+    pred_ctr = torch.rand(bs, num_queries, 2) * 640
+    pred_wh  = torch.rand(bs, num_queries, 2) * 256 + 16
+    pred_boxes = torch.cat([pred_ctr - pred_wh * 0.5, pred_ctr + pred_wh * 0.5], dim=-1)
+
+    targets = []
+    for batch_idx in range(bs):
+        num_tgt = batch_idx * 3 + 1
+        tgt_x1y1 = torch.rand(num_tgt, 2) * 400
+        tgt_wh = torch.rand(num_tgt, 2) * 200 + 16
+        targets.append({"labels": torch.randint(0, 80, [num_tgt]),
+                        "boxes": torch.cat([tgt_x1y1, tgt_x1y1 + tgt_wh], dim=-1)})
+    tgt_bboxes = torch.zeros(bs, max([len(tgt["boxes"]) for tgt in targets]), 4)
+    tgt_mask = torch.zeros(*tgt_bboxes.shape[:2], dtype=torch.bool)
+    for batch_idx, tgt in enumerate(targets):
+        tgt_bboxes[batch_idx, :len(tgt["boxes"])] = tgt["boxes"]
+        tgt_mask[batch_idx, :len(tgt["boxes"])] = True
+
+    indices = UniformMatcher(4)(pred_boxes, anchor_boxes, targets)
+    src_idx, tgt_idx, match_mask = BatchUniformMatcher(4)(pred_boxes, anchor_boxes, tgt_bboxes, tgt_mask)
+    for batch_idx, (src, tgt) in enumerate(indices):
+        assert torch.equal(src, src_idx[batch_idx][match_mask[batch_idx]])
+        assert torch.equal(tgt, tgt_idx[batch_idx][match_mask[batch_idx]])
+    print("BatchUniformMatcher matches UniformMatcher on {} images.".format(bs))
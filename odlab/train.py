@@ -10,7 +10,7 @@ import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
 
 from utils import distributed_utils
-from utils.misc import compute_flops, collate_fn
+from utils.misc import compute_flops, collate_fn, PrecisionPolicy
 from utils.optimizer import build_optimizer
 from utils.lr_scheduler import build_wp_lr_scheduler, build_lr_scheduler
 
@@ -44,6 +44,9 @@ def parse_args():
                         help='coco, voc, widerface, crowdhuman')
     parser.add_argument('--vis_tgt', action="store_true", default=False,
                         help="visualize input data.")
+    # Mixing precision
+    parser.add_argument('--precision', default='fp32', type=str, choices=['fp32', 'fp16', 'bf16'],
+                        help="training precision: fp32, fp16 (with grad scaler) or bf16.")
     # Dataloader
     parser.add_argument('--num_workers', default=2, type=int, 
                         help='Number of workers used in dataloading')
@@ -164,6 +167,7 @@ def main():
         return
 
     # ----------------------- Training -----------------------
+    precision = PrecisionPolicy(args.precision, device)
     print("Start training")
     best_map = cfg.best_map
     for epoch in range(start_epoch, cfg.max_epoch):
@@ -180,6 +184,7 @@ def main():
                         epoch,
                         args.vis_tgt,
                         wp_lr_scheduler,
+                        precision,
                         debug=args.debug)
         
         # LR Scheduler
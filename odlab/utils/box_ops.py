@@ -89,6 +89,29 @@ def box_iou(boxes1, boxes2):
     
     return iou, union
 
+def batch_box_iou(boxes1, boxes2):
+    """
+        Batched version of box_iou.
+        boxes1: (Tensor) [B, N, 4]
+        boxes2: (Tensor) [B, M, 4]
+        Return the [B, N, M] pairwise iou & union.
+    """
+    area1 = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])  # [B, N]
+    area2 = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])  # [B, M]
+
+    lt = torch.max(boxes1[:, :, None, :2], boxes2[:, None, :, :2])  # [B,N,M,2]
+    rb = torch.min(boxes1[:, :, None, 2:], boxes2[:, None, :, 2:])  # [B,N,M,2]
+
+    wh = (rb - lt).clamp(min=0)  # [B,N,M,2]
+    inter = wh[..., 0] * wh[..., 1]  # [B,N,M]
+
+    union = area1[:, :, None] + area2[:, None, :] - inter
+    union[union == 0.0] = 1.0
+
+    iou = inter / union
+    
+    return iou, union
+
 def generalized_box_iou(boxes1, boxes2):
     """
     Generalized IoU from https://giou.stanford.edu/
@@ -111,3 +134,20 @@ def generalized_box_iou(boxes1, boxes2):
     area = wh[:, :, 0] * wh[:, :, 1]
 
     return iou - (area - union) / area
+
+def batch_generalized_box_iou(boxes1, boxes2):
+    """
+        Batched version of generalized_box_iou.
+        boxes1: (Tensor) [B, N, 4]
+        boxes2: (Tensor) [B, M, 4]
+        Return the [B, N, M] pairwise giou.
+    """
+    iou, union = batch_box_iou(boxes1, boxes2)
+
+    lt = torch.min(boxes1[:, :, None, :2], boxes2[:, None, :, :2])
+    rb = torch.max(boxes1[:, :, None, 2:], boxes2[:, None, :, 2:])
+
+    wh = (rb - lt).clamp(min=0)  # [B,N,M,2]
+    area = wh[..., 0] * wh[..., 1]
+
+    return iou - (area - union) / area
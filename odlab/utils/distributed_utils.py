@@ -4,6 +4,8 @@ import subprocess
 
 import torch
 import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+import contextlib
 
 
 def reduce_dict(input_dict, average=True):
@@ -120,3 +122,26 @@ def init_distributed_mode(args):
                                          world_size=args.world_size, rank=args.rank)
     torch.distributed.barrier()
     setup_for_distributed(args.rank == 0)
+
+
+class GradAccumulator(object):
+    """
+        Gradient accumulation over `accumulate` micro-batches. Under DDP, the micro-steps
+        before the boundary run in no_sync(), so the gradients are all-reduced once per step.
+    """
+    def __init__(self, model, accumulate=1):
+        self.model = model
+        self.accumulate = max(accumulate, 1)
+
+    def is_boundary(self, iter_i):
+        return (iter_i + 1) % self.accumulate == 0
+
+    def no_sync(self, iter_i):
+        """ Context of the forward & backward of the iter_i-th micro-batch. """
+        if isinstance(self.model, DDP) and not self.is_boundary(iter_i):
+            return self.model.no_sync()
+        return contextlib.nullcontext()
+
+    def scale(self, loss):
+        """ Normalize the loss of a micro-batch. """
+        return loss / self.accumulate
@@ -3,9 +3,14 @@
 # ---------------------------------------------------------------------------
 import time
 import datetime
+import statistics
+import warnings
+import functools
+import contextlib
 import numpy as np
 from   typing import List
 from   thop import profile
+from   scipy.optimize import linear_sum_assignment
 from   collections import defaultdict, deque
 
 import torch
@@ -26,12 +31,17 @@ class SmoothedValue(object):
         if fmt is None:
             fmt = "{median:.4f} ({global_avg:.4f})"
         self.deque = deque(maxlen=window_size)
+        self.window_total = 0.0
         self.total = 0.0
         self.count = 0
         self.fmt = fmt
 
     def update(self, value, n=1):
+        # the window sum is updated incrementally
+        if len(self.deque) == self.deque.maxlen:
+            self.window_total -= self.deque[0]
         self.deque.append(value)
+        self.window_total += value
         self.count += n
         self.total += value * n
 
@@ -41,7 +51,8 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=device)
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -50,13 +61,11 @@ class SmoothedValue(object):
 
     @property
     def median(self):
-        d = torch.tensor(list(self.deque))
-        return d.median().item()
+        return statistics.median(self.deque)
 
     @property
     def avg(self):
-        d = torch.tensor(list(self.deque), dtype=torch.float32)
-        return d.mean().item()
+        return self.window_total / len(self.deque)
 
     @property
     def global_avg(self):
@@ -82,14 +91,38 @@ class MetricLogger(object):
     def __init__(self, delimiter="\t"):
         self.meters = defaultdict(SmoothedValue)
         self.delimiter = delimiter
+        # Running sums of the tensor values since the last flush, kept on their device
+        self.pending_sums = dict()
+        self.pending_counts = defaultdict(int)
 
     def update(self, **kwargs):
         for k, v in kwargs.items():
             if isinstance(v, torch.Tensor):
-                v = v.item()
+                v = v.detach().float().reshape(())
+                self.pending_sums[k] = self.pending_sums[k] + v if k in self.pending_sums else v
+                self.pending_counts[k] += 1
+                continue
             assert isinstance(v, (float, int))
             self.meters[k].update(v)
 
+    def flush(self):
+        """
+            Average the pending tensor values over the processes with a single
+            all-reduce and one host copy, and update the meters with them.
+        """
+        if len(self.pending_sums) == 0:
+            return
+        names = list(self.pending_sums.keys())
+        sums = torch.stack([self.pending_sums[k] for k in names])
+        if is_dist_avail_and_initialized():
+            dist.all_reduce(sums)
+            sums /= dist.get_world_size()
+        for k, v in zip(names, sums.tolist()):
+            n = self.pending_counts[k]
+            self.meters[k].update(v / n, n)
+        self.pending_sums.clear()
+        self.pending_counts.clear()
+
     def __getattr__(self, attr):
         if attr in self.meters:
             return self.meters[attr]
@@ -107,6 +140,7 @@ class MetricLogger(object):
         return self.delimiter.join(loss_str)
 
     def synchronize_between_processes(self):
+        self.flush()
         for meter in self.meters.values():
             meter.synchronize_between_processes()
 
@@ -147,6 +181,7 @@ class MetricLogger(object):
             yield obj
             iter_time.update(time.time() - end)
             if i % print_freq == 0 or i == len(iterable) - 1:
+                self.flush()
                 eta_seconds = iter_time.global_avg * (len(iterable) - i)
                 eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
                 if torch.cuda.is_available():
@@ -167,6 +202,67 @@ class MetricLogger(object):
         print('{} Total time: {} ({:.4f} s / it)'.format(
             header, total_time_str, total_time / len(iterable)))
 
+## Mixed precision policy
+class PrecisionPolicy(object):
+    """
+        Mixed precision policy shared by the trainers, built on torch.autocast:
+        'fp32', 'fp16' (with a GradScaler) or 'bf16', on both the GPU and the CPU.
+    """
+    def __init__(self, precision='fp32', device=torch.device('cpu')):
+        assert precision in ['fp32', 'fp16', 'bf16']
+        self.device_type = torch.device(device).type
+        if precision == 'fp16' and self.device_type == 'cpu':
+            print('fp16 autocast is not supported on the CPU, use bf16 instead.')
+            precision = 'bf16'
+        self.precision = precision
+        self.dtype = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}[precision]
+        # Only fp16 needs the loss scaling, as bf16 has the dynamic range of fp32
+        self.scaler = torch.cuda.amp.GradScaler(enabled=precision == 'fp16')
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype, enabled=self.precision != 'fp32')
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def unscale_(self, optimizer):
+        self.scaler.unscale_(optimizer)
+
+    def step(self, optimizer):
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def state_dict(self):
+        return self.scaler.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.scaler.load_state_dict(state_dict)
+
+def _to_fp32(x):
+    if isinstance(x, torch.Tensor):
+        return x.float() if x.is_floating_point() else x
+    if isinstance(x, dict):
+        return {k: _to_fp32(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return type(x)(_to_fp32(v) for v in x)
+    return x
+
+def force_fp32(func):
+    """
+        Run the decorated function (e.g. a loss or a matcher) in fp32 under autocast,
+        with its floating tensor inputs cast to fp32.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(torch.autocast(device_type='cpu', enabled=False))
+            if torch.cuda.is_available():
+                stack.enter_context(torch.autocast(device_type='cuda', enabled=False))
+            return func(*_to_fp32(args), **_to_fp32(kwargs))
+
+    return wrapper
+
+
 class SinkhornDistance(torch.nn.Module):
     def __init__(self, eps=1e-3, max_iter=100, reduction='none'):
         super(SinkhornDistance, self).__init__()
@@ -204,6 +300,135 @@ class SinkhornDistance(torch.nn.Module):
         return (-C + u.unsqueeze(-1) + v.unsqueeze(-2)) / self.eps
     
 
+## Batched solvers of the linear assignment problem
+@torch.no_grad()
+def batch_auction_assignment(cost, gt_mask, scale=1000, eps_factor=5, max_iter=10000):
+    """
+        ε-scaling auction algorithm solving the assignments of a batch at once.
+        The cost is rounded to multiples of 1 / scale, for which the result is optimal.
+
+        cost:    (Tensor) [B, Q, G], solved by the scipy_assignment if Q < G
+        gt_mask: (Tensor) [B, G], False for the padded GTs
+        Return the matched query index of each GT: [B, G], -1 for the padded GTs.
+    """
+    bs, num_queries, num_gts = cost.shape
+    if num_gts > num_queries:
+        # some GTs are left unmatched, which the auction does not handle
+        return scipy_assignment(cost, gt_mask)
+    device = cost.device
+    # ---------------- Integer benefits ----------------
+    # The GTs bid for the queries. The problem is made square with dummy bidders of zero benefit
+    # (padded GTs included), and the benefits are scaled by (Q + 1), so that ε = 1 is exact.
+    int_cost = torch.round(cost.double().transpose(1, 2) * scale).long() * (num_queries + 1)
+    benefit = torch.zeros([bs, num_queries, num_queries], dtype=torch.long, device=device)
+    benefit[:, :num_gts] = torch.where(gt_mask[..., None], -int_cost, torch.zeros_like(int_cost))
+
+    neg_inf = torch.iinfo(torch.long).min // 4
+    indexes = torch.arange(num_queries, device=device).expand(bs, -1)
+    prices = torch.zeros([bs, num_queries], dtype=torch.long, device=device)
+    eps = max(int(benefit.max() - benefit.min()) // eps_factor, 1)
+
+    # ---------------- ε-scaling phases ----------------
+    while True:
+        # object of each bidder, with an extra slot to drop the unused scatters
+        owner = torch.full([bs, num_queries + 1], -1, dtype=torch.long, device=device)
+        obj_owner = torch.full([bs, num_queries], -1, dtype=torch.long, device=device)
+        for _ in range(max_iter):
+            active = owner[:, :-1] < 0
+            if not active.any():
+                break
+            # Bidding: each unassigned bidder bids for its best object
+            values = benefit - prices[:, None, :]
+            top_values, top_objs = values.topk(min(2, num_queries), dim=-1)
+            best_objs = top_objs[..., 0]
+            bids = prices.gather(1, best_objs) + top_values[..., 0] - top_values[..., -1] + eps
+            bids = torch.where(active, bids, torch.full_like(bids, neg_inf))
+
+            # Assignment: each object goes to its highest bidder
+            max_bids = torch.full_like(prices, neg_inf).scatter_reduce(1, best_objs, bids, 'amax')
+            is_winner = active & (bids == max_bids.gather(1, best_objs))
+            winners = torch.full_like(prices, -1).scatter_reduce(
+                1, best_objs, torch.where(is_winner, indexes, torch.full_like(indexes, -1)), 'amax')
+            sold = winners >= 0
+
+            # The previous owners of the sold objects become unassigned
+            prev_owners = torch.where(sold & (obj_owner >= 0), obj_owner, torch.full_like(obj_owner, num_queries))
+            owner.scatter_(1, prev_owners, -1)
+            owner.scatter_(1, torch.where(sold, winners, torch.full_like(winners, num_queries)), indexes)
+            obj_owner = torch.where(sold, winners, obj_owner)
+            prices = torch.where(sold, max_bids, prices)
+
+        if (owner[:, :-1] < 0).any():
+            # the valid GTs left unassigned would be dropped from the loss
+            warnings.warn('The auction did not converge in {} iterations, '
+                          'the assignments are solved by scipy instead.'.format(max_iter))
+            return scipy_assignment(cost, gt_mask)
+        if eps == 1:
+            break
+        eps = max(eps // eps_factor, 1)
+
+    return torch.where(gt_mask, owner[:, :num_gts], torch.full_like(owner[:, :num_gts], -1))
+
+def scipy_assignment(cost, gt_mask):
+    """
+        The assignments of a batch solved image by image by the scipy, the fallback of the auction.
+        With more GTs than queries, the extra GTs are left unmatched.
+
+        cost:    (Tensor) [B, Q, G]
+        gt_mask: (Tensor) [B, G], False for the padded GTs
+        Return the matched query index of each GT: [B, G], -1 for the unmatched & padded GTs.
+    """
+    cost_cpu, gt_mask_cpu = cost.detach().double().cpu(), gt_mask.cpu()
+    assignment = torch.full(gt_mask.shape, -1, dtype=torch.long)
+    for b in range(cost.shape[0]):
+        gt_inds = torch.nonzero(gt_mask_cpu[b]).flatten()
+        query_inds, col_inds = linear_sum_assignment(cost_cpu[b][:, gt_inds].numpy())
+        assignment[b, gt_inds[col_inds]] = torch.as_tensor(query_inds, dtype=torch.long)
+
+    return assignment.to(cost.device)
+
+@torch.no_grad()
+def batch_sinkhorn_assignment(cost, gt_mask, eps=0.05, max_iter=50):
+    """
+        Entropic approximation of the assignments of a batch, solved by the
+        Sinkhorn iterations and rounded greedily to a one-to-one matching.
+
+        cost:    (Tensor) [B, Q, G], solved by the scipy_assignment if Q < G
+        gt_mask: (Tensor) [B, G], False for the padded GTs
+        Return the matched query index of each GT: [B, G], -1 for the padded GTs.
+    """
+    bs, num_queries, num_gts = cost.shape
+    if num_gts > num_queries:
+        # the background marginal Q - G would be negative
+        return scipy_assignment(cost, gt_mask)
+    valid_mask = gt_mask[:, None, :].expand_as(cost)
+    # Normalize the cost of each image to [0, 1], so that ε does not depend on the cost scale
+    cost = cost.float()
+    cost_min = cost.masked_fill(~valid_mask, float('inf')).flatten(1).min(dim=1)[0][:, None, None]
+    cost_max = cost.masked_fill(~valid_mask, -float('inf')).flatten(1).max(dim=1)[0][:, None, None]
+    cost = ((cost - cost_min) / (cost_max - cost_min).clamp(min=1e-6)).masked_fill(~valid_mask, 0.)
+
+    # Each query sends one unit to a GT or to the background, which takes the rest
+    mu = torch.ones([bs, num_queries], device=cost.device)
+    nu = torch.cat([gt_mask.float(), (num_queries - gt_mask.sum(-1, keepdim=True)).float()], dim=-1)
+    cost = torch.cat([cost, torch.zeros_like(cost[..., :1])], dim=-1)
+    _, pi = SinkhornDistance(eps, max_iter)(mu, nu, cost)
+
+    # Greedy rounding on the transport plan
+    scores = pi[..., :num_gts].masked_fill(~valid_mask, -1.)
+    assignment = torch.full([bs, num_gts], -1, dtype=torch.long, device=cost.device)
+    batch_inds = torch.arange(bs, device=cost.device)
+    for _ in range(int(gt_mask.sum(-1).max())):
+        best = scores.flatten(1).argmax(dim=1)
+        query_inds, gt_inds = best // num_gts, best % num_gts
+        is_valid = scores[batch_inds, query_inds, gt_inds] >= 0
+        assignment[batch_inds, gt_inds] = torch.where(is_valid, query_inds, assignment[batch_inds, gt_inds])
+        scores[batch_inds, query_inds, :] = -1.
+        scores[batch_inds, :, gt_inds] = -1.
+
+    return assignment
+    
+
 # ---------------------------- Dataloader tools ----------------------------
 def _max_by_axis(the_list):
     # type: (List[List[int]]) -> List[int]
@@ -233,6 +458,64 @@ def batch_tensor_from_tensor_list(tensor_list: List[Tensor]):
     
     return tensor, mask
 
+## pad the targets of a batch
+def pad_targets(targets, device=None):
+    """
+        Pad the per-image targets to a common number of boxes, so that
+        the label assignment could be done on the whole batch at once.
+
+        targets: (List) [dict{'boxes': [...], 
+                              'labels': [...], 
+                              'orig_size': ...}, ...]
+        Return:
+            tgt_labels: (Tensor) [B, N]
+            tgt_bboxes: (Tensor) [B, N, 4]
+            tgt_mask:   (Tensor) [B, N], True for the valid targets
+    """
+    bs = len(targets)
+    src_device = targets[0]["boxes"].device
+    if device is None:
+        device = src_device
+    num_tgts = [len(tgt["labels"]) for tgt in targets]
+    num_max = max(max(num_tgts), 1)
+
+    # The targets are padded where they are and then moved to the device in one copy.
+    labels = torch.cat([tgt["labels"].to(src_device) for tgt in targets])
+    bboxes = torch.cat([tgt["boxes"].to(src_device).reshape(-1, 4) for tgt in targets]).float()
+    num_tgts = torch.as_tensor(num_tgts, device=src_device)
+    batch_inds = torch.repeat_interleave(torch.arange(bs, device=src_device), num_tgts)
+    tgt_inds = torch.arange(len(labels), device=src_device) - (torch.cumsum(num_tgts, 0) - num_tgts)[batch_inds]
+
+    tgt_labels = torch.zeros([bs, num_max], dtype=torch.long, device=src_device)
+    tgt_bboxes = torch.zeros([bs, num_max, 4], dtype=torch.float32, device=src_device)
+    tgt_mask   = torch.zeros([bs, num_max], dtype=torch.bool, device=src_device)
+    tgt_labels[batch_inds, tgt_inds] = labels.long()
+    tgt_bboxes[batch_inds, tgt_inds] = bboxes
+    tgt_mask[batch_inds, tgt_inds] = True
+
+    tgt_labels = tgt_labels.to(device, non_blocking=True)
+    tgt_bboxes = tgt_bboxes.to(device, non_blocking=True)
+    tgt_mask   = tgt_mask.to(device, non_blocking=True)
+
+    return tgt_labels, tgt_bboxes, tgt_mask
+
+## move the targets of a batch to the device
+def targets_to_device(targets, device):
+    """
+        Move the targets to the device with one copy per field for the whole batch,
+        instead of one copy per field for every image.
+    """
+    targets_device = [dict() for _ in targets]
+    for k in targets[0].keys():
+        fields = [tgt[k] for tgt in targets]
+        # flatten & pack the field of all the images
+        packed_fields = torch.cat([field.reshape(-1) for field in fields]).to(device, non_blocking=True)
+        packed_fields = packed_fields.split([field.numel() for field in fields])
+        for tgt, field, packed_field in zip(targets_device, fields, packed_fields):
+            tgt[k] = packed_field.view(field.shape)
+
+    return targets_device
+
 def collate_fn(batch):
     batch = list(zip(*batch))
     batch[0] = batch_tensor_from_tensor_list(batch[0])
@@ -84,6 +84,8 @@ class GElanBaseConfig(object):
         self.use_ema = True
         self.ema_decay = 0.9998
         self.ema_tau   = 2000
+        self.ema_update_interval = 1   # update the EMA every n steps
+        self.ema_offload = False       # keep the EMA weights in pinned host memory
 
         # ---------------- Optimizer config ----------------
         self.trainer      = 'yolo'
@@ -112,6 +114,10 @@ class GElanBaseConfig(object):
         self.mixup_prob  = 0.0
         self.copy_paste  = 0.0           # approximated by the YOLOX's mixup
         self.multi_scale = [0.5, 1.25]   # multi scale: [img_size * 0.5, img_size * 1.25]
+        ## Progressive resizing: the img_size ramps up from train_img_size * resize_min_ratio
+        self.resize_min_ratio   = 1.0     # 1.0: train at the full img_size from the start
+        self.resize_ramp_epoch  = 0       # number of epochs to reach the full img_size
+        self.resize_scale_batch = False   # enlarge the batch size & lr as the images shrink
         ## Pixel mean & std
         self.pixel_mean = [0., 0., 0.]
         self.pixel_std  = [255., 255., 255.]
@@ -63,6 +63,9 @@ class RTDetrBaseConfig(object):
         self.cost_class = 2.0
         self.cost_bbox  = 5.0
         self.cost_giou  = 2.0
+        self.matcher_solver = 'hungarian'     # 'hungarian' (scipy), 'auction' or 'sinkhorn' (on device)
+        self.matcher_num_workers = 4          # threads solving the per-image assignments
+        self.reuse_matching_for_aux = False   # aux layers reuse the matching of the last layer
         ## Loss weight
         self.loss_cls  = 1.0
         self.loss_box  = 5.0
@@ -72,6 +75,8 @@ class RTDetrBaseConfig(object):
         self.use_ema = True
         self.ema_decay = 0.9999
         self.ema_tau   = 2000
+        self.ema_update_interval = 1   # update the EMA every n steps
+        self.ema_offload = False       # keep the EMA weights in pinned host memory
 
         # ---------------- Optimizer config ----------------
         self.trainer = 'rtdetr'
@@ -0,0 +1,219 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+
+class AnnotationIndex(object):
+    """
+        Compact columnar index of the annotations, in a CSR layout: the boxes & labels of the i-th image
+        are boxes[offsets[i]: offsets[i+1]] & labels[offsets[i]: offsets[i+1]], with the class ids remapped.
+
+        All the fields are flat numpy arrays, so that a sample is fetched by a slice, and the pages
+        of the forked DataLoader workers are not copied on write by the refcounts of the python objects.
+    """
+    fields = ['image_ids', 'shapes', 'offsets', 'boxes', 'labels', 'file_names']
+
+    def __init__(self, image_ids, shapes, offsets, boxes, labels, file_names=None, class_ids=None):
+        self.image_ids  = np.asarray(image_ids, dtype=np.int64)              # [N,]
+        self.shapes     = np.asarray(shapes, dtype=np.int64).reshape(-1, 2)  # [N, 2], (height, width)
+        self.offsets    = np.asarray(offsets, dtype=np.int64)                # [N+1,]
+        self.boxes      = np.asarray(boxes, dtype=np.float32).reshape(-1, 4) # [M, 4], (x1, y1, x2, y2)
+        self.labels     = np.asarray(labels, dtype=np.int16)                 # [M,]
+        self.file_names = None if file_names is None else np.asarray(file_names)                 # [N,]
+        # the sorted category ids, i.e. the original id of each label
+        self.class_ids  = class_ids
+        # hash of the annotation file, set by the load_anno_index, which keys the caches built on the index
+        self.digest     = None
+
+    @classmethod
+    def from_coco(cls, coco, image_ids, class_ids, iscrowd=None, drop_empty=False):
+        """
+            Build the index from a pycocotools COCO, with the same filters as the former per-sample pull_anno.
+            iscrowd: (int) only keep the annotations with this iscrowd flag, or all of them with None.
+            drop_empty: (bool) drop the boxes of zero width or height.
+        """
+        cls_map = {cat_id: i for i, cat_id in enumerate(class_ids)}
+        shapes, file_names = [], []
+        offsets, boxes, labels = [0], [], []
+        for img_id in image_ids:
+            im_ann = coco.imgs[img_id]
+            width, height = im_ann['width'], im_ann['height']
+            shapes.append([height, width])
+            file_names.append(im_ann['file_name'])
+            for anno in coco.imgToAnns[img_id]:
+                if iscrowd is not None and anno['iscrowd'] != iscrowd:
+                    continue
+                if 'bbox' not in anno or anno['area'] <= 0:
+                    continue
+                x1 = max(0, anno['bbox'][0])
+                y1 = max(0, anno['bbox'][1])
+                x2 = min(width - 1, x1 + max(0, anno['bbox'][2] - 1))
+                y2 = min(height - 1, y1 + max(0, anno['bbox'][3] - 1))
+                if x2 < x1 or y2 < y1 or drop_empty and (x2 == x1 or y2 == y1):
+                    continue
+                boxes.append([x1, y1, x2, y2])
+                labels.append(cls_map[anno['category_id']])
+            offsets.append(len(labels))
+
+        return cls(image_ids, shapes, offsets, boxes, labels, file_names, list(class_ids))
+
+    def save(self, path):
+        """
+            Save the fields as the .npy files of a directory, which is written in a temporary directory
+            & renamed at last, so that a concurrent process never reads a partial index.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path))
+        for name in self.fields:
+            if getattr(self, name) is not None:
+                np.save(os.path.join(tmp_path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'class_ids': self.class_ids}, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # saved by another process in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        # the arrays are memory-mapped, not read
+        arrays = {}
+        for name in cls.fields:
+            if os.path.exists(os.path.join(path, name + '.npy')):
+                arrays[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        return cls(**arrays, class_ids=meta['class_ids'])
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def get(self, index):
+        """
+            Return the boxes & labels of the index-th image, as the copies which may be modified in place.
+        """
+        start, end = self.offsets[index], self.offsets[index + 1]
+        bboxes = self.boxes[start: end].astype(np.float64)
+        labels = self.labels[start: end].astype(np.int64)
+
+        return bboxes, labels
+
+    def nbytes(self):
+        arrays = [self.image_ids, self.shapes, self.offsets, self.boxes, self.labels]
+        if self.file_names is not None:
+            arrays.append(self.file_names)
+        return sum(a.nbytes for a in arrays)
+
+
+# ------------------------------ Cache of the index ------------------------------
+ANNO_CACHE_VERSION = 1
+
+def load_anno_index(anno_file, iscrowd=None, drop_empty=False, cache_dir=None):
+    """
+        Load the annotation index of a COCO-style json file from the cache, which is keyed by the hash of the
+        file & the filters, so that the json is only parsed on the first launch or after it is changed.
+    """
+    cache_dir = cache_dir or os.environ.get('YOLO_ANNO_CACHE', os.path.expanduser('~/.cache/yolo_tutorial/annotations'))
+    digest = file_digest(anno_file, [ANNO_CACHE_VERSION, iscrowd, drop_empty])
+    cache_path = os.path.join(cache_dir, digest)
+
+    if os.path.isdir(cache_path):
+        index = AnnotationIndex.load(cache_path)
+        index.digest = digest
+        return index
+
+    # ---------------- Parse the json on a miss ----------------
+    from pycocotools.coco import COCO
+    coco = COCO(anno_file)
+    index = AnnotationIndex.from_coco(coco, coco.getImgIds(), sorted(coco.getCatIds()), iscrowd, drop_empty)
+    try:
+        index.save(cache_path)
+    except OSError as e:
+        print('Failed to cache the annotation index of {}: {}'.format(anno_file, e))
+    index.digest = digest
+
+    return index
+
+def file_digest(path, extra=None):
+    """
+        The sha1 of a file & of the json of `extra`, in hex.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(16 * 1024**2), b''):
+            sha1.update(chunk)
+    if extra is not None:
+        sha1.update(json.dumps(extra).encode())
+
+    return sha1.hexdigest()
+
+
+if __name__ == "__main__":
+    # Check the index against the former per-sample pull_anno on a synthetic COCO
+    import time
+    from pycocotools.coco import COCO
+
+    rng = np.random.default_rng(0)
+    coco = COCO()
+    coco.dataset = {'images': [], 'annotations': [], 'categories': [{'id': i * 2 + 1} for i in range(20)]}
+    for img_id in range(2000):
+        coco.dataset['images'].append({'id': img_id, 'width': 640, 'height': 480, 'file_name': '{}.jpg'.format(img_id)})
+        for _ in range(rng.integers(0, 12)):
+            x, y, w, h = rng.uniform(0, 640), rng.uniform(0, 480), rng.uniform(0, 200), rng.uniform(0, 200)
+            coco.dataset['annotations'].append({'id': len(coco.dataset['annotations']) + 1, 'image_id': img_id,
+                                                'category_id': int(rng.integers(0, 20)) * 2 + 1, 'bbox': [x, y, w, h],
+                                                'area': w * h, 'iscrowd': int(rng.random() < 0.1)})
+    coco.createIndex()
+    class_ids = sorted(coco.getCatIds())
+
+    def pull_anno(img_id):
+        im_ann = coco.loadImgs(img_id)[0]
+        width, height = im_ann['width'], im_ann['height']
+        bboxes, labels = [], []
+        for anno in coco.loadAnns(coco.getAnnIds(imgIds=[int(img_id)], iscrowd=False)):
+            if 'bbox' in anno and anno['area'] > 0:
+                x1 = np.max((0, anno['bbox'][0]))
+                y1 = np.max((0, anno['bbox'][1]))
+                x2 = np.min((width - 1, x1 + np.max((0, anno['bbox'][2] - 1))))
+                y2 = np.min((height - 1, y1 + np.max((0, anno['bbox'][3] - 1))))
+                if x2 < x1 or y2 < y1:
+                    continue
+                bboxes.append([x1, y1, x2, y2])
+                labels.append(class_ids.index(anno['category_id']))
+        return np.array(bboxes).reshape(-1, 4), np.array(labels).reshape(-1)
+
+    index = AnnotationIndex.from_coco(coco, coco.getImgIds(), class_ids, iscrowd=0)
+    t0 = time.time()
+    for img_id in index.image_ids:
+        pull_anno(img_id)
+    t1 = time.time()
+    for i, img_id in enumerate(index.image_ids):
+        index_bboxes, index_labels = index.get(i)
+        bboxes, labels = pull_anno(img_id)
+        assert np.allclose(index_bboxes, bboxes, atol=1e-3) and (index_labels == labels).all()
+    t2 = time.time()
+    for i in range(len(index)):
+        index.get(i)
+    t3 = time.time()
+    print('pull_anno: {:.1f} us / image, index: {:.1f} us / image, {:.1f} KB'.format(
+        (t1 - t0) / len(index) * 1e6, (t3 - t2) / len(index) * 1e6, index.nbytes() / 1024))
+
+    # Round trip of the cache, which is loaded instead of parsing the json
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        anno_file = os.path.join(tmp_dir, 'instances.json')
+        with open(anno_file, 'w') as f:
+            json.dump(coco.dataset, f)
+        t0 = time.time()
+        index = load_anno_index(anno_file, iscrowd=0, cache_dir=os.path.join(tmp_dir, 'cache'))
+        t1 = time.time()
+        cached = load_anno_index(anno_file, iscrowd=0, cache_dir=os.path.join(tmp_dir, 'cache'))
+        t2 = time.time()
+        for name in AnnotationIndex.fields:
+            assert (getattr(index, name) == getattr(cached, name)).all()
+        assert cached.class_ids == index.class_ids
+        print('Index from the json: {:.3f}s, from the cache: {:.3f}s'.format(t1 - t0, t2 - t1))
@@ -0,0 +1,36 @@
+import torch
+
+
+class AugmentControl(object):
+    """
+        Control block of the augmentation state in the shared memory, written by the main process & read by
+        the DataLoader workers on each item, so that a change, e.g. closing the mosaic at the second stage,
+        takes effect in the persistent workers at once. The block is a shared tensor, which is inherited by
+        the forked workers & passed as a handle to the spawned ones.
+    """
+    fields = ['epoch', 'mosaic_prob', 'mixup_prob', 'copy_paste', 'img_size']
+
+    def __init__(self):
+        self.block = torch.zeros(len(self.fields), dtype=torch.float64).share_memory_()
+
+    def __getitem__(self, name):
+        return self.block[self.fields.index(name)].item()
+
+    def __setitem__(self, name, value):
+        self.block[self.fields.index(name)] = float(value)
+
+    def __repr__(self):
+        return 'AugmentControl({})'.format(', '.join('{}={}'.format(k, self[k]) for k in self.fields))
+
+
+def control_property(name, cast=float):
+    """
+        Attribute of a dataset stored in its AugmentControl.
+    """
+    def getter(self):
+        return cast(self.control[name])
+
+    def setter(self, value):
+        self.control[name] = value
+
+    return property(getter, setter)
@@ -1,10 +1,12 @@
 import os
+import torch
 
 try:
     # dataset class
     from .voc     import VOCDataset
     from .coco    import COCODataset
     from .custom  import CustomDataset
+    from .shard   import ShardDataset
     # transform class
     from .data_augment.yolo_augment import YOLOAugmentation, YOLOBaseTransform
     from .data_augment.ssd_augment  import SSDAugmentation, SSDBaseTransform
@@ -14,6 +16,7 @@ except:
     from voc     import VOCDataset
     from coco    import COCODataset
     from custom  import CustomDataset
+    from shard   import ShardDataset
     # transform class
     from data_augment.yolo_augment import YOLOAugmentation, YOLOBaseTransform
     from data_augment.ssd_augment  import SSDAugmentation, SSDBaseTransform
@@ -22,8 +25,15 @@ except:
 # ------------------------------ Dataset ------------------------------
 def build_dataset(args, cfg, transform=None, is_train=False):
     # ------------------------- Build dataset -------------------------
+    ## Packed shards of the training set, see pack_dataset.py
+    if is_train and getattr(args, 'shard_dir', None):
+        dataset = ShardDataset(cfg       = cfg,
+                               data_dir  = args.shard_dir,
+                               transform = transform,
+                               is_train  = is_train,
+                               )
     ## VOC dataset
-    if args.dataset == 'voc':
+    elif args.dataset == 'voc':
         dataset = VOCDataset(cfg       = cfg,
                              data_dir  = args.root,
                              transform = transform,
@@ -46,6 +56,24 @@ def build_dataset(args, cfg, transform=None, is_train=False):
                                   is_train  = is_train,
                                   )
 
+    ## Reuse of the recently decoded images as the mosaic partners
+    if is_train:
+        dataset.partner_reuse = getattr(args, 'partner_reuse', 0.0)
+        dataset.partner_pool_size = getattr(args, 'partner_pool', 64)
+
+    ## Cache of the decoded training images
+    cache_images = getattr(args, 'cache_images', 'none')
+    if is_train and cache_images != 'none':
+        cache_path = None
+        if cache_images == 'disk':
+            # one cache file per rank, as the ranks fill their caches separately, & per annotation file,
+            # so that the images of a changed dataset are not served from a stale cache of the same size
+            rank = torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
+            digest = (dataset.anno_index.digest or 'nodigest')[:12]
+            cache_path = os.path.join(args.cache_dir or os.path.join(args.root, 'cache'),
+                                      '{}_{}_{}_{}_rank{}'.format(args.dataset, dataset.image_set, cfg.train_img_size, digest, rank))
+        dataset.build_image_cache(cfg.train_img_size, args.cache_budget, cache_images, cache_path)
+
     cfg.class_labels = dataset.class_labels
     cfg.class_indexs = dataset.class_indexs
     cfg.num_classes  = dataset.num_classes
@@ -54,7 +82,11 @@ def build_dataset(args, cfg, transform=None, is_train=False):
 
 
 # ------------------------------ Transform ------------------------------
-def build_transform(cfg, is_train=False):
+def build_transform(cfg, is_train=False, uint8_output=False, batch_augment=False):
+    """
+        uint8_output: (bool) the YOLO transforms output the uint8 images, normalized on the device by the DevicePrefetcher.
+        batch_augment: (bool) the YOLO augmentations after the mosaic are left to the BatchAugmentation on the device.
+    """
     # ---------------- Build transform ----------------
     ## YOLO style transform
     if cfg.aug_type == 'yolo':
@@ -64,14 +96,17 @@ def build_transform(cfg, is_train=False):
                                          cfg.pixel_mean,
                                          cfg.pixel_std,
                                          cfg.box_format,
-                                         cfg.normalize_coords)
+                                         cfg.normalize_coords,
+                                         uint8_output,
+                                         batch_augment)
         else:
             transform = YOLOBaseTransform(cfg.test_img_size,
                                           cfg.max_stride,
                                           cfg.pixel_mean,
                                           cfg.pixel_std,
                                           cfg.box_format,
-                                          cfg.normalize_coords)
+                                          cfg.normalize_coords,
+                                          uint8_output)
 
     ## RT-DETR style transform
     elif cfg.aug_type == 'ssd':
@@ -2,14 +2,15 @@ import os
 import cv2
 import time
 import numpy as np
-from pycocotools.coco import COCO
 
 try:
     from .data_augment.strong_augment import MosaicAugment, MixupAugment
     from .voc import VOCDataset
+    from .anno_index import load_anno_index
 except:
     from  data_augment.strong_augment import MosaicAugment, MixupAugment
     from  voc import VOCDataset
+    from  anno_index import load_anno_index
 
 
 coco_class_indexs = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 27, 28, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 46, 47, 48, 49, 50, 51, 52, 53, 54, 55, 56, 57, 58, 59, 60, 61, 62, 63, 64, 65, 67, 70, 72, 73, 74, 75, 76, 77, 78, 79, 80, 81, 82, 84, 85, 86, 87, 88, 89, 90]
@@ -37,9 +38,10 @@ class COCODataset(VOCDataset):
         self.num_classes = 80
         # ----------- Data parameters -----------
         self.json_file = coco_json_files['{}'.format(self.image_set)]
-        self.coco = COCO(os.path.join(self.data_dir, 'annotations', self.json_file))
-        self.ids = self.coco.getImgIds()
-        self.class_ids = sorted(self.coco.getCatIds())
+        self.anno_file = os.path.join(self.data_dir, 'annotations', self.json_file)
+        self.anno_index = load_anno_index(self.anno_file, iscrowd=0)
+        self.class_ids = self.anno_index.class_ids
+        self.ids = self.anno_index.image_ids
         self.dataset_size = len(self.ids)
         self.class_labels = coco_class_labels
         self.class_indexs = coco_class_indexs
@@ -63,52 +65,8 @@ class COCODataset(VOCDataset):
         print('use Mixup Augmentation: {}'.format(self.mixup_prob))
         print('use Copy-paste Augmentation: {}'.format(self.copy_paste))
 
-    def pull_image(self, index):
-        # get the image file name
-        image_dict = self.coco.dataset['images'][index]
-        image_id = image_dict["id"]
-        filename = image_dict["file_name"]
-
-        # load the image
-        image_path = os.path.join(self.data_dir, self.image_set, filename)
-        image = cv2.imread(image_path)
-
-        assert image is not None
-
-        return image, image_id
-
-    def pull_anno(self, index):
-        img_id = self.ids[index]
-        # image infor
-        im_ann = self.coco.loadImgs(img_id)[0]
-        width = im_ann['width']
-        height = im_ann['height']
- 
-        # load a target
-        anno_ids = self.coco.getAnnIds(imgIds=[int(img_id)], iscrowd=False)
-        annotations = self.coco.loadAnns(anno_ids)
-        bboxes = []
-        labels = []
-        for anno in annotations:
-            if 'bbox' in anno and anno['area'] > 0:
-                # bbox
-                x1 = np.max((0, anno['bbox'][0]))
-                y1 = np.max((0, anno['bbox'][1]))
-                x2 = np.min((width - 1, x1 + np.max((0, anno['bbox'][2] - 1))))
-                y2 = np.min((height - 1, y1 + np.max((0, anno['bbox'][3] - 1))))
-                if x2 < x1 or y2 < y1:
-                    continue
-                # class label
-                cls_id = self.class_ids.index(anno['category_id'])
-                
-                bboxes.append([x1, y1, x2, y2])
-                labels.append(cls_id)
-
-        # guard against no boxes via resizing
-        bboxes = np.array(bboxes).reshape(-1, 4)
-        labels = np.array(labels).reshape(-1)
-        
-        return bboxes, labels
+    def image_path(self, index):
+        return os.path.join(self.data_dir, self.image_set, self.anno_index.file_names[index]), self.ids[index]
 
 
 if __name__ == "__main__":
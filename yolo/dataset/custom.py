@@ -2,14 +2,15 @@ import os
 import cv2
 import time
 import numpy as np
-from pycocotools.coco import COCO
 
 try:
     from .data_augment.strong_augment import MosaicAugment, MixupAugment
     from .coco import COCODataset
+    from .anno_index import load_anno_index
 except:
     from  data_augment.strong_augment import MosaicAugment, MixupAugment
     from  coco import COCODataset
+    from  anno_index import load_anno_index
 
 
 custom_class_indexs = [0, 1, 2, 3, 4, 5, 6, 7, 8]
@@ -31,9 +32,10 @@ class CustomDataset(COCODataset):
         self.data_dir = data_dir
         self.json_file = '{}.json'.format(self.image_set)
         # ----------- Data parameters -----------
-        self.coco = COCO(os.path.join(self.data_dir, self.image_set, 'annotations', self.json_file))
-        self.ids = self.coco.getImgIds()
-        self.class_ids = sorted(self.coco.getCatIds())
+        self.anno_file = os.path.join(self.data_dir, self.image_set, 'annotations', self.json_file)
+        self.anno_index = load_anno_index(self.anno_file, iscrowd=0, drop_empty=True)
+        self.class_ids = self.anno_index.class_ids
+        self.ids = self.anno_index.image_ids
         self.dataset_size = len(self.ids)
         self.class_labels = custom_class_labels
         self.class_indexs = custom_class_indexs
@@ -63,48 +65,11 @@ class CustomDataset(COCODataset):
         print('use Mixup Augmentation: {}'.format(self.mixup_prob))
         print('use Copy-paste Augmentation: {}'.format(self.copy_paste))
 
-    def pull_image(self, index):
-        id_ = self.ids[index]
-        im_ann = self.coco.loadImgs(id_)[0] 
+    def image_path(self, index):
         img_file = os.path.join(
-                self.data_dir, self.image_set, 'images', im_ann["file_name"])
-        image = cv2.imread(img_file)
+                self.data_dir, self.image_set, 'images', self.anno_index.file_names[index])
 
-        return image, id_
-
-    def pull_anno(self, index):
-        img_id = self.ids[index]
-        im_ann = self.coco.loadImgs(img_id)[0]
-        anno_ids = self.coco.getAnnIds(imgIds=[int(img_id)], iscrowd=0)
-        annotations = self.coco.loadAnns(anno_ids)
-        
-        # image infor
-        width = im_ann['width']
-        height = im_ann['height']
-        
-        #load a target
-        bboxes = []
-        labels = []
-        for anno in annotations:
-            if 'bbox' in anno and anno['area'] > 0:
-                # bbox
-                x1 = np.max((0, anno['bbox'][0]))
-                y1 = np.max((0, anno['bbox'][1]))
-                x2 = np.min((width - 1, x1 + np.max((0, anno['bbox'][2] - 1))))
-                y2 = np.min((height - 1, y1 + np.max((0, anno['bbox'][3] - 1))))
-                if x2 <= x1 or y2 <= y1:
-                    continue
-                # class label
-                cls_id = self.class_ids.index(anno['category_id'])
-                
-                bboxes.append([x1, y1, x2, y2])
-                labels.append(cls_id)
-
-        # guard against no boxes via resizing
-        bboxes = np.array(bboxes).reshape(-1, 4)
-        labels = np.array(labels).reshape(-1)
-        
-        return bboxes, labels
+        return img_file, self.ids[index]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,218 @@
+import math
+import torch
+import torch.nn.functional as F
+
+
+# ------------------------- Batch-level augmentations -------------------------
+## HSV on the device, as the augment_hsv of OpenCV images: H in [0, 180), S & V in [0, 255]
+def bgr_to_hsv(images):
+    b, g, r = images.unbind(dim=1)
+    v = torch.maximum(torch.maximum(r, g), b)
+    delta = v - torch.minimum(torch.minimum(r, g), b)
+    s = torch.where(v > 0, delta / v.clamp(min=1e-6) * 255., torch.zeros_like(v))
+    delta = delta.clamp(min=1e-6)
+    h = torch.where(v == r, 60. * (g - b) / delta,
+        torch.where(v == g, 120. + 60. * (b - r) / delta, 240. + 60. * (r - g) / delta))
+    h = torch.where(delta > 1e-6, h, torch.zeros_like(h)) % 360. / 2.
+
+    return h, s, v
+
+def hsv_to_bgr(h, s, v):
+    s = s / 255.
+    def channel(n):
+        k = (n + h / 30.) % 6.
+        return v - v * s * torch.clamp(torch.minimum(k, 4. - k), 0., 1.)
+
+    return torch.stack([channel(1.), channel(3.), channel(5.)], dim=1)
+
+
+class BatchAugmentation(object):
+    """
+        YOLO augmentations of a whole batch on the training device: HSV jitter, random perspective of the
+        non-mosaic samples & horizontal flip, while the workers only decode, resize & mosaic the images.
+        The perspective & flip of each image are composed in a single matrix, applied by grid_sample.
+
+        The images are [B, 3, H, W] floats in [0, 255] with the content of each image at its top-left, of the
+        `content_size` recorded by the YOLOAugmentation; the targets are the PackedTargets of the xyxy boxes in pixels.
+        The parameters are drawn by (seed, epoch, iteration), so that the augmentations of a resumed epoch are the same;
+        the seed is offset by the rank in the distributed training, so that each rank draws its own augmentations.
+    """
+    def __init__(self, affine_params, seed=0, min_box_size=8):
+        self.affine_params = affine_params
+        self.seed = seed
+        self.min_box_size = min_box_size
+        self.epoch = 0
+        self.iteration = 0
+
+    def set_epoch(self, epoch, start_iter=0):
+        self.epoch = epoch
+        self.iteration = start_iter
+
+    def draw_params(self, bs):
+        g = torch.Generator()
+        g.manual_seed(((self.seed * 1000003 + self.epoch) * 1000003 + self.iteration) % 2**63)
+        self.iteration += 1
+
+        def uniform(low, high, size=(bs,)):
+            return torch.rand(size, generator=g, dtype=torch.float64) * (high - low) + low
+
+        p = self.affine_params
+        return {'gains':       uniform(-1, 1, (bs, 3)) * torch.tensor([p['hsv_h'], p['hsv_s'], p['hsv_v']], dtype=torch.float64) + 1,
+                'perspective': uniform(-p['perspective'], p['perspective'], (bs, 2)),
+                'degrees':     uniform(-p['degrees'], p['degrees']),
+                'scale':       uniform(p['scale'][0], p['scale'][1]),
+                'shear':       uniform(-p['shear'], p['shear'], (bs, 2)),
+                'translate':   uniform(0.5 - p['translate'], 0.5 + p['translate'], (bs, 2)),
+                'flip':        torch.rand(bs, generator=g) < 0.5,
+                }
+
+    def get_matrices(self, params, content_sizes, mosaic):
+        """
+            The random perspective of the random_perspective, in the pixel coordinates of each image content.
+            Return: the matrices of the images [B, 3, 3] & of the boxes [B, 3, 3].
+        """
+        bs = len(content_sizes)
+        h, w = content_sizes[:, 0], content_sizes[:, 1]
+        eye = torch.eye(3, dtype=torch.float64).repeat(bs, 1, 1)
+        C, P, R, S, T, Fimg, Fbox = [eye.clone() for _ in range(7)]
+        C[:, 0, 2], C[:, 1, 2] = -w / 2, -h / 2
+        P[:, 2, 0], P[:, 2, 1] = params['perspective'][:, 0], params['perspective'][:, 1]
+        a = params['degrees'] * math.pi / 180
+        R[:, 0, 0], R[:, 0, 1] = params['scale'] * torch.cos(a), params['scale'] * torch.sin(a)
+        R[:, 1, 0], R[:, 1, 1] = -params['scale'] * torch.sin(a), params['scale'] * torch.cos(a)
+        S[:, 0, 1] = torch.tan(params['shear'][:, 0] * math.pi / 180)
+        S[:, 1, 0] = torch.tan(params['shear'][:, 1] * math.pi / 180)
+        T[:, 0, 2], T[:, 1, 2] = params['translate'][:, 0] * w, params['translate'][:, 1] * h
+        M = T @ S @ R @ P @ C
+        # the mosaic samples are already warped by the MosaicAugment
+        M[mosaic] = torch.eye(3, dtype=torch.float64)
+
+        # horizontal flip within the content, of the pixels (np.fliplr) & of the box coordinates
+        flip = params['flip']
+        Fimg[flip, 0, 0], Fimg[flip, 0, 2] = -1, w[flip] - 1
+        Fbox[flip, 0, 0], Fbox[flip, 0, 2] = -1, w[flip]
+
+        return Fimg @ M, Fbox @ M
+
+    def warp_images(self, images, matrices, content_sizes, perspective):
+        bs, _, img_h, img_w = images.shape
+        device = images.device
+        # source pixel of each output pixel, by the inverse matrices
+        inv = torch.linalg.inv(matrices).float().to(device)
+        ys, xs = torch.meshgrid(torch.arange(img_h, device=device, dtype=torch.float32),
+                                torch.arange(img_w, device=device, dtype=torch.float32), indexing='ij')
+        coords = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1).view(1, -1, 3)
+        src = coords @ inv.transpose(1, 2)
+        src = src[..., :2] / src[..., 2:3] if perspective else src[..., :2]
+        # pixel indexes -> [-1, 1], with align_corners=False
+        grid = torch.stack([(2 * src[..., 0] + 1) / img_w - 1, (2 * src[..., 1] + 1) / img_h - 1], dim=-1)
+        grid = grid.view(bs, img_h, img_w, 2)
+        # the border is filled by 114, as the cv2.warpAffine & the padding
+        images = F.grid_sample(images - 114., grid, mode='bilinear', padding_mode='zeros', align_corners=False) + 114.
+        sizes = content_sizes.to(device, torch.float32)
+        outside = (xs[None] >= sizes[:, 1, None, None]) | (ys[None] >= sizes[:, 0, None, None])
+        images = images.masked_fill(outside[:, None], 114.)
+
+        return images
+
+    def warp_boxes(self, targets, matrices, content_sizes, perspective):
+        boxes = targets.boxes.double()
+        batch_inds = targets.batch_inds
+        n = len(boxes)
+        if n > 0:
+            # warp the 4 corners of the boxes, as the warp_targets
+            xy = torch.ones(n, 4, 3, dtype=torch.float64)
+            xy[..., :2] = boxes[:, [0, 1, 2, 3, 0, 3, 2, 1]].view(n, 4, 2)
+            xy = xy @ matrices[batch_inds].transpose(1, 2)
+            xy = xy[..., :2] / xy[..., 2:3] if perspective else xy[..., :2]
+            boxes = torch.cat([xy.min(dim=1)[0], xy.max(dim=1)[0]], dim=-1)
+            # clip to the content of each image
+            sizes = content_sizes[batch_inds].double()
+            boxes[:, [0, 2]] = torch.minimum(boxes[:, [0, 2]].clamp(min=0), sizes[:, 1:2])
+            boxes[:, [1, 3]] = torch.minimum(boxes[:, [1, 3]].clamp(min=0), sizes[:, 0:1])
+        boxes = boxes.float()
+        keep = (boxes[:, 2:] - boxes[:, :2]).min(dim=-1)[0] >= self.min_box_size
+
+        # the packed targets stay sorted by the batch index
+        packed = torch.cat([targets.packed[:, :2], boxes], dim=1)[keep]
+        counts = torch.bincount(batch_inds[keep], minlength=len(targets))
+
+        return type(targets)(packed, counts, targets.meta)
+
+    @torch.no_grad()
+    def __call__(self, images, targets):
+        bs = images.shape[0]
+        params = self.draw_params(bs)
+        perspective = self.affine_params['perspective']
+        content_sizes = torch.as_tensor([meta["content_size"] for meta in targets.meta], dtype=torch.float64)
+        mosaic = torch.as_tensor([bool(meta["mosaic"]) for meta in targets.meta])
+
+        # --------------- HSV augmentations ---------------
+        gains = params['gains'].float().to(images.device)
+        h, s, v = bgr_to_hsv(images)
+        h = (h * gains[:, 0, None, None]).floor() % 180.
+        s = (s * gains[:, 1, None, None]).clamp(0., 255.)
+        v = (v * gains[:, 2, None, None]).clamp(0., 255.)
+        images = hsv_to_bgr(h, s, v)
+
+        # --------------- Spatial augmentations ---------------
+        img_matrices, box_matrices = self.get_matrices(params, content_sizes, mosaic)
+        images = self.warp_images(images, img_matrices, content_sizes, perspective)
+        targets = self.warp_boxes(targets, box_matrices, content_sizes, perspective)
+
+        return images, targets
+
+
+if __name__ == "__main__":
+    # Compare the HSV round trip with OpenCV & check that the boxes follow the warped pixels
+    import cv2
+    import numpy as np
+    import os
+    import sys
+    sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+    from utils.misc import PackedTargets
+
+    affine_params = {'degrees': 10.0, 'translate': 0.2, 'scale': [0.5, 1.5], 'shear': 2.0, 'perspective': 0.0,
+                     'hsv_h': 0.0, 'hsv_s': 0.0, 'hsv_v': 0.0}
+    batch_augment = BatchAugmentation(affine_params, seed=0, min_box_size=0)
+
+    # HSV of OpenCV, which rounds the H & S to uint8, with H wrapping around at 180
+    image = np.random.randint(0, 255, [64, 64, 3], dtype=np.uint8)
+    h, s, v = bgr_to_hsv(torch.from_numpy(image).permute(2, 0, 1)[None].float())
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV).astype(np.float32)
+    diff = np.abs(torch.stack([h, s, v], dim=-1)[0].numpy() - hsv)
+    diff[..., 0] = np.minimum(diff[..., 0], 180. - diff[..., 0])
+    print('HSV difference to OpenCV: {:.2f}'.format(diff.max()))
+    assert diff.max() <= 1.0
+    bgr = hsv_to_bgr(h, s, v)[0].permute(1, 2, 0).numpy()
+    print('BGR round trip difference: {:.3f}'.format(np.abs(bgr - image).max()))
+    assert np.abs(bgr - image).max() < 0.01
+
+    # a white box on a black image, its warped box should bound the warped white pixels within ~1 px,
+    # for a mosaic sample (identity), a flipped mosaic sample, an affine sample & a flipped affine sample
+    draw_params = batch_augment.draw_params
+    def draw_params_with_flips(bs):
+        params = draw_params(bs)
+        params['flip'] = torch.arange(bs) % 2 == 1
+        return params
+    batch_augment.draw_params = draw_params_with_flips
+
+    images = torch.full([4, 3, 320, 320], 114.)
+    targets = []
+    for i in range(4):
+        images[i, :, :240] = 0.
+        images[i, :, 60:140, 100:200] = 255.
+        targets.append({"boxes": torch.tensor([[100., 60., 200., 140.]]), "labels": torch.tensor([1]),
+                        "mosaic": i < 2, "content_size": [240, 320]})
+    images, targets = batch_augment(images, PackedTargets.from_list(targets))
+    for i in range(4):
+        # the pixels more than half white, as the bilinear interpolation blurs the edges
+        ys, xs = torch.nonzero(images[i, 0] > 127.5, as_tuple=True)
+        box = targets[i]["boxes"][0]
+        pixels = torch.tensor([xs.min(), ys.min(), xs.max() + 1, ys.max() + 1], dtype=torch.float32)
+        print('Box: {}, white pixels: {}'.format(box.round().tolist(), pixels.tolist()))
+        # the corners of the rotated box are rasterized partially
+        assert (box - pixels).abs().max() <= 1.5, i
+    # the identity & its flip are exact
+    assert targets[0]["boxes"][0].tolist() == [100., 60., 200., 140.]
+    assert targets[1]["boxes"][0].tolist() == [120., 60., 220., 140.]
@@ -515,6 +515,12 @@ class SSDAugmentation(object):
             ConvertBoxFormat(self.box_format),
         ])
 
+    def set_img_size(self, img_size):
+        self.img_size = img_size
+        for t in self.augment.transforms:
+            if isinstance(t, Resize):
+                t.img_size = img_size
+
     def __call__(self, image, target, mosaic=False):
         orig_h, orig_w = image.shape[:2]
         ratio = [self.img_size / orig_w, self.img_size / orig_h]
@@ -2,7 +2,7 @@ import random
 import cv2
 import numpy as np
 
-from .yolo_augment import random_perspective
+from .yolo_augment import random_perspective, get_perspective_matrix, warp_targets
 
 
 # ------------------------- Strong augmentations -------------------------
@@ -12,23 +12,27 @@ class MosaicAugment(object):
                  img_size,
                  affine_params,
                  is_train=False,
+                 fused=True,
                  ) -> None:
         self.img_size = img_size
         self.is_train = is_train
         self.affine_params = affine_params
+        # warp each image once into the output, instead of the mosaic canvas then the random perspective
+        self.fused = fused
 
     def __call__(self, image_list, target_list):
         assert len(image_list) == 4
         # mosaic center
         yc, xc = [int(random.uniform(-x, 2*self.img_size + x)) for x in [-self.img_size // 2, -self.img_size // 2]]
 
+        if self.fused:
+            return self.fused_mosaic(image_list, target_list, xc, yc)
+
         mosaic_bboxes = []
         mosaic_labels = []
         mosaic_img = np.ones([self.img_size*2, self.img_size*2, image_list[0].shape[2]], dtype=np.uint8) * 114
         for i in range(4):
             img_i, target_i = image_list[i], target_list[i]
-            bboxes_i = target_i["boxes"]
-            labels_i = target_i["labels"]
             orig_h, orig_w, _ = img_i.shape
 
             # ------------------ Keep ratio Resize ------------------
@@ -40,47 +44,14 @@ class MosaicAugment(object):
 
             # ------------------ Create mosaic image ------------------
             ## Place image in mosaic image
-            if i == 0:  # top left
-                x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
-                x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
-            elif i == 1:  # top right
-                x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, self.img_size * 2), yc
-                x1b, y1b, x2b, y2b = 0, h - (y2a - y1a), min(w, x2a - x1a), h
-            elif i == 2:  # bottom left
-                x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(self.img_size * 2, yc + h)
-                x1b, y1b, x2b, y2b = w - (x2a - x1a), 0, w, min(y2a - y1a, h)
-            elif i == 3:  # bottom right
-                x1a, y1a, x2a, y2a = xc, yc, min(xc + w, self.img_size * 2), min(self.img_size * 2, yc + h)
-                x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
-
+            (x1a, y1a, x2a, y2a), (x1b, y1b, x2b, y2b) = self.tile_placement(i, xc, yc, h, w)
             mosaic_img[y1a:y2a, x1a:x2a] = img_i[y1b:y2b, x1b:x2b]
-            padw = x1a - x1b
-            padh = y1a - y1b
 
             ## Mosaic target
-            bboxes_i_ = bboxes_i.copy()
-            if len(bboxes_i) > 0:
-                # a valid target, and modify it.
-                bboxes_i_[:, 0] = (w * bboxes_i[:, 0] / orig_w + padw)
-                bboxes_i_[:, 1] = (h * bboxes_i[:, 1] / orig_h + padh)
-                bboxes_i_[:, 2] = (w * bboxes_i[:, 2] / orig_w + padw)
-                bboxes_i_[:, 3] = (h * bboxes_i[:, 3] / orig_h + padh)    
-
-                mosaic_bboxes.append(bboxes_i_)
-                mosaic_labels.append(labels_i)
-
-        if len(mosaic_bboxes) == 0:
-            mosaic_bboxes = np.array([]).reshape(-1, 4)
-            mosaic_labels = np.array([]).reshape(-1)
-        else:
-            mosaic_bboxes = np.concatenate(mosaic_bboxes)
-            mosaic_labels = np.concatenate(mosaic_labels)
-
-        # clip
-        mosaic_bboxes = mosaic_bboxes.clip(0, self.img_size * 2)
+            self.place_target(target_i, orig_h, orig_w, h, w, x1a - x1b, y1a - y1b, mosaic_bboxes, mosaic_labels)
 
         # ----------------------- Random perspective -----------------------
-        mosaic_targets = np.concatenate([mosaic_labels[..., None], mosaic_bboxes], axis=-1)
+        mosaic_targets = self.concat_targets(mosaic_bboxes, mosaic_labels)
         mosaic_img, mosaic_targets = random_perspective(
             mosaic_img,
             mosaic_targets,
@@ -100,6 +71,133 @@ class MosaicAugment(object):
 
         return mosaic_img, mosaic_target
 
+    def fused_mosaic(self, image_list, target_list, xc, yc):
+        """
+            The placement of each image in the 2*img_size mosaic canvas is composed with the random perspective,
+            so that each image is warped once, directly into the img_size output, within the region of its tile,
+            instead of resizing & pasting the 4 images and warping the whole canvas.
+        """
+        perspective = self.affine_params['perspective']
+        mosaic_bboxes = []
+        mosaic_labels = []
+        tiles = []
+        for i in range(4):
+            img_i, target_i = image_list[i], target_list[i]
+            orig_h, orig_w, _ = img_i.shape
+            # size of the resized image in the mosaic canvas
+            r = self.img_size / max(orig_h, orig_w)
+            h, w = int(orig_h * r), int(orig_w * r)
+
+            (x1a, y1a, x2a, y2a), (x1b, y1b, x2b, y2b) = self.tile_placement(i, xc, yc, h, w)
+            tiles.append([img_i, w / orig_w, h / orig_h, x1a - x1b, y1a - y1b, (x1a, y1a, x2a, y2a)])
+            self.place_target(target_i, orig_h, orig_w, h, w, x1a - x1b, y1a - y1b, mosaic_bboxes, mosaic_labels)
+
+        # ----------------------- Random perspective -----------------------
+        ## drawn as the random_perspective of the mosaic canvas
+        M, height, width = get_perspective_matrix(self.img_size * 2, self.img_size * 2,
+                                                  self.affine_params['degrees'],
+                                                  translate   = self.affine_params['translate'],
+                                                  scale       = self.affine_params['scale'],
+                                                  shear       = self.affine_params['shear'],
+                                                  perspective = perspective,
+                                                  border      = [-self.img_size//2, -self.img_size//2]
+                                                  )
+        mosaic_img = np.full([height, width, image_list[0].shape[2]], 114, dtype=np.uint8)
+        for img_i, sx, sy, padw, padh, (x1a, y1a, x2a, y2a) in tiles:
+            if x2a <= x1a or y2a <= y1a:
+                continue
+            ## bounding box of the tile in the output
+            corners = np.array([[x1a, y1a, 1], [x2a, y1a, 1], [x1a, y2a, 1], [x2a, y2a, 1]], dtype=np.float64) @ M.T
+            corners = corners[:, :2] / corners[:, 2:3]
+            bx1, by1 = np.floor(corners.min(axis=0)).clip(0, [width, height]).astype(np.int64)
+            bx2, by2 = np.ceil(corners.max(axis=0)).clip(0, [width, height]).astype(np.int64)
+            if bx2 <= bx1 or by2 <= by1:
+                continue
+
+            ## crop of the image in its tile, with a margin of a pixel for the interpolation at the seams
+            orig_h, orig_w = img_i.shape[:2]
+            u1 = max(int(np.floor((x1a - padw) / sx)) - 1, 0)
+            v1 = max(int(np.floor((y1a - padh) / sy)) - 1, 0)
+            u2 = min(int(np.ceil((x2a - padw) / sx)) + 1, orig_w)
+            v2 = min(int(np.ceil((y2a - padh) / sy)) + 1, orig_h)
+            crop = img_i[v1:v2, u1:u2]
+            if crop.size == 0:
+                continue
+
+            ## crop -> mosaic canvas (as cv2.resize, aligned by the pixel centers) -> output -> bounding box
+            A = np.array([[sx, 0, padw + (u1 + 0.5) * sx - 0.5],
+                          [0, sy, padh + (v1 + 0.5) * sy - 0.5],
+                          [0, 0, 1]])
+            B = np.array([[1, 0, -bx1], [0, 1, -by1], [0, 0, 1]], dtype=np.float64)
+            H = B @ M @ A
+            ## the output pixels whose nearest canvas pixel is in the tile, so that the margin of the crop
+            ## does not overwrite the neighbouring tiles at the seams, as the paste of the canvas
+            T = np.array([[1, 0, x1a], [0, 1, y1a], [0, 0, 1]], dtype=np.float64)
+            tile_mask = np.ones([y2a - y1a, x2a - x1a], dtype=np.uint8)
+            dsize = (int(bx2 - bx1), int(by2 - by1))
+            if perspective:
+                warped = cv2.warpPerspective(crop, H, dsize, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+                mask = cv2.warpPerspective(tile_mask, B @ M @ T, dsize, flags=cv2.INTER_NEAREST, borderValue=0)
+            else:
+                warped = cv2.warpAffine(crop, H[:2], dsize, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+                mask = cv2.warpAffine(tile_mask, (B @ M @ T)[:2], dsize, flags=cv2.INTER_NEAREST, borderValue=0)
+            mask = mask.astype(bool)
+            mosaic_img[by1:by2, bx1:bx2][mask] = warped[mask]
+
+        mosaic_targets = warp_targets(self.concat_targets(mosaic_bboxes, mosaic_labels), M, height, width, perspective)
+
+        # target
+        mosaic_target = {
+            "boxes": mosaic_targets[..., 1:],
+            "labels": mosaic_targets[..., 0],
+        }
+
+        return mosaic_img, mosaic_target
+
+    def tile_placement(self, i, xc, yc, h, w):
+        # region of the i-th tile in the mosaic canvas (a) & in the resized image (b), as xmin, ymin, xmax, ymax
+        if i == 0:  # top left
+            x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
+            x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
+        elif i == 1:  # top right
+            x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, self.img_size * 2), yc
+            x1b, y1b, x2b, y2b = 0, h - (y2a - y1a), min(w, x2a - x1a), h
+        elif i == 2:  # bottom left
+            x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(self.img_size * 2, yc + h)
+            x1b, y1b, x2b, y2b = w - (x2a - x1a), 0, w, min(y2a - y1a, h)
+        elif i == 3:  # bottom right
+            x1a, y1a, x2a, y2a = xc, yc, min(xc + w, self.img_size * 2), min(self.img_size * 2, yc + h)
+            x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
+
+        return (x1a, y1a, x2a, y2a), (x1b, y1b, x2b, y2b)
+
+    def place_target(self, target_i, orig_h, orig_w, h, w, padw, padh, mosaic_bboxes, mosaic_labels):
+        bboxes_i = target_i["boxes"]
+        labels_i = target_i["labels"]
+        bboxes_i_ = bboxes_i.copy()
+        if len(bboxes_i) > 0:
+            # a valid target, and modify it.
+            bboxes_i_[:, 0] = (w * bboxes_i[:, 0] / orig_w + padw)
+            bboxes_i_[:, 1] = (h * bboxes_i[:, 1] / orig_h + padh)
+            bboxes_i_[:, 2] = (w * bboxes_i[:, 2] / orig_w + padw)
+            bboxes_i_[:, 3] = (h * bboxes_i[:, 3] / orig_h + padh)    
+
+            mosaic_bboxes.append(bboxes_i_)
+            mosaic_labels.append(labels_i)
+
+    def concat_targets(self, mosaic_bboxes, mosaic_labels):
+        if len(mosaic_bboxes) == 0:
+            mosaic_bboxes = np.array([]).reshape(-1, 4)
+            mosaic_labels = np.array([]).reshape(-1)
+        else:
+            mosaic_bboxes = np.concatenate(mosaic_bboxes)
+            mosaic_labels = np.concatenate(mosaic_labels)
+
+        # clip
+        mosaic_bboxes = mosaic_bboxes.clip(0, self.img_size * 2)
+
+        return np.concatenate([mosaic_labels[..., None], mosaic_bboxes], axis=-1)
+
 ## Mixup Augmentation
 class MixupAugment(object):
     def __init__(self, img_size) -> None:
@@ -223,3 +321,59 @@ class MixupAugment(object):
             return self.yolox_mixup_augment(origin_image, origin_target, new_image, new_target)
         else:
             return self.yolo_mixup_augment(origin_image, origin_target, new_image, new_target)
+
+
+if __name__ == "__main__":
+    # Compare the fused mosaic to the mosaic canvas + random perspective, with the same random draws:
+    # python -m dataset.data_augment.strong_augment
+    import time
+
+    affine_params = {'degrees': 0.0, 'translate': 0.2, 'scale': [0.1, 2.0], 'shear': 0.0, 'perspective': 0.0}
+    mosaic_augment = MosaicAugment(640, affine_params, is_train=True)
+
+    rng = np.random.default_rng(0)
+    samples = []
+    for _ in range(50):
+        image_list, target_list = [], []
+        for _ in range(4):
+            h, w = rng.integers(240, 640, size=2)
+            image = cv2.GaussianBlur(rng.integers(0, 255, [h, w, 3], dtype=np.uint8), (15, 15), 0)
+            x1, y1 = rng.uniform(0, w / 2), rng.uniform(0, h / 2)
+            target_list.append({"boxes": np.array([[x1, y1, x1 + w / 3, y1 + h / 3]]), "labels": np.array([1])})
+            image_list.append(image)
+        samples.append((image_list, target_list))
+
+    for fused in [False, True]:
+        mosaic_augment.fused = fused
+        outputs = []
+        t0 = time.time()
+        for i, (image_list, target_list) in enumerate(samples):
+            random.seed(i)
+            outputs.append(mosaic_augment(image_list, [{k: v.copy() for k, v in t.items()} for t in target_list]))
+        print('{}: {:.2f} ms / sample'.format('Fused mosaic' if fused else 'Mosaic + perspective', (time.time() - t0) / len(samples) * 1e3))
+        if fused:
+            pixel_diffs = [np.abs(a[0].astype(np.float32) - b[0].astype(np.float32)).mean() for a, b in zip(legacy_outputs, outputs)]
+            box_diffs = [np.abs(a[1]["boxes"] - b[1]["boxes"]).max() for a, b in zip(legacy_outputs, outputs)]
+            print('Mean abs pixel difference: {:.2f}, max box difference: {:.4f}'.format(np.mean(pixel_diffs), np.max(box_diffs)))
+        legacy_outputs = outputs
+
+    # Seams: with flat tiles, an output pixel of a single tile in the legacy mosaic, i.e. not blended at a seam,
+    # should be of the same tile in the fused mosaic, so that the tiles never overwrite their neighbours
+    colors = np.array([[40, 80, 120], [200, 60, 30], [30, 200, 90], [160, 160, 230], [114, 114, 114]], dtype=np.float32)
+    seam_ratios = []
+    for i in range(50):
+        # small images, which are upscaled the most
+        sizes = rng.integers(160, 640, size=(4, 2))
+        image_list = [np.full([h, w, 3], colors[k], dtype=np.uint8) for k, (h, w) in enumerate(sizes)]
+        target_list = [{"boxes": np.zeros([0, 4]), "labels": np.zeros([0])} for _ in range(4)]
+        outputs = []
+        for fused in [False, True]:
+            mosaic_augment.fused = fused
+            random.seed(i)
+            outputs.append(mosaic_augment(image_list, target_list)[0].astype(np.float32))
+        legacy_img, fused_img = outputs
+        flat = (np.abs(legacy_img[:, :, None] - colors[None, None]).max(axis=-1) <= 1).any(axis=-1)
+        mismatch = flat & (np.abs(legacy_img - fused_img).max(axis=-1) > 1)
+        seam_ratios.append(mismatch.sum() / max(flat.sum(), 1))
+    print('Seam pixels of another tile: {:.4%} at most'.format(np.max(seam_ratios)))
+    assert np.max(seam_ratios) <= 1e-3
@@ -9,24 +9,24 @@ import torchvision.transforms.functional as F
 
 # ------------------------- Basic augmentations -------------------------
 ## Spatial transform
-def random_perspective(image,
-                       targets=(),
-                       degrees=10,
-                       translate=.1,
-                       scale=[0.1, 2.0],
-                       shear=10,
-                       perspective=0.0,
-                       border=(0, 0)):
-    # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(0.1, 0.1), scale=(0.9, 1.1), shear=(-10, 10))
-    # targets = [cls, xyxy]
-
-    height = image.shape[0] + border[0] * 2  # shape(h,w,c)
-    width = image.shape[1] + border[1] * 2
+def get_perspective_matrix(img_h,
+                           img_w,
+                           degrees=10,
+                           translate=.1,
+                           scale=[0.1, 2.0],
+                           shear=10,
+                           perspective=0.0,
+                           border=(0, 0)):
+    """
+        Draw the random perspective of an [img_h, img_w] image into its [height, width] output.
+    """
+    height = img_h + border[0] * 2
+    width = img_w + border[1] * 2
 
     # Center
     C = np.eye(3)
-    C[0, 2] = -image.shape[1] / 2  # x translation (pixels)
-    C[1, 2] = -image.shape[0] / 2  # y translation (pixels)
+    C[0, 2] = -img_w / 2  # x translation (pixels)
+    C[1, 2] = -img_h / 2  # y translation (pixels)
 
     # Perspective
     P = np.eye(3)
@@ -53,13 +53,11 @@ def random_perspective(image,
 
     # Combined rotation matrix
     M = T @ S @ R @ P @ C  # order of operations (right to left) is IMPORTANT
-    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
-        if perspective:
-            image = cv2.warpPerspective(image, M, dsize=(width, height), borderValue=(114, 114, 114))
-        else:  # affine
-            image = cv2.warpAffine(image, M[:2], dsize=(width, height), borderValue=(114, 114, 114))
 
-    # Transform label coordinates
+    return M, height, width
+
+def warp_targets(targets, M, height, width, perspective=0.0):
+    # targets = [cls, xyxy]
     n = len(targets)
     if n:
         new = np.zeros((n, 4))
@@ -80,6 +78,28 @@ def random_perspective(image,
 
         targets[:, 1:5] = new
 
+    return targets
+
+def random_perspective(image,
+                       targets=(),
+                       degrees=10,
+                       translate=.1,
+                       scale=[0.1, 2.0],
+                       shear=10,
+                       perspective=0.0,
+                       border=(0, 0)):
+    # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(0.1, 0.1), scale=(0.9, 1.1), shear=(-10, 10))
+    # targets = [cls, xyxy]
+    M, height, width = get_perspective_matrix(image.shape[0], image.shape[1], degrees, translate, scale, shear, perspective, border)
+    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
+        if perspective:
+            image = cv2.warpPerspective(image, M, dsize=(width, height), borderValue=(114, 114, 114))
+        else:  # affine
+            image = cv2.warpAffine(image, M[:2], dsize=(width, height), borderValue=(114, 114, 114))
+
+    # Transform label coordinates
+    targets = warp_targets(targets, M, height, width, perspective)
+
     return image, targets
 
 ## Color transform
@@ -108,7 +128,9 @@ class YOLOAugmentation(object):
                  pixel_mean = [0., 0., 0.],
                  pixel_std  = [255., 255., 255.],
                  box_format='xyxy',
-                 normalize_coords=False):
+                 normalize_coords=False,
+                 uint8_output=False,
+                 batch_augment=False):
         # Basic parameters
         self.img_size   = img_size
         self.pixel_mean = pixel_mean
@@ -117,6 +139,13 @@ class YOLOAugmentation(object):
         self.affine_params = affine_params
         self.normalize_coords = normalize_coords
         self.color_format = 'bgr'
+        # output the padded uint8 image, which is normalized on the device, see DevicePrefetcher
+        self.uint8_output = uint8_output
+        # leave the HSV, random perspective & flip to the BatchAugmentation on the device
+        self.batch_augment = batch_augment
+
+    def set_img_size(self, img_size):
+        self.img_size = img_size
 
     def __call__(self, image, target, mosaic=False):
         # --------------- Resize image ---------------
@@ -132,14 +161,15 @@ class YOLOAugmentation(object):
         target["boxes"][..., [1, 3]] = target["boxes"][..., [1, 3]] / orig_h * img_h
 
         # --------------- HSV augmentations ---------------
-        image = augment_hsv(image,
-                            hgain=self.affine_params['hsv_h'], 
-                            sgain=self.affine_params['hsv_s'], 
-                            vgain=self.affine_params['hsv_v'])
+        if not self.batch_augment:
+            image = augment_hsv(image,
+                                hgain=self.affine_params['hsv_h'], 
+                                sgain=self.affine_params['hsv_s'], 
+                                vgain=self.affine_params['hsv_v'])
         
         # --------------- Spatial augmentations ---------------
         ## Random perspective
-        if not mosaic:
+        if not mosaic and not self.batch_augment:
             # spatial augment
             target_ = np.concatenate((target['labels'][..., None], target['boxes']), axis=-1)
             image, target_ = random_perspective(image, target_,
@@ -153,7 +183,7 @@ class YOLOAugmentation(object):
             target['labels'] = target_[..., 0]
 
         ## Random flip
-        if random.random() < 0.5:
+        if not self.batch_augment and random.random() < 0.5:
             w = image.shape[1]
             image = np.fliplr(image).copy()
             boxes = target['boxes'].copy()
@@ -161,7 +191,7 @@ class YOLOAugmentation(object):
             target["boxes"] = boxes
 
         # --------------- To torch.Tensor ---------------
-        image = F.to_tensor(image) * 255.
+        image = self.to_tensor(image)
         if target is not None:
             target["boxes"] = torch.as_tensor(target["boxes"]).float()
             target["labels"] = torch.as_tensor(target["labels"]).long()
@@ -179,14 +209,24 @@ class YOLOAugmentation(object):
 
         # --------------- Pad Image ---------------
         img_h0, img_w0 = image.shape[1:]
-        pad_image = torch.ones([image.size(0), self.img_size, self.img_size]).float() * 114.
+        if self.batch_augment:
+            target["mosaic"] = mosaic
+            target["content_size"] = [img_h0, img_w0]
+        pad_image = torch.full([image.size(0), self.img_size, self.img_size], 114, dtype=image.dtype)
         pad_image[:, :img_h0, :img_w0] = image
 
         # --------------- Normalize ---------------
-        pad_image = F.normalize(pad_image, self.pixel_mean, self.pixel_std)
+        if not self.uint8_output:
+            pad_image = F.normalize(pad_image, self.pixel_mean, self.pixel_std)
 
         return pad_image, target, ratio
 
+    def to_tensor(self, image):
+        if self.uint8_output:
+            # [H, W, C] -> [C, H, W], a view which is made contiguous by the padding
+            return torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1)
+        return F.to_tensor(image) * 255.
+
 ## YOLO-style Transform for Eval
 class YOLOBaseTransform(object):
     def __init__(self,
@@ -195,7 +235,8 @@ class YOLOBaseTransform(object):
                  pixel_mean = [0., 0., 0.],
                  pixel_std  = [255., 255., 255.],
                  box_format='xyxy',
-                 normalize_coords=False):
+                 normalize_coords=False,
+                 uint8_output=False):
         self.img_size = img_size
         self.max_stride = max_stride
         self.pixel_mean = pixel_mean
@@ -203,6 +244,8 @@ class YOLOBaseTransform(object):
         self.box_format = box_format
         self.normalize_coords = normalize_coords
         self.color_format = 'bgr'
+        # output the padded uint8 image, which is normalized on the device, see DevicePrefetcher
+        self.uint8_output = uint8_output
 
     def __call__(self, image, target=None, mosaic=False):
         # --------------- Resize image ---------------
@@ -220,7 +263,7 @@ class YOLOBaseTransform(object):
             target["boxes"][..., [1, 3]] = target["boxes"][..., [1, 3]] / orig_h * img_h
 
         # --------------- To torch.Tensor ---------------
-        image = F.to_tensor(image) * 255.
+        image = self.to_tensor(image)
         if target is not None:
             target["boxes"] = torch.as_tensor(target["boxes"]).float()
             target["labels"] = torch.as_tensor(target["labels"]).long()
@@ -245,14 +288,20 @@ class YOLOBaseTransform(object):
         
         pad_img_h = img_h0 + dh
         pad_img_w = img_w0 + dw
-        pad_image = torch.ones([image.size(0), pad_img_h, pad_img_w]).float() * 114.
+        pad_image = torch.full([image.size(0), pad_img_h, pad_img_w], 114, dtype=image.dtype)
         pad_image[:, :img_h0, :img_w0] = image
 
         # --------------- Normalize ---------------
-        pad_image = F.normalize(pad_image, self.pixel_mean, self.pixel_std)
+        if not self.uint8_output:
+            pad_image = F.normalize(pad_image, self.pixel_mean, self.pixel_std)
 
         return pad_image, target, ratio
 
+    def to_tensor(self, image):
+        if self.uint8_output:
+            return torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1)
+        return F.to_tensor(image) * 255.
+
 
 if __name__ == "__main__":
     image_path = "voc_image.jpg"
@@ -0,0 +1,175 @@
+import os
+import cv2
+import numpy as np
+import torch
+
+
+class ImageCache(object):
+    """
+        Cache of the decoded images, resized so that their long side is at most img_size.
+
+        All the images are given a fixed slot in a flat uint8 arena, from their shapes in the annotations,
+        until the byte budget is used up. The arena is either a tensor in the shared memory ('ram'), or a
+        memmap file on a local disk ('disk'), which is also reused by the next runs. Either is shared with
+        the forked & the spawned DataLoader workers: the shared tensors are pickled as handles, and the
+        memmap files are reopened by their paths. A worker missing an image decodes it and fills its slot,
+        so that the image is decoded once for all the workers.
+    """
+    def __init__(self, image_shapes, img_size=640, budget=8, mode='ram', cache_path=None, max_workers=64):
+        """
+            image_shapes: (List) [[height, width], ...] of the original images.
+            budget: (float) byte budget of the cached images, in GB.
+        """
+        assert mode in ['ram', 'disk']
+        self.img_size = img_size
+        self.mode = mode
+        self.max_workers = max_workers
+
+        # ------------ Slots of the images ------------
+        self.orig_shapes = np.array(image_shapes, dtype=np.int64).reshape(-1, 2)
+        ratios = np.minimum(img_size / self.orig_shapes.max(axis=1), 1.0)
+        self.shapes = np.maximum(np.round(self.orig_shapes * ratios[:, None]), 1).astype(np.int64)
+        nbytes = self.shapes.prod(axis=1) * 3
+        self.num_cached = int(np.searchsorted(np.cumsum(nbytes), budget * 1024**3, side='right'))
+        self.offsets = np.concatenate([[0], np.cumsum(nbytes[:self.num_cached])]).astype(np.int64)
+        total_bytes = max(int(self.offsets[-1]), 1)
+
+        # ------------ Shared arena ------------
+        ## [N] filled flags & [max_workers + 1, 2] hit / miss counters of each worker
+        self.cache_path = cache_path
+        self.num_bytes = total_bytes
+        self.num_state_bytes = self.num_cached + (max_workers + 1) * 2 * 8
+        if mode == 'ram':
+            self.arena_tensor = torch.zeros(self.num_bytes, dtype=torch.uint8).share_memory_()
+            self.state_tensor = torch.zeros(self.num_state_bytes, dtype=torch.uint8).share_memory_()
+            self.attach()
+        else:
+            os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+            arena = self.open_memmap(cache_path + '.data', self.num_bytes)
+            self.open_memmap(cache_path + '.state', self.num_state_bytes, fresh=arena.fresh)
+            self.attach()
+        self.counters[:] = 0
+
+        print('Image cache ({}): {} / {} images, {:.1f} GB'.format(
+            mode, self.num_cached, len(self.shapes), total_bytes / 1024**3))
+
+    def attach(self):
+        # numpy views of the shared arena
+        if self.mode == 'ram':
+            self.arena = self.arena_tensor.numpy()
+            state = self.state_tensor.numpy()
+        else:
+            self.arena = np.memmap(self.cache_path + '.data', dtype=np.uint8, mode='r+', shape=(self.num_bytes,))
+            state = np.memmap(self.cache_path + '.state', dtype=np.uint8, mode='r+', shape=(self.num_state_bytes,))
+        self.filled = state[:self.num_cached]
+        self.counters = state[self.num_cached:].view(np.int64).reshape(self.max_workers + 1, 2)
+
+    def __getstate__(self):
+        # the views are not pickled by value into the spawned workers, but attached again
+        state = self.__dict__.copy()
+        for name in ['arena', 'filled', 'counters']:
+            state.pop(name)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.attach()
+
+    @staticmethod
+    def open_memmap(path, nbytes, fresh=None):
+        # a file of another size was made for another dataset or img_size
+        reuse = os.path.exists(path) and os.path.getsize(path) == nbytes and fresh is not True
+        memmap = np.memmap(path, dtype=np.uint8, mode='r+' if reuse else 'w+', shape=(nbytes,))
+        memmap.fresh = not reuse
+        return memmap
+
+    def worker_slot(self):
+        worker_info = torch.utils.data.get_worker_info()
+        return 0 if worker_info is None else worker_info.id % self.max_workers + 1
+
+    def load(self, index, pull_image):
+        """
+            Return the cached image & its resize ratio, the image is pulled by `pull_image(index)` on a miss.
+        """
+        if index >= self.num_cached:
+            image = pull_image(index)
+            return image, 1.0
+
+        height, width = self.shapes[index]
+        slot = self.arena[self.offsets[index]: self.offsets[index + 1]].reshape(height, width, 3)
+        ratio = height / self.orig_shapes[index][0]
+        counters = self.counters[self.worker_slot()]
+        if self.filled[index]:
+            counters[0] += 1
+            # a copy, as the augmentations may work in place
+            return slot.copy(), ratio
+
+        counters[1] += 1
+        image = pull_image(index)
+        if image.shape[:2] != (height, width):
+            image = cv2.resize(image, (int(width), int(height)), interpolation=cv2.INTER_AREA)
+        slot[...] = image
+        # marked at last, so that no worker reads a partially written image
+        self.filled[index] = 1
+
+        return image, ratio
+
+    def stats(self):
+        hits, misses = self.counters.sum(axis=0).tolist()
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / max(hits + misses, 1),
+                'filled': int(self.filled.sum()), 'num_cached': self.num_cached}
+
+    def __repr__(self):
+        stats = self.stats()
+        return 'Image cache: hit rate {:.1%} ({} hits, {} misses), {} / {} images cached'.format(
+            stats['hit_rate'], stats['hits'], stats['misses'], stats['filled'], stats['num_cached'])
+
+
+if __name__ == "__main__":
+    # Read throughput of a 4-worker loader, decoding the JPEGs vs. reading the cache
+    import time
+    import tempfile
+
+    class JPEGDataset(torch.utils.data.Dataset):
+        def __init__(self, image_files, cache=None):
+            self.image_files = image_files
+            self.cache = cache
+
+        def __len__(self):
+            return len(self.image_files)
+
+        def pull_image(self, index):
+            return cv2.imread(self.image_files[index])
+
+        def __getitem__(self, index):
+            if self.cache is None:
+                image = self.pull_image(index)
+            else:
+                image, _ = self.cache.load(index, self.pull_image)
+            return image.shape[0]
+
+    def images_per_sec(dataset, num_epochs, context=None):
+        loader = torch.utils.data.DataLoader(dataset, batch_size=8, num_workers=4, multiprocessing_context=context)
+        t0 = time.time()
+        for _ in range(num_epochs):
+            for _ in loader:
+                pass
+        return num_epochs * len(dataset) / (time.time() - t0)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_files = []
+        for i in range(256):
+            image = np.random.randint(0, 255, [480, 640, 3], dtype=np.uint8)
+            image_files.append(os.path.join(tmp_dir, '{}.jpg'.format(i)))
+            cv2.imwrite(image_files[-1], cv2.GaussianBlur(image, (7, 7), 0))
+
+        print('JPEG decoding: {:.0f} images/s'.format(images_per_sec(JPEGDataset(image_files), 3)))
+        for mode in ['ram', 'disk']:
+            for context in ['fork', 'spawn']:
+                cache = ImageCache([[480, 640]] * len(image_files), img_size=640, budget=1, mode=mode,
+                                   cache_path=os.path.join(tmp_dir, 'cache', 'images_640_' + context))
+                dataset = JPEGDataset(image_files, cache)
+                # the first epoch fills the cache, which the main process sees in the counters of the workers
+                images_per_sec(dataset, 1, context)
+                assert cache.stats()['filled'] == len(image_files)
+                print('Cache ({}, {}): {:.0f} images/s, {}'.format(mode, context, images_per_sec(dataset, 3, context), cache))
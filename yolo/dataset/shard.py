@@ -0,0 +1,167 @@
+import os
+import cv2
+import json
+import numpy as np
+
+try:
+    from .data_augment.strong_augment import MosaicAugment, MixupAugment
+    from .voc import VOCDataset
+    from .anno_index import AnnotationIndex, file_digest
+except:
+    from  data_augment.strong_augment import MosaicAugment, MixupAugment
+    from  voc import VOCDataset
+    from  anno_index import AnnotationIndex, file_digest
+
+
+# ------------------------------ Packed shards ------------------------------
+## Layout of a packed split:
+##   shard_00000.bin, ...: the encoded image files, concatenated as they are.
+##   index.npz: per image, the shard, byte offset & length, image id & shape, and the annotations
+##              in a CSR layout, i.e. the boxes & labels of the i-th image are [anno_offsets[i]: anno_offsets[i+1]].
+class ShardWriter(object):
+    def __init__(self, output_dir, shard_size=1024):
+        """
+            shard_size: (int) size of a shard, in MB.
+        """
+        self.output_dir = output_dir
+        self.shard_size = shard_size * 1024**2
+        os.makedirs(output_dir, exist_ok=True)
+        self.shard_file = None
+        self.shard_id = -1
+        self.shard_bytes = 0
+        # index
+        self.shards, self.offsets, self.lengths = [], [], []
+        self.image_ids, self.shapes = [], []
+        self.anno_offsets, self.boxes, self.labels = [0], [], []
+
+    def shard_path(self, shard_id):
+        return os.path.join(self.output_dir, 'shard_{:05d}.bin'.format(shard_id))
+
+    def add(self, data, image_id, shape, bboxes, labels):
+        # start a new shard when the current one is full
+        if self.shard_file is None or self.shard_bytes > 0 and self.shard_bytes + len(data) > self.shard_size:
+            if self.shard_file is not None:
+                self.shard_file.close()
+            self.shard_id += 1
+            self.shard_file = open(self.shard_path(self.shard_id), 'wb')
+            self.shard_bytes = 0
+        self.shards.append(self.shard_id)
+        self.offsets.append(self.shard_bytes)
+        self.lengths.append(len(data))
+        self.shard_file.write(data)
+        self.shard_bytes += len(data)
+
+        self.image_ids.append(image_id)
+        self.shapes.append(shape)
+        self.boxes.append(np.asarray(bboxes, dtype=np.float32).reshape(-1, 4))
+        self.labels.append(np.asarray(labels, dtype=np.int16).reshape(-1))
+        self.anno_offsets.append(self.anno_offsets[-1] + len(self.labels[-1]))
+
+    def close(self, meta):
+        """
+            meta: (Dict) class labels & indexs of the dataset.
+        """
+        if self.shard_file is not None:
+            self.shard_file.close()
+        np.savez(os.path.join(self.output_dir, 'index.npz'),
+                 shards       = np.array(self.shards, dtype=np.int32),
+                 offsets      = np.array(self.offsets, dtype=np.int64),
+                 lengths      = np.array(self.lengths, dtype=np.int64),
+                 image_ids    = np.array(self.image_ids, dtype=np.int64),
+                 shapes       = np.array(self.shapes, dtype=np.int64).reshape(-1, 2),
+                 anno_offsets = np.array(self.anno_offsets, dtype=np.int64),
+                 boxes        = np.concatenate(self.boxes or [np.zeros([0, 4], np.float32)]),
+                 labels       = np.concatenate(self.labels or [np.zeros([0], np.int16)]),
+                 meta         = np.array(json.dumps(meta)),
+                 )
+
+
+class ShardDataset(VOCDataset):
+    """
+        Dataset read from the packed shards, which is interchangeable with the VOC, COCO & Custom dataset
+        it was packed from. The shards are memory-mapped, so that an image is read by a slice, e.g. for
+        the mosaic partners; reading the shards in sequence is done by the ShardShuffleSampler.
+    """
+    def __init__(self,
+                 cfg,
+                 data_dir  :str = None,
+                 transform = None,
+                 is_train  :bool = False,
+                 ):
+        # ----------- Basic parameters -----------
+        self.data_dir  = data_dir
+        self.image_set = "train" if is_train else "val"
+        self.is_train  = is_train
+        # ----------- Data parameters -----------
+        index = np.load(os.path.join(self.data_dir, 'index.npz'))
+        meta = json.loads(str(index['meta']))
+        self.shard_ids    = index['shards']
+        self.offsets      = index['offsets']
+        self.lengths      = index['lengths']
+        self.anno_index   = AnnotationIndex(index['image_ids'], index['shapes'], index['anno_offsets'],
+                                            index['boxes'], index['labels'])
+        self.anno_index.digest = file_digest(os.path.join(self.data_dir, 'index.npz'))
+        self.ids          = self.anno_index.image_ids
+        self.class_ids    = meta['class_ids']
+        self.num_classes  = meta['num_classes']
+        self.class_labels = meta['class_labels']
+        self.class_indexs = meta['class_indexs']
+        self.dataset_size = len(self.ids)
+        # memmaps of the shards, opened on the first read of each process
+        self.shards = {}
+        # ----------- Transform parameters -----------
+        self.transform = transform
+        if is_train:
+            self.mosaic_augment = MosaicAugment(cfg.train_img_size, cfg.affine_params, is_train)
+            self.mixup_augment = MixupAugment(cfg.train_img_size)
+            self.mosaic_prob = cfg.mosaic_prob
+            self.mixup_prob  = cfg.mixup_prob
+            self.copy_paste  = cfg.copy_paste
+        else:
+            self.mosaic_prob = 0.0
+            self.mixup_prob  = 0.0
+            self.copy_paste  = 0.0
+            self.mosaic_augment = None
+            self.mixup_augment  = None
+
+        print(' ============ Strong augmentation info. ============ ')
+        print('use Mosaic Augmentation: {}'.format(self.mosaic_prob))
+        print('use Mixup Augmentation: {}'.format(self.mixup_prob))
+        print('use Copy-paste Augmentation: {}'.format(self.copy_paste))
+        print('Packed dataset: {} images in {} shards'.format(self.dataset_size, len(np.unique(self.shard_ids))))
+
+    def pull_bytes(self, index):
+        shard_id = int(self.shard_ids[index])
+        if shard_id not in self.shards:
+            path = os.path.join(self.data_dir, 'shard_{:05d}.bin'.format(shard_id))
+            self.shards[shard_id] = np.memmap(path, dtype=np.uint8, mode='r')
+        offset = self.offsets[index]
+
+        return self.shards[shard_id][offset: offset + self.lengths[index]]
+
+    def pull_image(self, index):
+        image = cv2.imdecode(self.pull_bytes(index), cv2.IMREAD_COLOR)
+
+        assert image is not None
+
+        return image, self.ids[index]
+
+
+def pack_dataset(dataset, output_dir, shard_size=1024):
+    """
+        Pack the images & annotations of a VOC, COCO or Custom dataset into the shards.
+    """
+    writer = ShardWriter(output_dir, shard_size)
+    image_shapes = dataset.image_shapes()
+    for index in range(len(dataset)):
+        if index % 5000 == 0:
+            print('[Pack: {} / {}]'.format(index, len(dataset)))
+        image_path, image_id = dataset.image_path(index)
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        bboxes, labels = dataset.pull_anno(index)
+        writer.add(data, image_id, image_shapes[index], bboxes, labels)
+    writer.close({'class_ids': list(dataset.class_ids),
+                  'num_classes': dataset.num_classes,
+                  'class_labels': list(dataset.class_labels),
+                  'class_indexs': list(dataset.class_indexs)})
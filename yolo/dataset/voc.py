@@ -8,8 +8,14 @@ from pycocotools.coco import COCO
 
 try:
     from .data_augment.strong_augment import MosaicAugment, MixupAugment
+    from .image_cache import ImageCache
+    from .anno_index import load_anno_index
+    from .augment_control import AugmentControl, control_property
 except:
     from  data_augment.strong_augment import MosaicAugment, MixupAugment
+    from  image_cache import ImageCache
+    from  anno_index import load_anno_index
+    from  augment_control import AugmentControl, control_property
 
 
 voc_class_indexs = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19]
@@ -17,6 +23,26 @@ voc_class_labels = ('aeroplane', 'bicycle', 'bird', 'boat', 'bottle', 'bus', 'ca
 
 
 class VOCDataset(torch.utils.data.Dataset):
+    # The random augmentations of a sample are seeded by (sample_seed, epoch, index) when the
+    # sample_seed is set, so that they neither depend on the worker loading the sample nor on
+    # the iteration the training was resumed from.
+    sample_seed = None
+    # The augmentation state is kept in a shared control block, which the persistent DataLoader workers
+    # read on each item, see AugmentControl
+    epoch       = control_property('epoch', int)
+    mosaic_prob = control_property('mosaic_prob')
+    mixup_prob  = control_property('mixup_prob')
+    copy_paste  = control_property('copy_paste')
+    # Cache of the decoded images, see build_image_cache
+    image_cache = None
+    # A fraction of the mosaic partners is drawn from a pool of the images recently decoded by the worker,
+    # which saves their decoding, see load_mosaic
+    partner_reuse = 0.0
+    partner_pool_size = 64
+    # COCO api of the annotations, only parsed for the evaluation
+    anno_file = None
+    _coco = None
+
     def __init__(self, 
                  cfg,
                  data_dir  :str = None, 
@@ -30,9 +56,10 @@ class VOCDataset(torch.utils.data.Dataset):
         self.num_classes = 20
         # ----------- Data parameters -----------
         self.json_file = "instances_{}.json".format(self.image_set)
-        self.coco = COCO(os.path.join(self.data_dir, 'annotations', self.json_file))
-        self.ids = self.coco.getImgIds()
-        self.class_ids = sorted(self.coco.getCatIds())
+        self.anno_file = os.path.join(self.data_dir, 'annotations', self.json_file)
+        self.anno_index = load_anno_index(self.anno_file, iscrowd=None)
+        self.class_ids = self.anno_index.class_ids
+        self.ids = self.anno_index.image_ids
         self.dataset_size = len(self.ids)
         self.class_labels = voc_class_labels
         self.class_indexs = voc_class_indexs
@@ -56,26 +83,130 @@ class VOCDataset(torch.utils.data.Dataset):
         print('use Copy-paste Augmentation: {}'.format(self.copy_paste))
 
     # ------------ Basic dataset function ------------
+    @property
+    def control(self):
+        # made on the first write, i.e. in the main process, before the workers are started
+        if '_control' not in self.__dict__:
+            self.__dict__['_control'] = AugmentControl()
+        return self.__dict__['_control']
+
+    @property
+    def coco(self):
+        # the samples are read from the cached annotation index, the json is parsed on the first use of the COCO api
+        if self._coco is None:
+            self._coco = COCO(self.anno_file)
+        return self._coco
+
     def __len__(self):
         return len(self.ids)
 
     def __getitem__(self, index):
-        return self.pull_item(index)
+        if isinstance(index, tuple):
+            # the img_size of the batch is given with the index by the multi-scale batch sampler
+            index, img_size = index
+        else:
+            img_size = int(self.control['img_size'])
+        if img_size > 0 and self.transform is not None and img_size != self.transform.img_size:
+            self.apply_img_size(img_size)
+        if self.sample_seed is None:
+            return self.pull_item(index)
+        if torch.utils.data.get_worker_info() is not None:
+            self.seed_sample(index)
+            return self.pull_item(index)
+
+        # ------------ In the main process ------------
+        ## the global RNGs are of the trainer, e.g. of the dropout, and are restored after the sample
+        rng_states = random.getstate(), np.random.get_state(), torch.get_rng_state()
+        try:
+            self.seed_sample(index)
+            return self.pull_item(index)
+        finally:
+            random.setstate(rng_states[0])
+            np.random.set_state(rng_states[1])
+            torch.set_rng_state(rng_states[2])
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_img_size(self, img_size):
+        # the samples are made at the given img_size, e.g. by the progressive resizing,
+        # which is applied by the workers on their next item
+        self.control['img_size'] = img_size
+        self.apply_img_size(img_size)
+
+    def apply_img_size(self, img_size):
+        self.transform.set_img_size(img_size)
+        if self.mosaic_augment is not None:
+            self.mosaic_augment.img_size = img_size
+        if self.mixup_augment is not None:
+            self.mixup_augment.img_size = img_size
+
+    def build_image_cache(self, img_size, budget=8, mode='ram', cache_path=None):
+        self.image_cache = ImageCache(self.image_shapes(), img_size, budget, mode, cache_path)
+
+    def image_shapes(self):
+        # the original shapes of the images are given by the annotations
+        return self.anno_index.shapes.tolist()
+
+    def seed_sample(self, index):
+        seed = ((self.sample_seed * 1000003 + self.epoch) * 1000003 + index) % 2**32
+        random.seed(seed)
+        np.random.seed(seed)
+        # only the CPU generator, as the torch.manual_seed also reseeds the CUDA generators
+        torch.default_generator.manual_seed(seed)
 
     # ------------ Mosaic & Mixup ------------
+    def sample_partners(self, index, num_partners):
+        # rejection sampling, in O(1) as the collisions are rare
+        assert len(self.ids) > num_partners
+        partners = []
+        while len(partners) < num_partners:
+            partner = random.randrange(len(self.ids))
+            if partner != index and partner not in partners:
+                partners.append(partner)
+
+        return partners
+
+    def load_partner(self, index, placed=()):
+        """
+            Load the partner `index` of a mosaic, or reuse a pooled image, which is none of the indexes
+            `placed` in the mosaic, so that the partners stay distinct as by the sample_partners.
+            Return the image, target & index of the partner.
+        """
+        # ------------ Reuse a recently decoded image ------------
+        ## the mosaic only reads the partners, which are shared with the pool without copies
+        pool = self.__dict__.setdefault('partner_pool', [])
+        if self.partner_reuse > 0. and len(pool) > 0 and random.random() < self.partner_reuse:
+            pool_index, image, target = pool[random.randrange(len(pool))]
+            if pool_index != index and pool_index not in placed:
+                return image, target, pool_index
+
+        # ------------ Decode a new image ------------
+        image, target = self.load_image_target(index)
+        if self.partner_reuse > 0.:
+            if len(pool) < self.partner_pool_size:
+                pool.append((index, image, target))
+            else:
+                pool[random.randrange(len(pool))] = (index, image, target)
+
+        return image, target, index
+
     def load_mosaic(self, index):
         # ------------ Prepare 4 indexes of images ------------
         ## Load 4x mosaic image
-        index_list = np.arange(index).tolist() + np.arange(index+1, len(self.ids)).tolist()
-        id1 = index
-        id2, id3, id4 = random.sample(index_list, 3)
-        indexs = [id1, id2, id3, id4]
+        indexs = [index] + self.sample_partners(index, 3)
 
         ## Load images and targets
         image_list = []
         target_list = []
-        for index in indexs:
-            img_i, target_i = self.load_image_target(index)
+        placed = []
+        for i, index in enumerate(indexs):
+            if i == 0:
+                img_i, target_i = self.load_image_target(index)
+            else:
+                # the partners still to load count as placed, so that a pooled image never duplicates one
+                img_i, target_i, index = self.load_partner(index, placed + indexs[i + 1:])
+            placed.append(index)
             image_list.append(img_i)
             target_list.append(target_i)
 
@@ -101,11 +232,17 @@ class VOCDataset(torch.utils.data.Dataset):
     # ------------ Load data function ------------
     def load_image_target(self, index):
         # load an image
-        image, _ = self.pull_image(index)
+        if self.image_cache is not None:
+            image, ratio = self.image_cache.load(index, lambda i: self.pull_image(i)[0])
+        else:
+            image, ratio = self.pull_image(index)[0], 1.0
         height, width, channels = image.shape
 
         # load a target
         bboxes, labels = self.pull_anno(index)
+        if ratio != 1.0:
+            # the cached images are downscaled
+            bboxes = bboxes * ratio
         target = {
             "boxes": bboxes,
             "labels": labels,
@@ -137,16 +274,27 @@ class VOCDataset(torch.utils.data.Dataset):
         # augment
         image, target, deltas = self.transform(image, target, mosaic)
 
+        # drop the tiny boxes of the training samples, after the BatchAugmentation if any
+        if self.is_train and not self.transform.normalize_coords and self.transform.box_format == 'xyxy' \
+            and not getattr(self.transform, 'batch_augment', False):
+            target = self.filter_tiny_boxes(target, image.shape[-1])
+
         return image, target, deltas
 
-    def pull_image(self, index):
-        # get the image file name
-        image_dict = self.coco.dataset['images'][index]
-        image_id = image_dict["id"]
-        filename = image_dict["file_name"]
+    def filter_tiny_boxes(self, target, img_size, min_box_size=8):
+        boxes = torch.clamp(target["boxes"], 0, img_size)
+        keep = (boxes[..., 2:] - boxes[..., :2]).min(dim=-1)[0] >= min_box_size
+        target["boxes"] = boxes[keep]
+        target["labels"] = target["labels"][keep]
+
+        return target
 
+    def image_path(self, index):
+        return os.path.join(self.data_dir, "images", self.anno_index.file_names[index]), self.ids[index]
+
+    def pull_image(self, index):
         # load the image
-        image_path = os.path.join(self.data_dir, "images", filename)
+        image_path, image_id = self.image_path(index)
         image = cv2.imread(image_path)
 
         assert image is not None
@@ -154,39 +302,8 @@ class VOCDataset(torch.utils.data.Dataset):
         return image, image_id
 
     def pull_anno(self, index):
-        img_id = self.ids[index]        
-        # image infor
-        im_ann = self.coco.loadImgs(img_id)[0]
-        width = im_ann['width']
-        height = im_ann['height']
-
-        # annotation infor
-        anno_ids = self.coco.getAnnIds(imgIds=[int(img_id)], iscrowd=None)
-        annotations = self.coco.loadAnns(anno_ids)
-
-        #load a target
-        bboxes = []
-        labels = []
-        for anno in annotations:
-            if 'bbox' in anno and anno['area'] > 0:
-                # bbox
-                x1 = np.max((0, anno['bbox'][0]))
-                y1 = np.max((0, anno['bbox'][1]))
-                x2 = np.min((width - 1, x1 + np.max((0, anno['bbox'][2] - 1))))
-                y2 = np.min((height - 1, y1 + np.max((0, anno['bbox'][3] - 1))))
-                if x2 < x1 or y2 < y1:
-                    continue
-                # class label
-                cls_id = self.class_ids.index(anno['category_id'])
-                
-                bboxes.append([x1, y1, x2, y2])
-                labels.append(cls_id)
-
-        # guard against no boxes via resizing
-        bboxes = np.array(bboxes).reshape(-1, 4)
-        labels = np.array(labels).reshape(-1)
-                
-        return bboxes, labels
+        # a slice of the annotation index
+        return self.anno_index.get(index)
 
 
 if __name__ == "__main__":
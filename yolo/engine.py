@@ -2,16 +2,20 @@ import torch
 import torch.distributed as dist
 
 import os
-import random
+import math
+import time
 
 # ----------------- Extra Components -----------------
 from utils import distributed_utils
-from utils.misc import MetricLogger, SmoothedValue
+from utils.distributed_utils import GradAccumulator
+from utils.misc import MetricLogger, SmoothedValue, PrecisionPolicy, DevicePrefetcher, set_dataloader_epoch
+from utils.checkpoint import CheckpointManager, get_rng_state, set_rng_state
 from utils.vis_tools import vis_data
+from dataset.data_augment.batch_augment import BatchAugmentation
 
 # ----------------- Optimizer & LrScheduler Components -----------------
 from utils.solver.optimizer import build_yolo_optimizer, build_rtdetr_optimizer
-from utils.solver.lr_scheduler import LinearWarmUpLrScheduler, build_lr_scheduler
+from utils.solver.lr_scheduler import LinearWarmUpLrScheduler, build_lr_scheduler, build_resize_scheduler
 
 
 class YoloTrainer(object):
@@ -30,6 +34,8 @@ class YoloTrainer(object):
                  dataset,
                  train_loader,
                  evaluator,
+                 # Checkpoint of the resumed training
+                 checkpoint=None,
                  ):
         # ------------------- basic parameters -------------------
         self.args = args
@@ -54,31 +60,57 @@ class YoloTrainer(object):
         # ---------------------------- Dataset & Dataloader ----------------------------
         self.dataset      = dataset
         self.train_loader = train_loader
+        ## HSV, random perspective & flip of the uint8 batches on the device
+        batch_augment = None
+        if getattr(args, 'batch_augment', False) and cfg.aug_type == 'yolo':
+            # seeded per rank, as the fix_random_seed, so that the ranks draw different augmentations
+            batch_augment = BatchAugmentation(cfg.affine_params, args.seed + distributed_utils.get_rank())
+        self.prefetcher   = DevicePrefetcher(train_loader, device, cfg.pixel_mean, cfg.pixel_std, batch_augment)
 
         # ---------------------------- Evaluator ----------------------------
         self.evaluator = evaluator
 
-        # ---------------------------- Build Grad. Scaler ----------------------------
-        self.scaler = torch.cuda.amp.GradScaler(enabled=args.fp16)
+        # ---------------------------- Checkpoint Manager ----------------------------
+        self.ckpt_manager = CheckpointManager(args.keep_last, args.keep_best)
+        if checkpoint is not None:
+            self.ckpt_manager.restore(self.path_to_save, args.model)
+
+        # ---------------------------- Build Precision Policy ----------------------------
+        self.precision = PrecisionPolicy('fp16' if args.fp16 else args.precision, device)
 
         # ---------------------------- Build Optimizer ----------------------------
         self.grad_accumulate = max(cfg.batch_size_base // args.batch_size, 1)
         cfg.base_lr = cfg.base_lr / cfg.batch_size_base * args.batch_size * self.grad_accumulate  # Auto scale learning rate
         cfg.min_lr  = cfg.base_lr * cfg.min_lr_ratio
-        self.optimizer, self.start_epoch = build_yolo_optimizer(cfg, model, args.resume)
+        self.optimizer, self.start_epoch = build_yolo_optimizer(cfg, model, checkpoint)
 
         # ---------------------------- Build LR Scheduler ----------------------------
         warmup_iters = cfg.warmup_epoch * len(self.train_loader)
         self.lr_scheduler_warmup = LinearWarmUpLrScheduler(warmup_iters, cfg.base_lr, cfg.warmup_bias_lr)
-        self.lr_scheduler = build_lr_scheduler(cfg, self.optimizer, args.resume)
+        self.lr_scheduler = build_lr_scheduler(cfg, self.optimizer, checkpoint)
+
+        # ---------------------------- Build Resolution Scheduler ----------------------------
+        self.resize_scheduler = build_resize_scheduler(cfg)
+        self.batch_size = self.train_loader.batch_sampler.batch_size
+        # iterations of an epoch at the base batch size, which count the warmup
+        self.epoch_size = len(self.train_loader)
+        # wall-clock time of training, reported at each evaluation
+        self.train_time = 0.
+        self.target_time = None
 
         self.best_map = cfg.best_map / 100.0
         print("Best mAP metric: {}".format(self.best_map))
 
+        # ---------------------------- Resume ----------------------------
+        self.start_iter = 0
+        # the state is saved every `ckpt_iters` iterations, at the optimizer steps
+        self.ckpt_iters = math.ceil(args.ckpt_iters / self.grad_accumulate) * self.grad_accumulate
+        self.load_resume_state(checkpoint)
+
     def train(self, model):
         for epoch in range(self.start_epoch, self.cfg.max_epoch):
-            if self.args.distributed:
-                self.train_loader.batch_sampler.sampler.set_epoch(epoch)
+            set_dataloader_epoch(self.train_loader, epoch, self.args.seed, self.start_iter)
+            self.prefetcher.set_epoch(epoch, self.start_iter)
 
             # check second stage
             if epoch >= (self.cfg.max_epoch - self.second_stage_epoch - 1) and not self.second_stage:
@@ -86,19 +118,25 @@ class YoloTrainer(object):
                 # save model of the last mosaic epoch
                 weight_name = '{}_last_mosaic_epoch.pth'.format(self.args.model)
                 checkpoint_path = os.path.join(self.path_to_save, weight_name)
-                print('Saving state of the last Mosaic epoch-{}.'.format(self.epoch))
-                torch.save({'model': model.state_dict(),
-                            'mAP': round(self.evaluator.map*100, 1),
-                            'optimizer': self.optimizer.state_dict(),
-                            'epoch': self.epoch,
-                            'args': self.args}, 
-                            checkpoint_path)
+                if distributed_utils.is_main_process():
+                    print('Saving state of the last Mosaic epoch-{}.'.format(self.epoch))
+                    self.ckpt_manager.save({'model': model.state_dict(),
+                                            'mAP': round(self.evaluator.map*100, 1),
+                                            'optimizer': self.optimizer.state_dict(),
+                                            'epoch': self.epoch,
+                                            'args': self.args},
+                                            checkpoint_path)
 
             # train one epoch
+            self.set_resolution(epoch)
             self.epoch = epoch
+            t0 = time.time()
             self.train_one_epoch(model)
+            self.train_time += time.time() - t0
+            self.start_iter = 0
 
             # LR Schedule
+            self.resize_scheduler.scale_lr(self.optimizer, 1.0)
             if (epoch + 1) > self.cfg.warmup_epoch:
                 self.lr_scheduler.step()
 
@@ -111,14 +149,110 @@ class YoloTrainer(object):
                 if (epoch % self.cfg.eval_epoch) == 0 or (epoch == self.cfg.max_epoch - 1):
                     self.eval(model_eval)
 
+            # save the last checkpoints
+            if self.args.keep_last > 0 and distributed_utils.is_main_process():
+                self.save_last_ckpt(model)
+
             if self.args.debug:
                 print("For debug mode, we only train 1 epoch")
                 break
 
+        # wait for the checkpoints being written
+        self.ckpt_manager.close()
+
+    def set_resolution(self, epoch):
+        """
+            Set the img_size, the batch size & the lr of the epoch by the progressive resizing.
+        """
+        img_size = self.resize_scheduler.get_img_size(epoch)
+        batch_ratio = self.resize_scheduler.get_batch_ratio(epoch)
+        self.train_loader.dataset.set_img_size(img_size)
+        self.train_loader.batch_sampler.set_multi_scale(img_size, self.cfg.multi_scale, self.cfg.max_stride)
+        self.train_loader.batch_sampler.batch_size = self.batch_size * batch_ratio
+        self.resize_scheduler.scale_lr(self.optimizer, batch_ratio)
+        if img_size != self.cfg.train_img_size or batch_ratio > 1:
+            print('Progressive resizing: img_size {}, batch size {}'.format(img_size, self.batch_size * batch_ratio))
+
+    def save_last_ckpt(self, model):
+        model_without_ddp = model.module if self.args.distributed else model
+        weight_name = '{}_epoch_{}.pth'.format(self.args.model, self.epoch)
+        checkpoint_path = os.path.join(self.path_to_save, weight_name)
+        state_dicts = {
+            'model': model_without_ddp.state_dict(),
+            'optimizer':  self.optimizer.state_dict(),
+            'lr_scheduler': self.lr_scheduler.state_dict(),
+            'scaler': self.precision.state_dict(),
+            'epoch': self.epoch,
+            'args': self.args,
+            }
+        if self.model_ema is not None:
+            state_dicts["model_ema"] = self.model_ema.ema.state_dict()
+            state_dicts["ema_updates"] = self.model_ema.updates
+        self.ckpt_manager.save(state_dicts, checkpoint_path, group='last')
+
+    def save_resume_ckpt(self, model, iteration):
+        """
+            Save the state after the first `iteration` iterations of the current epoch.
+        """
+        # the RNG states of all the processes
+        rng_states = distributed_utils.all_gather(get_rng_state())
+        if not distributed_utils.is_main_process():
+            return
+        model_without_ddp = model.module if self.args.distributed else model
+        weight_name = '{}_resume.pth'.format(self.args.model)
+        checkpoint_path = os.path.join(self.path_to_save, weight_name)
+        state_dicts = {
+            'model': model_without_ddp.state_dict(),
+            'mAP': self.best_map * 100,
+            'optimizer':  self.optimizer.state_dict(),
+            'lr_scheduler': self.lr_scheduler.state_dict(),
+            'scaler': self.precision.state_dict(),
+            'epoch': self.epoch,
+            'iteration': iteration,
+            'second_stage': self.second_stage,
+            'lr_ratio': self.resize_scheduler.lr_ratio,
+            'train_time': self.train_time,
+            'rng_state': rng_states,
+            'args': self.args,
+            }
+        if self.model_ema is not None:
+            state_dicts["model_ema"] = self.model_ema.ema.state_dict()
+            state_dicts["ema_updates"] = self.model_ema.updates
+            state_dicts["ema_pending_decay"] = self.model_ema.pending_decay
+        self.ckpt_manager.save(state_dicts, checkpoint_path)
+
+    def load_resume_state(self, checkpoint):
+        """
+            Restore the grad scaler, and the position & RNG states of a checkpoint saved within an epoch.
+        """
+        if checkpoint is None:
+            return
+        if 'scaler' in checkpoint:
+            self.precision.load_state_dict(checkpoint['scaler'])
+        if 'iteration' not in checkpoint:
+            return
+
+        print('--Resume from the iteration {} of the epoch {}'.format(checkpoint['iteration'], checkpoint['epoch']))
+        self.start_epoch = checkpoint['epoch']
+        self.start_iter  = checkpoint['iteration']
+        if self.model_ema is not None and 'ema_pending_decay' in checkpoint:
+            self.model_ema.pending_decay = checkpoint['ema_pending_decay']
+        if checkpoint['second_stage']:
+            self.check_second_stage()
+        # the lr of the optimizer was scaled with the batch size
+        self.resize_scheduler.lr_ratio = checkpoint.get('lr_ratio', 1.0)
+        self.train_time = checkpoint.get('train_time', 0.)
+        # restored at last, as the training goes on right after
+        rng_states = checkpoint['rng_state']
+        if len(rng_states) == distributed_utils.get_world_size():
+            set_rng_state(rng_states[distributed_utils.get_rank()])
+        else:
+            print('The number of processes has changed, the RNG states are not restored.')
+
     def eval(self, model):
         # set eval mode
         model.eval()
-        model_eval = model if self.model_ema is None else self.model_ema.ema
+        model_eval = model if self.model_ema is None else self.model_ema.get_model(self.device)
         cur_map = -1.
         to_save = False
 
@@ -135,6 +269,10 @@ class YoloTrainer(object):
                     self.evaluator.evaluate(model_eval)
 
                 cur_map = self.evaluator.map
+                print('Training time: {:.1f} min'.format(self.train_time / 60))
+                if self.target_time is None and self.args.target_map > 0 and cur_map * 100 >= self.args.target_map:
+                    self.target_time = self.train_time
+                    print('Reach the target mAP {} in {:.1f} min of training.'.format(self.args.target_map, self.target_time / 60))
                 if cur_map > self.best_map:
                     # update best-map
                     self.best_map = cur_map
@@ -143,7 +281,10 @@ class YoloTrainer(object):
             # Save model
             if to_save:
                 print('Saving state, epoch:', self.epoch)
-                weight_name = '{}_best.pth'.format(self.args.model)
+                if self.args.keep_best != 1:
+                    weight_name = '{}_best_epoch_{}.pth'.format(self.args.model, self.epoch)
+                else:
+                    weight_name = '{}_best.pth'.format(self.args.model)
                 checkpoint_path = os.path.join(self.path_to_save, weight_name)
                 state_dicts = {
                     'model': model_eval.state_dict(),
@@ -155,7 +296,7 @@ class YoloTrainer(object):
                     }
                 if self.model_ema is not None:
                     state_dicts["ema_updates"] = self.model_ema.updates
-                torch.save(state_dicts, checkpoint_path)                      
+                self.ckpt_manager.save(state_dicts, checkpoint_path, group='best', metric=cur_map)
 
         if self.args.distributed:
             # wait for all processes to synchronize
@@ -170,32 +311,30 @@ class YoloTrainer(object):
         metric_logger.add_meter('size', SmoothedValue(window_size=1, fmt='{value:d}'))
         metric_logger.add_meter('gnorm', SmoothedValue(window_size=1, fmt='{value:.1f}'))
         header = 'Epoch: [{} / {}]'.format(self.epoch, self.cfg.max_epoch)
-        epoch_size = len(self.train_loader)
         print_freq = 10
         gnorm = 0.0
 
         # basic parameters
-        epoch_size = len(self.train_loader)
-        img_size   = self.cfg.train_img_size
+        epoch_size = self.epoch_size
         nw = epoch_size * self.cfg.warmup_epoch
+        accumulator = GradAccumulator(model, self.grad_accumulate)
 
         # Train one epoch
-        for iter_i, (images, targets) in enumerate(metric_logger.log_every(self.train_loader, print_freq, header)):
+        for iter_i, (images, targets) in enumerate(metric_logger.log_every(self.prefetcher, print_freq, header), self.start_iter):
             ni = iter_i + self.epoch * epoch_size
 
-            # Warmup
-            if nw > 0 and ni < nw:
-                self.lr_scheduler_warmup(ni, self.optimizer)
-            elif ni == nw:
-                print("Warmup stage is over.")
-                self.lr_scheduler_warmup.set_lr(self.optimizer, self.cfg.base_lr)
+            # Warmup, updated at the optimizer steps
+            if accumulator.is_boundary(iter_i):
+                if nw > 0 and ni < nw:
+                    self.lr_scheduler_warmup(ni, self.optimizer)
+                elif nw <= ni < nw + self.grad_accumulate:
+                    print("Warmup stage is over.")
+                    self.lr_scheduler_warmup.set_lr(self.optimizer, self.cfg.base_lr)
                                 
-            # To device
-            images = images.to(self.device, non_blocking=True).float()
+            # The images are copied to the device & normalized by the prefetcher
 
-            # Multi scale
-            images, targets, img_size = self.rescale_image_targets(
-                images, targets, self.cfg.max_stride, self.cfg.multi_scale)
+            # Multi scale: the batches are made at their img_size by the batch sampler & the dataset
+            img_size = images.shape[-1]
                 
             # Visualize train targets
             if self.args.vis_tgt:
@@ -208,33 +347,34 @@ class YoloTrainer(object):
                          self.cfg.pixel_std,
                          self.cfg.box_format)
 
-            # Inference
-            with torch.cuda.amp.autocast(enabled=self.args.fp16):
-                outputs = model(images)
-                # Compute loss
-                loss_dict = self.criterion(outputs=outputs, targets=targets)
-                losses = loss_dict['losses']
-                losses /= self.grad_accumulate
-                loss_dict_reduced = distributed_utils.reduce_dict(loss_dict)
+            # Inference & Backward, the gradients are only all-reduced at the last micro-batch of a step
+            with accumulator.no_sync(iter_i):
+                with self.precision.autocast():
+                    outputs = model(images)
+                    # Compute loss
+                    loss_dict = self.criterion(outputs=outputs, targets=targets)
+                    losses = accumulator.scale(loss_dict['losses'])
 
-            # Backward
-            self.scaler.scale(losses).backward()
+                self.precision.backward(losses)
 
             # Optimize
-            if (iter_i + 1) % self.grad_accumulate == 0:
+            if accumulator.is_boundary(iter_i):
                 if self.cfg.clip_max_norm > 0:
-                    self.scaler.unscale_(self.optimizer)
+                    self.precision.unscale_(self.optimizer)
                     gnorm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=self.cfg.clip_max_norm)
-                self.scaler.step(self.optimizer)
-                self.scaler.update()
+                self.precision.step(self.optimizer)
                 self.optimizer.zero_grad()
 
                 # ModelEMA
                 if self.model_ema is not None:
                     self.model_ema.update(model)
 
+                # Save the state within the epoch
+                if self.ckpt_iters > 0 and (iter_i + 1) % self.ckpt_iters == 0:
+                    self.save_resume_ckpt(model, iter_i + 1)
+
             # Update log
-            metric_logger.update(**loss_dict_reduced)
+            metric_logger.update(**loss_dict)
             metric_logger.update(lr=self.optimizer.param_groups[2]["lr"])
             metric_logger.update(size=img_size)
             metric_logger.update(gnorm=gnorm)
@@ -246,45 +386,8 @@ class YoloTrainer(object):
         # Gather the stats from all processes
         metric_logger.synchronize_between_processes()
         print("Averaged stats:", metric_logger)
-
-    def rescale_image_targets(self, images, targets, max_stride, multi_scale_range=[0.5, 1.5]):
-        """
-            Deployed for Multi scale trick.
-        """
-        # During training phase, the shape of input image is square.
-        old_img_size = images.shape[-1]
-        min_img_size = old_img_size * multi_scale_range[0]
-        max_img_size = old_img_size * multi_scale_range[1]
-
-        # Choose a new image size
-        new_img_size = random.randrange(min_img_size, max_img_size + max_stride, max_stride)
-        
-        # Resize
-        if new_img_size != old_img_size:
-            # interpolate
-            images = torch.nn.functional.interpolate(
-                                input=images, 
-                                size=new_img_size, 
-                                mode='bilinear', 
-                                align_corners=False)
-        # rescale targets
-        if not self.cfg.normalize_coords:
-            for tgt in targets:
-                boxes = tgt["boxes"].clone()
-                labels = tgt["labels"].clone()
-                boxes = torch.clamp(boxes, 0, old_img_size)
-                # rescale box
-                boxes[:, [0, 2]] = boxes[:, [0, 2]] / old_img_size * new_img_size
-                boxes[:, [1, 3]] = boxes[:, [1, 3]] / old_img_size * new_img_size
-                # refine tgt
-                tgt_boxes_wh = boxes[..., 2:] - boxes[..., :2]
-                min_tgt_size = torch.min(tgt_boxes_wh, dim=-1)[0]
-                keep = (min_tgt_size >= 8)
-
-                tgt["boxes"] = boxes[keep]
-                tgt["labels"] = labels[keep]
-
-        return images, targets, new_img_size
+        if self.train_loader.dataset.image_cache is not None:
+            print(self.train_loader.dataset.image_cache)
 
     def check_second_stage(self):
         # set second stage
@@ -324,6 +427,8 @@ class RTDetrTrainer(object):
                  dataset,
                  train_loader,
                  evaluator,
+                 # Checkpoint of the resumed training
+                 checkpoint=None,
                  ):
         # ------------------- basic parameters -------------------
         self.args = args
@@ -345,31 +450,47 @@ class RTDetrTrainer(object):
         # ---------------------------- Dataset & Dataloader ----------------------------
         self.dataset      = dataset
         self.train_loader = train_loader
+        self.prefetcher   = DevicePrefetcher(train_loader, device, cfg.pixel_mean, cfg.pixel_std, move_targets=True)
 
         # ---------------------------- Evaluator ----------------------------
         self.evaluator = evaluator
 
-        # ---------------------------- Build Grad. Scaler ----------------------------
-        self.scaler = torch.cuda.amp.GradScaler(enabled=args.fp16)
+        # ---------------------------- Checkpoint Manager ----------------------------
+        self.ckpt_manager = CheckpointManager(args.keep_last, args.keep_best)
+        if checkpoint is not None:
+            self.ckpt_manager.restore(self.path_to_save, args.model)
+
+        # ---------------------------- Build Precision Policy ----------------------------
+        self.precision = PrecisionPolicy('fp16' if args.fp16 else args.precision, device)
 
         # ---------------------------- Build Optimizer ----------------------------
         self.grad_accumulate = max(cfg.batch_size_base // args.batch_size, 1)
         cfg.base_lr = cfg.base_lr / cfg.batch_size_base * args.batch_size * self.grad_accumulate  # Auto scale learning rate
         cfg.min_lr  = cfg.base_lr * cfg.min_lr_ratio
-        self.optimizer, self.start_epoch = build_rtdetr_optimizer(cfg, model, args.resume)
+        self.optimizer, self.start_epoch = build_rtdetr_optimizer(cfg, model, checkpoint)
 
         # ---------------------------- Build LR Scheduler ----------------------------
         self.wp_lr_scheduler = LinearWarmUpLrScheduler(cfg.warmup_iters, cfg.base_lr)
-        self.lr_scheduler    = build_lr_scheduler(cfg, self.optimizer, args.resume)
+        self.lr_scheduler    = build_lr_scheduler(cfg, self.optimizer, checkpoint)
+
+        # ---------------------------- Multi Scale ----------------------------
+        self.train_loader.batch_sampler.set_multi_scale(cfg.train_img_size, cfg.multi_scale, cfg.max_stride)
+
+        # ---------------------------- Resume ----------------------------
+        self.start_iter = 0
+        # the state is saved every `ckpt_iters` iterations, at the optimizer steps
+        self.ckpt_iters = math.ceil(args.ckpt_iters / self.grad_accumulate) * self.grad_accumulate
+        self.load_resume_state(checkpoint)
 
     def train(self, model):
         for epoch in range(self.start_epoch, self.cfg.max_epoch):
-            if self.args.distributed:
-                self.train_loader.batch_sampler.sampler.set_epoch(epoch)
+            set_dataloader_epoch(self.train_loader, epoch, self.args.seed, self.start_iter)
+            self.prefetcher.set_epoch(epoch, self.start_iter)
 
             # train one epoch
             self.epoch = epoch
             self.train_one_epoch(model)
+            self.start_iter = 0
 
             # LR Scheduler
             self.lr_scheduler.step()
@@ -383,14 +504,90 @@ class RTDetrTrainer(object):
                 if (epoch % self.cfg.eval_epoch) == 0 or (epoch == self.cfg.max_epoch - 1):
                     self.eval(model_eval)
 
+            # save the last checkpoints
+            if self.args.keep_last > 0 and distributed_utils.is_main_process():
+                self.save_last_ckpt(model)
+
             if self.args.debug:
                 print("For debug mode, we only train 1 epoch")
                 break
 
+        # wait for the checkpoints being written
+        self.ckpt_manager.close()
+
+    def save_last_ckpt(self, model):
+        model_without_ddp = model.module if self.args.distributed else model
+        weight_name = '{}_epoch_{}.pth'.format(self.args.model, self.epoch)
+        checkpoint_path = os.path.join(self.path_to_save, weight_name)
+        state_dicts = {
+            'model': model_without_ddp.state_dict(),
+            'optimizer':  self.optimizer.state_dict(),
+            'lr_scheduler': self.lr_scheduler.state_dict(),
+            'scaler': self.precision.state_dict(),
+            'epoch': self.epoch,
+            'args': self.args,
+            }
+        if self.model_ema is not None:
+            state_dicts["model_ema"] = self.model_ema.ema.state_dict()
+            state_dicts["ema_updates"] = self.model_ema.updates
+        self.ckpt_manager.save(state_dicts, checkpoint_path, group='last')
+
+    def save_resume_ckpt(self, model, iteration):
+        """
+            Save the state after the first `iteration` iterations of the current epoch.
+        """
+        # the RNG states of all the processes
+        rng_states = distributed_utils.all_gather(get_rng_state())
+        if not distributed_utils.is_main_process():
+            return
+        model_without_ddp = model.module if self.args.distributed else model
+        weight_name = '{}_resume.pth'.format(self.args.model)
+        checkpoint_path = os.path.join(self.path_to_save, weight_name)
+        state_dicts = {
+            'model': model_without_ddp.state_dict(),
+            'mAP': self.best_map * 100,
+            'optimizer':  self.optimizer.state_dict(),
+            'lr_scheduler': self.lr_scheduler.state_dict(),
+            'scaler': self.precision.state_dict(),
+            'epoch': self.epoch,
+            'iteration': iteration,
+            'rng_state': rng_states,
+            'args': self.args,
+            }
+        if self.model_ema is not None:
+            state_dicts["model_ema"] = self.model_ema.ema.state_dict()
+            state_dicts["ema_updates"] = self.model_ema.updates
+            state_dicts["ema_pending_decay"] = self.model_ema.pending_decay
+        self.ckpt_manager.save(state_dicts, checkpoint_path)
+
+    def load_resume_state(self, checkpoint):
+        """
+            Restore the grad scaler, and the position & RNG states of a checkpoint saved within an epoch.
+        """
+        if checkpoint is None:
+            return
+        if 'scaler' in checkpoint:
+            self.precision.load_state_dict(checkpoint['scaler'])
+        if 'iteration' not in checkpoint:
+            return
+
+        print('--Resume from the iteration {} of the epoch {}'.format(checkpoint['iteration'], checkpoint['epoch']))
+        self.start_epoch = checkpoint['epoch']
+        self.start_iter  = checkpoint['iteration']
+        self.best_map    = checkpoint['mAP'] / 100.0
+        if self.model_ema is not None and 'ema_pending_decay' in checkpoint:
+            self.model_ema.pending_decay = checkpoint['ema_pending_decay']
+        # restored at last, as the training goes on right after
+        rng_states = checkpoint['rng_state']
+        if len(rng_states) == distributed_utils.get_world_size():
+            set_rng_state(rng_states[distributed_utils.get_rank()])
+        else:
+            print('The number of processes has changed, the RNG states are not restored.')
+
     def eval(self, model):
         # set eval mode
         model.eval()
-        model_eval = model if self.model_ema is None else self.model_ema.ema
+        model_eval = model if self.model_ema is None else self.model_ema.get_model(self.device)
         cur_map = -1.
         to_save = False
 
@@ -415,7 +612,10 @@ class RTDetrTrainer(object):
             # Save model
             if to_save:
                 print('Saving state, epoch:', self.epoch)
-                weight_name = '{}_best.pth'.format(self.args.model)
+                if self.args.keep_best != 1:
+                    weight_name = '{}_best_epoch_{}.pth'.format(self.args.model, self.epoch)
+                else:
+                    weight_name = '{}_best.pth'.format(self.args.model)
                 checkpoint_path = os.path.join(self.path_to_save, weight_name)
                 state_dicts = {
                     'model': model_eval.state_dict(),
@@ -427,7 +627,7 @@ class RTDetrTrainer(object):
                     }
                 if self.model_ema is not None:
                     state_dicts["ema_updates"] = self.model_ema.updates
-                torch.save(state_dicts, checkpoint_path)                      
+                self.ckpt_manager.save(state_dicts, checkpoint_path, group='best', metric=cur_map)
 
         if self.args.distributed:
             # wait for all processes to synchronize
@@ -448,12 +648,14 @@ class RTDetrTrainer(object):
 
         # basic parameters
         epoch_size = len(self.train_loader)
-        img_size   = self.cfg.train_img_size
         nw         = self.cfg.warmup_iters
         lr_warmup_stage = True
+        self.criterion.matcher.match_time = 0.
+        start_time = time.time()
+        accumulator = GradAccumulator(model, self.grad_accumulate)
 
         # Train one epoch
-        for iter_i, (images, targets) in enumerate(metric_logger.log_every(self.train_loader, print_freq, header)):
+        for iter_i, (images, targets) in enumerate(metric_logger.log_every(self.prefetcher, print_freq, header), self.start_iter):
             ni = iter_i + self.epoch * epoch_size
 
             # WarmUp
@@ -467,15 +669,9 @@ class RTDetrTrainer(object):
                         lr_warmup_stage = False
                         self.wp_lr_scheduler.set_lr(self.optimizer, self.cfg.base_lr)
                                 
-            # To device
-            images = images.to(self.device, non_blocking=True).float()
-            for tgt in targets:
-                tgt['boxes'] = tgt['boxes'].to(self.device)
-                tgt['labels'] = tgt['labels'].to(self.device)
-
-            # Multi scale
-            images, targets, img_size = self.rescale_image_targets(
-                images, targets, self.cfg.max_stride, self.cfg.multi_scale)
+            # The images & the packed targets are copied to the device by the prefetcher
+            # Multi scale: the batches are made at their img_size by the batch sampler & the dataset
+            img_size = images.shape[-1]
                 
             # Visualize train targets
             if self.args.vis_tgt:
@@ -488,33 +684,34 @@ class RTDetrTrainer(object):
                          self.cfg.pixel_std,
                          self.cfg.box_format)
 
-            # Inference
-            with torch.cuda.amp.autocast(enabled=self.args.fp16):
-                outputs = model(images, targets)    
-                # Compute loss
-                loss_dict = self.criterion(outputs, targets)
-                losses = sum(loss_dict.values())
-                losses /= self.grad_accumulate
-                loss_dict_reduced = distributed_utils.reduce_dict(loss_dict)
+            # Inference & Backward, the gradients are only all-reduced at the last micro-batch of a step
+            with accumulator.no_sync(iter_i):
+                with self.precision.autocast():
+                    outputs = model(images, targets)    
+                    # Compute loss
+                    loss_dict = self.criterion(outputs, targets)
+                    losses = accumulator.scale(sum(loss_dict.values()))
 
-            # Backward
-            self.scaler.scale(losses).backward()
+                self.precision.backward(losses)
 
             # Optimize
-            if (iter_i + 1) % self.grad_accumulate == 0:
+            if accumulator.is_boundary(iter_i):
                 if self.cfg.clip_max_norm > 0:
-                    self.scaler.unscale_(self.optimizer)
+                    self.precision.unscale_(self.optimizer)
                     gnorm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=self.cfg.clip_max_norm)
-                self.scaler.step(self.optimizer)
-                self.scaler.update()
+                self.precision.step(self.optimizer)
                 self.optimizer.zero_grad()
 
                 # ModelEMA
                 if self.model_ema is not None:
                     self.model_ema.update(model)
 
+                # Save the state within the epoch
+                if self.ckpt_iters > 0 and (iter_i + 1) % self.ckpt_iters == 0:
+                    self.save_resume_ckpt(model, iter_i + 1)
+
             # Update log
-            metric_logger.update(**loss_dict_reduced)
+            metric_logger.update(**loss_dict)
             metric_logger.update(lr=self.optimizer.param_groups[2]["lr"])
             metric_logger.update(size=img_size)
             metric_logger.update(gnorm=gnorm)
@@ -523,36 +720,20 @@ class RTDetrTrainer(object):
                 print("For debug mode, we only train 1 iteration")
                 break
 
-    def rescale_image_targets(self, images, targets, max_stride, multi_scale_range=[0.5, 1.5]):
-        """
-            Deployed for Multi scale trick.
-        """
-        # During training phase, the shape of input image is square.
-        old_img_size = images.shape[-1]
-        min_img_size = old_img_size * multi_scale_range[0]
-        max_img_size = old_img_size * multi_scale_range[1]
-
-        # Choose a new image size
-        new_img_size = random.randrange(min_img_size, max_img_size + max_stride, max_stride)
-        
-        # Resize
-        if new_img_size != old_img_size:
-            # interpolate
-            images = torch.nn.functional.interpolate(
-                                input=images, 
-                                size=new_img_size, 
-                                mode='bilinear', 
-                                align_corners=False)
-
-        return images, targets, new_img_size
+        # Time cost of the Hungarian matching
+        total_time = time.time() - start_time
+        match_time = self.criterion.matcher.match_time
+        print('Matching time: {:.1f}s ({:.1f}% of the epoch)'.format(match_time, match_time / max(total_time, 1e-6) * 100))
+        if self.train_loader.dataset.image_cache is not None:
+            print(self.train_loader.dataset.image_cache)
 
 
 # Build Trainer
-def build_trainer(args, cfg, device, model, model_ema, criterion, train_transform, val_transform, dataset, train_loader, evaluator):
+def build_trainer(args, cfg, device, model, model_ema, criterion, train_transform, val_transform, dataset, train_loader, evaluator, checkpoint=None):
     # ----------------------- Det trainers -----------------------
     if   cfg.trainer == 'yolo':
-        return YoloTrainer(args, cfg, device, model, model_ema, criterion, train_transform, val_transform, dataset, train_loader, evaluator)
+        return YoloTrainer(args, cfg, device, model, model_ema, criterion, train_transform, val_transform, dataset, train_loader, evaluator, checkpoint)
     elif cfg.trainer == 'rtdetr':
-        return RTDetrTrainer(args, cfg, device, model, model_ema, criterion, train_transform, val_transform, dataset, train_loader, evaluator)
+        return RTDetrTrainer(args, cfg, device, model, model_ema, criterion, train_transform, val_transform, dataset, train_loader, evaluator, checkpoint)
     else:
         raise NotImplementedError(cfg.trainer)
\ No newline at end of file
@@ -0,0 +1,61 @@
+import os
+import argparse
+
+from utils.misc import load_weight
+from utils.checkpoint import CheckpointReader, save_slim_weights
+
+from config import build_config
+from models import build_model
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export the slim weights for deployment')
+    # Model setting
+    parser.add_argument('--model', default='yolov1', type=str,
+                        help='build yolo')
+    parser.add_argument('--weight', default=None,
+                        type=str, help='Trained checkpoint file path to export')
+    parser.add_argument('--num_classes', default=80, type=int,
+                        help='number of the classes of the trained model.')
+    parser.add_argument('--fuse_conv_bn', action='store_true', default=False,
+                        help='export the weights of the model with fused Conv & BN')
+    parser.add_argument('--half', action='store_true', default=False,
+                        help='export the floating weights in fp16')
+
+    # Output setting
+    parser.add_argument('--output', default=None, type=str,
+                        help='path of the exported weights, *.safetensors')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    output = args.output or os.path.splitext(args.weight)[0] + '.safetensors'
+    checkpoint = CheckpointReader(args.weight)
+
+    if args.fuse_conv_bn:
+        # the fused model is built, as the keys of the fused weights differ from the checkpoint
+        cfg = build_config(args)
+        cfg.num_classes = args.num_classes
+        model = build_model(args, cfg, is_val=False)
+        model = load_weight(model, args.weight, fuse_cbn=True)
+        state_dict = model.state_dict()
+    else:
+        # the EMA weights, if any, as the load_weight
+        state_dict = checkpoint["model_ema"] if "model_ema" in checkpoint else checkpoint["model"]
+
+    if args.half:
+        state_dict = {k: v.half() if v.is_floating_point() else v for k, v in state_dict.items()}
+
+    metadata = {'model': args.model,
+                'num_classes': args.num_classes,
+                'fused': args.fuse_conv_bn,
+                'dtype': 'fp16' if args.half else 'fp32',
+                'epoch': checkpoint.get('epoch'),
+                'mAP': checkpoint.get('mAP'),
+                }
+    save_slim_weights(state_dict, output, metadata)
+
+    size = os.path.getsize(output) / 1024**2
+    print('Export the slim weights to {} ({:.1f} MB, from {:.1f} MB).'.format(output, size, os.path.getsize(args.weight) / 1024**2))
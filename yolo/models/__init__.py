@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
 
-import torch
+from utils.checkpoint import CheckpointReader
 from .yolov1.build     import build_yolov1
 from .yolov2.build     import build_yolov2
 from .yolov3.build     import build_yolov3
@@ -14,7 +14,10 @@ from .rtdetr.build     import build_rtdetr
 
 
 # build object detector
-def build_model(args, cfg, is_val=False):
+def build_model(args, cfg, is_val=False, checkpoint=None):
+    """
+        checkpoint: (CheckpointReader) the checkpoint of the resumed training.
+    """
     # ------------ build object detector ------------
     ## Modified YOLOv1
     if   'yolov1' in args.model:
@@ -48,9 +51,8 @@ def build_model(args, cfg, is_val=False):
         # ------------ Load pretrained weight ------------
         if hasattr(args, "pretrained") and args.pretrained is not None:
             print('Loading COCO pretrained weight ...')
-            checkpoint = torch.load(args.pretrained, map_location='cpu')
-            # checkpoint state dict
-            checkpoint_state_dict = checkpoint.pop("model")
+            # only the model weights are read from the file
+            checkpoint_state_dict = dict(CheckpointReader(args.pretrained)["model"])
             # model state dict
             model_state_dict = model.state_dict()
             # check
@@ -68,15 +70,11 @@ def build_model(args, cfg, is_val=False):
             model.load_state_dict(checkpoint_state_dict, strict=False)
 
         # ------------ Keep training from the given checkpoint ------------
-        if hasattr(args, "resume") and args.resume and args.resume != "None":
-            checkpoint = torch.load(args.resume, map_location='cpu')
-            # checkpoint state dict
-            try:
-                checkpoint_state_dict = checkpoint.pop("model")
-                print('Load model from the checkpoint: ', args.resume)
-                model.load_state_dict(checkpoint_state_dict)
-                del checkpoint, checkpoint_state_dict
-            except:
+        if checkpoint is not None:
+            if "model" in checkpoint:
+                print('Load model from the checkpoint: ', checkpoint.path)
+                model.load_state_dict(checkpoint["model"])
+            else:
                 print("No model in the given checkpoint.")
 
         return model, criterion
@@ -1,5 +1,7 @@
 import torch
 
+from utils.misc import pad_targets, pack_targets
+
 
 def inverse_sigmoid(x, eps=1e-5):
     x = x.clamp(min=0., max=1.)
@@ -27,8 +29,9 @@ def get_contrastive_denoising_training_group(targets,
     if num_denoising <= 0:
         return None, None, None, None
 
-    num_gts = [len(t['labels']) for t in targets]
-    device = targets[0]['labels'].device
+    targets = pack_targets(targets)
+    num_gts = targets.counts.tolist()
+    device = targets.packed.device
     
     max_gt_num = max(num_gts)
     if max_gt_num == 0:
@@ -39,16 +42,8 @@ def get_contrastive_denoising_training_group(targets,
     # pad gt to max_num of a batch
     bs = len(num_gts)
 
-    input_query_class = torch.full([bs, max_gt_num], num_classes, dtype=torch.int32, device=device)
-    input_query_bbox = torch.zeros([bs, max_gt_num, 4], device=device)
-    pad_gt_mask = torch.zeros([bs, max_gt_num], dtype=torch.bool, device=device)
-
-    for i in range(bs):
-        num_gt = num_gts[i]
-        if num_gt > 0:
-            input_query_class[i, :num_gt] = targets[i]['labels']
-            input_query_bbox[i, :num_gt] = targets[i]['boxes']
-            pad_gt_mask[i, :num_gt] = 1
+    input_query_class, input_query_bbox, pad_gt_mask = pad_targets(targets, device)
+    input_query_class = input_query_class.masked_fill(~pad_gt_mask, num_classes).int()
     # each group has positive and negative queries.
     input_query_class = input_query_class.tile([1, 2 * num_group])
     input_query_bbox = input_query_bbox.tile([1, 2 * num_group, 1])
@@ -90,16 +85,10 @@ def get_contrastive_denoising_training_group(targets,
     # match query cannot see the reconstruction
     attn_mask[num_denoising:, :num_denoising] = True
     
-    # reconstruct cannot see each other
-    for i in range(num_group):
-        if i == 0:
-            attn_mask[max_gt_num * 2 * i: max_gt_num * 2 * (i + 1), max_gt_num * 2 * (i + 1): num_denoising] = True
-        if i == num_group - 1:
-            attn_mask[max_gt_num * 2 * i: max_gt_num * 2 * (i + 1), :max_gt_num * i * 2] = True
-        else:
-            attn_mask[max_gt_num * 2 * i: max_gt_num * 2 * (i + 1), max_gt_num * 2 * (i + 1): num_denoising] = True
-            attn_mask[max_gt_num * 2 * i: max_gt_num * 2 * (i + 1), :max_gt_num * 2 * i] = True
-        
+    # reconstruct cannot see each other: block-diagonal mask over the denoising groups
+    group_ids = torch.arange(num_denoising, device=device) // (max_gt_num * 2)
+    attn_mask[:num_denoising, :num_denoising] = group_ids[:, None] != group_ids[None, :]
+
     dn_meta = {
         "dn_positive_idx": dn_positive_idx,
         "dn_num_group": num_group,
@@ -9,9 +9,11 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from utils.misc import force_fp32, pack_targets
+
 from .loss_utils import box_cxcywh_to_xyxy, box_iou, generalized_box_iou
 from .loss_utils import is_dist_avail_and_initialized, get_world_size
-from .matcher import HungarianMatcher
+from .matcher import HungarianMatcher, BatchAssignMatcher
 
 
 # --------------- Criterion for RT-DETR ---------------
@@ -24,7 +26,13 @@ class SetCriterion(nn.Module):
         self.alpha = 0.75  # For VFL
         self.gamma = 2.0
 
-        self.matcher = HungarianMatcher(cfg.cost_class, cfg.cost_bbox, cfg.cost_giou, alpha=0.25, gamma=2.0)
+        if cfg.matcher_solver == 'hungarian':
+            self.matcher = HungarianMatcher(cfg.cost_class, cfg.cost_bbox, cfg.cost_giou, alpha=0.25, gamma=2.0,
+                                            num_workers=cfg.matcher_num_workers)
+        else:
+            self.matcher = BatchAssignMatcher(cfg.cost_class, cfg.cost_bbox, cfg.cost_giou, alpha=0.25, gamma=2.0,
+                                              solver=cfg.matcher_solver)
+        self.reuse_matching_for_aux = cfg.reuse_matching_for_aux
         self.weight_dict = {'loss_cls':  cfg.loss_cls,
                             'loss_box':  cfg.loss_box,
                             'loss_giou': cfg.loss_giou}
@@ -102,14 +110,20 @@ class SetCriterion(nn.Module):
         assert loss in loss_map, f'do you really want to compute {loss} loss?'
         return loss_map[loss](outputs, targets, indices, num_boxes, **kwargs)
 
+    @force_fp32
     def forward(self, outputs, targets):
         outputs_without_aux = {k: v for k, v in outputs.items() if 'aux' not in k}
 
-        # Retrieve the matching between the outputs of the last layer and the targets
-        indices = self.matcher(outputs_without_aux, targets)
+        # Retrieve the matching between the outputs of the last layer and the targets.
+        # The auxiliary layers are matched together with the last layer, or reuse its matching.
+        if 'aux_outputs' in outputs and not self.reuse_matching_for_aux:
+            indices, *aux_indices = self.matcher.batch_forward([outputs_without_aux] + outputs['aux_outputs'], targets)
+        else:
+            indices = self.matcher(outputs_without_aux, targets)
+            aux_indices = [indices] * len(outputs.get('aux_outputs', []))
 
         # Compute the average number of target boxes accross all nodes, for normalization purposes
-        num_boxes = sum(len(t["labels"]) for t in targets)
+        num_boxes = len(pack_targets(targets).packed)
         num_boxes = torch.as_tensor([num_boxes], dtype=torch.float, device=next(iter(outputs.values())).device)
         if is_dist_avail_and_initialized():
             torch.distributed.all_reduce(num_boxes)
@@ -124,8 +138,7 @@ class SetCriterion(nn.Module):
 
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
         if 'aux_outputs' in outputs:
-            for i, aux_outputs in enumerate(outputs['aux_outputs']):
-                indices = self.matcher(aux_outputs, targets)
+            for i, (aux_outputs, indices) in enumerate(zip(outputs['aux_outputs'], aux_indices)):
                 for loss in self.losses:
                     l_dict = self.get_loss(loss, aux_outputs, targets, indices, num_boxes)
                     l_dict = {k: l_dict[k] * self.weight_dict[k] for k in l_dict if k in self.weight_dict}
@@ -153,8 +166,9 @@ class SetCriterion(nn.Module):
         '''get_cdn_matched_indices
         '''
         dn_positive_idx, dn_num_group = dn_meta["dn_positive_idx"], dn_meta["dn_num_group"]
-        num_gts = [len(t['labels']) for t in targets]
-        device = targets[0]['labels'].device
+        targets = pack_targets(targets)
+        num_gts = targets.counts.tolist()
+        device = targets.packed.device
         
         dn_match_indices = []
         for i, num_gt in enumerate(num_gts):
@@ -1,13 +1,18 @@
+import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from concurrent.futures import ThreadPoolExecutor
 from scipy.optimize import linear_sum_assignment
 
+from utils.box_ops import batch_generalized_box_iou
+from utils.misc import pad_targets, pack_targets, batch_auction_assignment, batch_sinkhorn_assignment
+
 from .loss_utils import box_cxcywh_to_xyxy, generalized_box_iou
 
 
 class HungarianMatcher(nn.Module):
-    def __init__(self, cost_class=2.0, cost_bbox=5.0, cost_giou=2.0, alpha=0.25, gamma=2.0):
+    def __init__(self, cost_class=2.0, cost_bbox=5.0, cost_giou=2.0, alpha=0.25, gamma=2.0, num_workers=0):
         super().__init__()
         self.cost_class = cost_class
         self.cost_bbox  = cost_bbox
@@ -16,37 +21,135 @@ class HungarianMatcher(nn.Module):
         self.alpha = alpha
         self.gamma = gamma
 
+        # The per-image assignments are solved concurrently in a thread pool,
+        # as scipy releases the GIL in linear_sum_assignment.
+        self.num_workers = num_workers
+        self.pool = None
+        # Accumulated time cost of the matching, in seconds.
+        self.match_time = 0.
+
         assert self.cost_class != 0 or self.cost_bbox != 0 or self.cost_giou != 0, "all costs cant be 0"
 
+    def start_timer(self, device):
+        # the kernels queued before the matching are waited for, as the .cpu() of the matching
+        # would wait for them, so that the match_time is not overstated on CUDA
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        return time.time()
+
     @torch.no_grad()
     def forward(self, outputs, targets):
-        bs, num_queries = outputs["pred_logits"].shape[:2]
+        return self.batch_forward([outputs], targets)[0]
 
-        # We flatten to compute the cost matrices in a batch
-        out_prob = F.sigmoid(outputs["pred_logits"].flatten(0, 1))
-        out_bbox = outputs["pred_boxes"].flatten(0, 1)  # [batch_size * num_queries, 4]
+    @torch.no_grad()
+    def batch_forward(self, outputs_list, targets):
+        """
+            Match the outputs of several decoder layers at once.
+            outputs_list: (List) [dict{'pred_logits': [B, Nq, C], 'pred_boxes': [B, Nq, 4]}, ...]
+            Return the matched indices of each layer.
+        """
+        t0 = self.start_timer(outputs_list[0]["pred_logits"].device)
+        num_layers = len(outputs_list)
+        bs, num_queries = outputs_list[0]["pred_logits"].shape[:2]
+
+        # We flatten to compute the cost matrices of all the layers in a batch
+        out_prob = F.sigmoid(torch.stack([outputs["pred_logits"] for outputs in outputs_list]).flatten(0, 2))
+        out_bbox = torch.stack([outputs["pred_boxes"] for outputs in outputs_list]).flatten(0, 2)  # [L * B * Nq, 4]
 
-        # Also concat the target labels and boxes
-        tgt_ids = torch.cat([v["labels"] for v in targets])
-        tgt_bbox = torch.cat([v["boxes"] for v in targets])
+        # The target labels and boxes are already concatenated in the packed targets
+        targets = pack_targets(targets)
+        tgt_ids = targets.labels
+        tgt_bbox = targets.boxes
 
         # Compute the classification cost
         out_prob = out_prob[:, tgt_ids]
         neg_cost_class = (1 - self.alpha) * (out_prob**self.gamma) * (-(1 - out_prob + 1e-8).log())
         pos_cost_class = self.alpha * ((1 - out_prob)**self.gamma) * (-(out_prob + 1e-8).log())
-        cost_class = pos_cost_class - neg_cost_class        
+        cost_class = pos_cost_class - neg_cost_class
 
         # Compute the L1 cost between boxes
         cost_bbox = torch.cdist(out_bbox, tgt_bbox, p=1)
 
         # Compute the giou cost betwen boxes
         cost_giou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox), box_cxcywh_to_xyxy(tgt_bbox))
-        
-        # Final cost matrix
+
+        # Final cost matrix: [L * B, Nq, M]
         C = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou
-        C = C.view(bs, num_queries, -1).cpu()
+        C = C.view(num_layers * bs, num_queries, -1).cpu()
+
+        # Optimize cost
+        sizes = targets.counts.tolist()
+        C = [c.numpy() for c in C.split(sizes, -1)]
+        costs = [C[i][l * bs + i] for l in range(num_layers) for i in range(bs)]
+        if self.num_workers > 0 and len(costs) > 1:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.num_workers)
+            indices = list(self.pool.map(linear_sum_assignment, costs))
+        else:
+            indices = [linear_sum_assignment(c) for c in costs]
+        indices = [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+        self.match_time += time.time() - t0
+
+        return [indices[l * bs: (l + 1) * bs] for l in range(num_layers)]
+
+
+class BatchAssignMatcher(HungarianMatcher):
+    """
+        Device-resident matcher: the padded [B, Nq, M] costs of the whole batch are solved at once
+        by the auction algorithm ('auction') or its entropic approximation ('sinkhorn').
+    """
+    def __init__(self, cost_class=2.0, cost_bbox=5.0, cost_giou=2.0, alpha=0.25, gamma=2.0, solver='auction'):
+        super().__init__(cost_class, cost_bbox, cost_giou, alpha, gamma)
+        assert solver in ['auction', 'sinkhorn']
+        self.solver = solver
+
+    @torch.no_grad()
+    def batch_forward(self, outputs_list, targets):
+        t0 = self.start_timer(outputs_list[0]["pred_logits"].device)
+        num_layers = len(outputs_list)
+        bs, num_queries = outputs_list[0]["pred_logits"].shape[:2]
+        device = outputs_list[0]["pred_logits"].device
+
+        # [L * B, Nq, C]
+        out_prob = F.sigmoid(torch.stack([outputs["pred_logits"] for outputs in outputs_list]).flatten(0, 1))
+        out_bbox = torch.stack([outputs["pred_boxes"] for outputs in outputs_list]).flatten(0, 1)
+
+        # [B, M] -> [L * B, M]
+        tgt_labels, tgt_bboxes, tgt_mask = pad_targets(targets, device)
+        tgt_labels = tgt_labels.repeat(num_layers, 1)
+        tgt_bboxes = tgt_bboxes.repeat(num_layers, 1, 1)
+        tgt_mask   = tgt_mask.repeat(num_layers, 1)
+
+        # Compute the classification cost: [L * B, Nq, M]
+        out_prob = out_prob.gather(2, tgt_labels[:, None, :].expand(-1, num_queries, -1))
+        neg_cost_class = (1 - self.alpha) * (out_prob**self.gamma) * (-(1 - out_prob + 1e-8).log())
+        pos_cost_class = self.alpha * ((1 - out_prob)**self.gamma) * (-(out_prob + 1e-8).log())
+        cost_class = pos_cost_class - neg_cost_class
+
+        # Compute the L1 & giou cost between boxes: [L * B, Nq, M]
+        cost_bbox = torch.cdist(out_bbox, tgt_bboxes, p=1)
+        cost_giou = -batch_generalized_box_iou(box_cxcywh_to_xyxy(out_bbox), box_cxcywh_to_xyxy(tgt_bboxes))
+
+        # Final cost matrix: [L * B, Nq, M]
+        C = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou
+        C = C.masked_fill(~tgt_mask[:, None, :], 0.)
+
+        # Matched query of each target: [L * B, M]
+        if self.solver == 'auction':
+            assignment = batch_auction_assignment(C, tgt_mask)
+        else:
+            assignment = batch_sinkhorn_assignment(C, tgt_mask)
+        assignment = assignment.cpu()
 
-        sizes = [len(v["boxes"]) for v in targets]
-        indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
+        indices = []
+        sizes = pack_targets(targets).counts.tolist()
+        for k, query_inds in enumerate(assignment):
+            query_inds = query_inds[:sizes[k % bs]]
+            tgt_inds = torch.arange(len(query_inds))[query_inds >= 0]
+            query_inds = query_inds[query_inds >= 0]
+            # sorted by the query index, as the scipy solver does
+            query_inds, order = query_inds.sort()
+            indices.append((query_inds, tgt_inds[order]))
+        self.match_time += time.time() - t0
 
-        return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+        return [indices[l * bs: (l + 1) * bs] for l in range(num_layers)]
@@ -3,6 +3,7 @@ import torch.nn.functional as F
 from .matcher import Yolov2Matcher
 from utils.box_ops import get_ious
 from utils.distributed_utils import get_world_size, is_dist_avail_and_initialized
+from utils.misc import force_fp32
 
 
 class SetCriterion(object):
@@ -36,6 +37,7 @@ class SetCriterion(object):
 
         return loss_box
 
+    @force_fp32
     def __call__(self, outputs, targets):
         device = outputs['pred_cls'][0].device
         stride = outputs['stride']
@@ -3,6 +3,7 @@ import torch.nn.functional as F
 
 from utils.box_ops import get_ious
 from utils.distributed_utils import get_world_size, is_dist_avail_and_initialized
+from utils.misc import force_fp32
 
 from .matcher import Yolov5Matcher
 
@@ -39,6 +40,7 @@ class SetCriterion(object):
 
         return loss_box, ious
 
+    @force_fp32
     def __call__(self, outputs, targets):
         device = outputs['pred_cls'][0].device
         fpn_strides = outputs['strides']
@@ -2,8 +2,9 @@ import torch
 import torch.nn.functional as F
 from utils.box_ops import get_ious
 from utils.distributed_utils import get_world_size, is_dist_avail_and_initialized
+from utils.misc import pad_targets, force_fp32
 
-from .matcher import YoloxMatcher
+from .matcher import BatchYoloxMatcher
 
 
 class SetCriterion(object):
@@ -14,7 +15,7 @@ class SetCriterion(object):
         self.loss_cls_weight = cfg.loss_cls
         self.loss_box_weight = cfg.loss_box
         # matcher
-        self.matcher = YoloxMatcher(cfg.num_classes, cfg.ota_center_sampling_radius, cfg.ota_topk_candidate)
+        self.matcher = BatchYoloxMatcher(cfg.num_classes, cfg.ota_center_sampling_radius, cfg.ota_topk_candidate)
 
     def loss_objectness(self, pred_obj, gt_obj):
         loss_obj = F.binary_cross_entropy_with_logits(pred_obj, gt_obj, reduction='none')
@@ -33,6 +34,7 @@ class SetCriterion(object):
 
         return loss_box
 
+    @force_fp32
     def __call__(self, outputs, targets):        
         """
             outputs['pred_obj']: List(Tensor) [B, M, 1]
@@ -53,54 +55,33 @@ class SetCriterion(object):
         cls_preds = torch.cat(outputs['pred_cls'], dim=1)
         box_preds = torch.cat(outputs['pred_box'], dim=1)
 
-        # label assignment
-        cls_targets = []
-        box_targets = []
-        obj_targets = []
-        fg_masks = []
-
-        for batch_idx in range(bs):
-            tgt_labels = targets[batch_idx]["labels"].to(device)
-            tgt_bboxes = targets[batch_idx]["boxes"].to(device)
-
-            # check target
-            if len(tgt_labels) == 0 or tgt_bboxes.max().item() == 0.:
-                num_anchors = sum([ab.shape[0] for ab in anchors])
-                # There is no valid gt
-                cls_target = obj_preds.new_zeros((0, self.num_classes))
-                box_target = obj_preds.new_zeros((0, 4))
-                obj_target = obj_preds.new_zeros((num_anchors, 1))
-                fg_mask = obj_preds.new_zeros(num_anchors).bool()
-            else:
-                (
-                    fg_mask,
-                    assigned_labels,
-                    assigned_ious,
-                    assigned_indexs
-                ) = self.matcher(
-                    fpn_strides = fpn_strides,
-                    anchors = anchors,
-                    pred_obj = obj_preds[batch_idx],
-                    pred_cls = cls_preds[batch_idx], 
-                    pred_box = box_preds[batch_idx],
-                    tgt_labels = tgt_labels,
-                    tgt_bboxes = tgt_bboxes
-                    )
-
-                obj_target = fg_mask.unsqueeze(-1)
-                cls_target = F.one_hot(assigned_labels.long(), self.num_classes)
-                cls_target = cls_target * assigned_ious.unsqueeze(-1)
-                box_target = tgt_bboxes[assigned_indexs]
-
-            cls_targets.append(cls_target)
-            box_targets.append(box_target)
-            obj_targets.append(obj_target)
-            fg_masks.append(fg_mask)
-
-        cls_targets = torch.cat(cls_targets, 0)
-        box_targets = torch.cat(box_targets, 0)
-        obj_targets = torch.cat(obj_targets, 0)
-        fg_masks = torch.cat(fg_masks, 0)
+        # label assignment: [B, N], [B, N, 4], [B, N]
+        tgt_labels, tgt_bboxes, tgt_mask = pad_targets(targets, device)
+        # check target: the image whose boxes are all zeros has no valid gt
+        tgt_mask = tgt_mask & (tgt_bboxes.flatten(1).max(dim=-1).values > 0.).unsqueeze(-1)
+        (
+            fg_masks,
+            assigned_labels,
+            assigned_ious,
+            assigned_indexs
+        ) = self.matcher(
+            fpn_strides = fpn_strides,
+            anchors = anchors,
+            pred_obj = obj_preds,
+            pred_cls = cls_preds, 
+            pred_box = box_preds,
+            tgt_labels = tgt_labels,
+            tgt_bboxes = tgt_bboxes,
+            tgt_mask = tgt_mask
+            )
+
+        # [B, M] -> [BM,]
+        obj_targets = fg_masks.view(-1, 1)
+        fg_masks = fg_masks.view(-1)
+        cls_targets = F.one_hot(assigned_labels.view(-1)[fg_masks], self.num_classes)
+        cls_targets = cls_targets * assigned_ious.view(-1)[fg_masks].unsqueeze(-1)
+        batch_inds = torch.arange(bs, device=device).unsqueeze(-1).expand_as(assigned_indexs)
+        box_targets = tgt_bboxes[batch_inds, assigned_indexs].view(-1, 4)[fg_masks]
         num_fgs = fg_masks.sum()
 
         if is_dist_avail_and_initialized():
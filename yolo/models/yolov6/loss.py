@@ -3,6 +3,7 @@ import torch.nn.functional as F
 
 from utils.box_ops import bbox_iou
 from utils.distributed_utils import get_world_size, is_dist_avail_and_initialized
+from utils.misc import force_fp32
 
 from .matcher import TaskAlignedAssigner
 
@@ -42,6 +43,7 @@ class SetCriterion(object):
 
         return loss_box
     
+    @force_fp32
     def __call__(self, outputs, targets):        
         """
             outputs['pred_cls']: List(Tensor) [B, M, C]
@@ -128,8 +128,9 @@ class Yolov8DetPredLayer(nn.Module):
             delta_pred = outputs["pred_reg"].reshape([B, M, 4, self.cfg.reg_max])
             # [B, M, 4, reg_max] -> [B, reg_max, 4, M]
             delta_pred = delta_pred.permute(0, 3, 2, 1).contiguous()
-            # [B, reg_max, 4, M] -> [B, 1, 4, M]
-            delta_pred = self.proj_conv(F.softmax(delta_pred, dim=1))
+            # [B, reg_max, 4, M] -> [B, 1, 4, M], the DFL integral is kept in fp32 under autocast
+            with torch.autocast(device_type=delta_pred.device.type, enabled=False):
+                delta_pred = self.proj_conv(F.softmax(delta_pred.float(), dim=1))
             # [B, 1, 4, M] -> [B, 4, M] -> [B, M, 4]
             delta_pred = delta_pred.view(B, 4, M).permute(0, 2, 1).contiguous()
             ## tlbr -> xyxy
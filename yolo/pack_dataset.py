@@ -0,0 +1,68 @@
+import os
+import time
+import argparse
+import numpy as np
+
+from dataset.build import build_dataset
+from dataset.shard import ShardDataset, pack_dataset
+from utils.misc import ShardShuffleSampler
+
+from config import build_config
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Pack a dataset into the shards for the sequential reads')
+    # Dataset setting
+    parser.add_argument('--root', default='D:/python_work/dataset/COCO/',
+                        help='data root')
+    parser.add_argument('--dataset', default='coco',
+                        help='coco, voc, custom')
+    parser.add_argument('--image_set', default='train', type=str, choices=['train', 'val'],
+                        help='the split to pack')
+    parser.add_argument('--model', default='yolov1', type=str,
+                        help='config of the dataset transforms, which does not change the packed data')
+
+    # Output setting
+    parser.add_argument('--output', default=None, type=str,
+                        help='directory of the packed split, <root>/shards/<image_set> by default')
+    parser.add_argument('--shard_size', default=1024, type=int,
+                        help='size of a shard, in MB')
+    parser.add_argument('--benchmark', default=2000, type=int,
+                        help='number of the images to compare the read throughput, 0 to skip')
+
+    return parser.parse_args()
+
+
+def images_per_sec(dataset, indexs):
+    t0 = time.time()
+    for index in indexs:
+        dataset.pull_image(index)
+        dataset.pull_anno(index)
+
+    return len(indexs) / (time.time() - t0)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    output = args.output or os.path.join(args.root, 'shards', args.image_set)
+    is_train = args.image_set == 'train'
+    cfg = build_config(args)
+
+    # ---------------- Pack ----------------
+    dataset = build_dataset(args, cfg, transform=None, is_train=is_train)
+    pack_dataset(dataset, output, args.shard_size)
+    packed = ShardDataset(cfg, output, transform=None, is_train=is_train)
+    assert len(packed) == len(dataset)
+
+    # ---------------- Read throughput ----------------
+    ## both formats are read in the same orders: the order of the training, i.e. of the ShardShuffleSampler,
+    ## and a random order
+    ## Note: clear the page cache in between, e.g. by `echo 3 > /proc/sys/vm/drop_caches`, for the cold reads.
+    if args.benchmark > 0:
+        orders = {'shard-shuffle': list(ShardShuffleSampler(packed, seed=0))[:args.benchmark],
+                  'random': np.random.permutation(len(dataset))[:args.benchmark]}
+        for name, indexs in orders.items():
+            loose_speed = images_per_sec(dataset, indexs)
+            shard_speed = images_per_sec(packed, indexs)
+            print('Read throughput ({} order): {:.0f} images/s from the loose files, {:.0f} images/s from the shards ({:.2f}x)'.format(
+                name, loose_speed, shard_speed, shard_speed / loose_speed))
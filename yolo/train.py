@@ -15,6 +15,7 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from utils import distributed_utils
 from utils.misc import compute_flops, build_dataloader, CollateFunc
 from utils.ema  import ModelEMA
+from utils.checkpoint import open_checkpoint
 
 # ----------------- Config Components -----------------
 from config import build_config
@@ -50,6 +51,16 @@ def parse_args():
                         help='use tensorboard')
     parser.add_argument('--save_folder', default='weights/', type=str, 
                         help='path to save weight')
+    parser.add_argument('--keep_last', default=0, type=int,
+                        help='keep the checkpoints of the last N epochs (0: do not save them).')
+    parser.add_argument('--keep_best', default=1, type=int,
+                        help='keep the K best checkpoints (<= 0: keep all of them).')
+    parser.add_argument('--target_map', default=0., type=float,
+                        help='report the training time to reach the target mAP (%%), e.g. to compare the progressive resizing.')
+    parser.add_argument('--ckpt_iters', default=0, type=int,
+                        help='save the resumable state every N iterations within an epoch (0: only the epoch checkpoints).')
+    parser.add_argument('--batch_augment', action='store_true', default=False,
+                        help='apply the HSV, random perspective & flip of the YOLO augmentations to the whole batch on the device')
     parser.add_argument('--vis_tgt', action="store_true", default=False,
                         help="visualize training data.")
     parser.add_argument('--vis_aux_loss', action="store_true", default=False,
@@ -57,7 +68,9 @@ def parse_args():
     
     # Mixing precision
     parser.add_argument('--fp16', dest="fp16", action="store_true", default=False,
-                        help="Adopting mix precision training.")
+                        help="Adopting mix precision training, same as --precision fp16.")
+    parser.add_argument('--precision', default='fp32', type=str, choices=['fp32', 'fp16', 'bf16'],
+                        help="training precision: fp32, fp16 (with grad scaler) or bf16.")
     
     # Batchsize
     parser.add_argument('--batch_size', default=16, type=int, 
@@ -78,6 +91,19 @@ def parse_args():
                         help='coco, voc')
     parser.add_argument('--num_workers', default=4, type=int, 
                         help='Number of workers used in dataloading')
+    parser.add_argument('--shard_dir', default=None, type=str,
+                        help='train with the packed shards of the training set, made by pack_dataset.py')
+    parser.add_argument('--partner_reuse', default=0.0, type=float,
+                        help='fraction of the mosaic partners drawn from the recently decoded images of a worker, '
+                             'which makes the samples depend on the worker history, i.e. not bit-identical on resume')
+    parser.add_argument('--partner_pool', default=64, type=int,
+                        help='number of the recently decoded images kept by a worker for the mosaic partners')
+    parser.add_argument('--cache_images', default='none', type=str, choices=['none', 'ram', 'disk'],
+                        help='cache the decoded training images in the shared memory or on the local disk')
+    parser.add_argument('--cache_budget', default=8.0, type=float,
+                        help='byte budget of the image cache, in GB')
+    parser.add_argument('--cache_dir', default=None, type=str,
+                        help='directory of the disk cache, <root>/cache by default')
     
     # DDP train
     parser.add_argument('--distributed', action='store_true', default=False,
@@ -141,7 +167,7 @@ def train():
     cfg = build_config(args)
 
     # ---------------------------- Build Transform ----------------------------
-    train_transform = build_transform(cfg, is_train=True)
+    train_transform = build_transform(cfg, is_train=True, uint8_output=True, batch_augment=args.batch_augment)
     val_transform   = build_transform(cfg, is_train=False)
 
     # ---------------------------- Build Dataset & Dataloader ----------------------------
@@ -156,16 +182,20 @@ def train():
                              transform    = val_transform
                              )
 
+    # ---------------------------- Read the checkpoint to resume ----------------------------
+    ## Read once, and shared by the model, ModelEMA, optimizer & lr scheduler
+    checkpoint = open_checkpoint(args.resume)
+
     # ---------------------------- Build model ----------------------------
     ## Build model
-    model, criterion = build_model(args, cfg, is_val=True)
+    model, criterion = build_model(args, cfg, is_val=True, checkpoint=checkpoint)
     model = model.to(device).train()
     model_without_ddp = model
 
     # ---------------------------- Build Model-EMA ----------------------------
     if cfg.use_ema and distributed_utils.get_rank() in [-1, 0]:
         print('Build ModelEMA for {} ...'.format(args.model))
-        model_ema = ModelEMA(model, cfg.ema_decay, cfg.ema_tau, args.resume)
+        model_ema = ModelEMA(model, cfg.ema_decay, cfg.ema_tau, checkpoint, cfg.ema_update_interval, cfg.ema_offload)
     else:
         model_ema = None
 
@@ -193,13 +223,15 @@ def train():
         dist.barrier()
 
     # ---------------------------- Build Trainer ----------------------------
-    trainer = build_trainer(args, cfg, device, model, model_ema, criterion, train_transform, val_transform, dataset, train_loader, evaluator)
+    trainer = build_trainer(args, cfg, device, model, model_ema, criterion, train_transform, val_transform, dataset, train_loader, evaluator, checkpoint)
+    del checkpoint
 
     ## Eval before training
     if args.eval_first and distributed_utils.is_main_process():
         # to check whether the evaluator can work
         model_eval = model_without_ddp
         trainer.eval(model_eval)
+        trainer.ckpt_manager.close()
         return
 
     # garbage = torch.randn(640, 1024, 73, 73).to(device) # 15 G
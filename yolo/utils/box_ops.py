@@ -81,6 +81,27 @@ def box_iou(boxes1, boxes2):
     iou = inter / union
     return iou, union
 
+def batch_box_iou(boxes1, boxes2):
+    """
+        Batched version of box_iou.
+        boxes1: (Tensor) [B, N, 4]
+        boxes2: (Tensor) [B, M, 4]
+        Return the [B, N, M] pairwise iou & union.
+    """
+    area1 = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])  # [B, N]
+    area2 = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])  # [B, M]
+
+    lt = torch.max(boxes1[:, :, None, :2], boxes2[:, None, :, :2])  # [B,N,M,2]
+    rb = torch.min(boxes1[:, :, None, 2:], boxes2[:, None, :, 2:])  # [B,N,M,2]
+
+    wh = (rb - lt).clamp(min=0)  # [B,N,M,2]
+    inter = wh[..., 0] * wh[..., 1]  # [B,N,M]
+
+    union = area1[:, :, None] + area2[:, None, :] - inter
+
+    iou = inter / union
+    return iou, union
+
 def generalized_box_iou(boxes1, boxes2):
     """
     Generalized IoU from https://giou.stanford.edu/
@@ -104,6 +125,23 @@ def generalized_box_iou(boxes1, boxes2):
 
     return iou - (area - union) / area
 
+def batch_generalized_box_iou(boxes1, boxes2):
+    """
+        Batched version of generalized_box_iou.
+        boxes1: (Tensor) [B, N, 4]
+        boxes2: (Tensor) [B, M, 4]
+        Return the [B, N, M] pairwise giou.
+    """
+    iou, union = batch_box_iou(boxes1, boxes2)
+
+    lt = torch.min(boxes1[:, :, None, :2], boxes2[:, None, :, :2])
+    rb = torch.max(boxes1[:, :, None, 2:], boxes2[:, None, :, 2:])
+
+    wh = (rb - lt).clamp(min=0)  # [B,N,M,2]
+    area = wh[..., 0] * wh[..., 1]
+
+    return iou - (area - union) / area
+
 def get_ious(bboxes1,
              bboxes2,
              box_mode="xyxy",
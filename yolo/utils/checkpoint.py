@@ -0,0 +1,376 @@
+import os
+import re
+import json
+import time
+import struct
+import pickle
+import random
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+
+def state_to_cpu(state):
+    """
+        Snapshot the (nested) state dicts, by copying all the tensors to the CPU.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: state_to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return state
+
+
+class CheckpointReader(object):
+    """
+        A checkpoint file read once, and shared by the builders of the model, ModelEMA, optimizer & lr scheduler.
+        The file is memory-mapped, so that the tensors of a section (e.g. the optimizer state) are only read
+        from the disk when the section is used.
+    """
+    def __init__(self, path):
+        self.path = path
+        t0 = time.time()
+        self.checkpoint = self.load(path)
+        print('Read the checkpoint {} in {:.2f}s.'.format(path, time.time() - t0))
+
+    @staticmethod
+    def load(path):
+        # The weights-only unpickler runs no code, but the training checkpoints also hold the args & the RNG states
+        for weights_only in [True, False]:
+            try:
+                return torch.load(path, map_location='cpu', mmap=True, weights_only=weights_only)
+            except (pickle.UnpicklingError, RuntimeError, TypeError):
+                continue
+        # the legacy format (or an older torch) can not be memory-mapped
+        return torch.load(path, map_location='cpu')
+
+    def __contains__(self, key):
+        return key in self.checkpoint
+
+    def __getitem__(self, key):
+        return self.checkpoint[key]
+
+    def get(self, key, default=None):
+        return self.checkpoint.get(key, default)
+
+    def keys(self):
+        return self.checkpoint.keys()
+
+
+def open_checkpoint(path):
+    """ The CheckpointReader of the path, None if no path is given. """
+    if path is None or path.lower() == "none":
+        return None
+    return CheckpointReader(path)
+
+
+def get_rng_state():
+    """
+        The RNG states of python, numpy & torch (CPU & CUDA) of this process.
+    """
+    rng_state = {'python': random.getstate(),
+                 'numpy':  np.random.get_state(),
+                 'torch':  torch.get_rng_state()}
+    if torch.cuda.is_available():
+        rng_state['cuda'] = torch.cuda.get_rng_state_all()
+    return rng_state
+
+
+def set_rng_state(rng_state):
+    random.setstate(rng_state['python'])
+    np.random.set_state(rng_state['numpy'])
+    torch.set_rng_state(rng_state['torch'])
+    if 'cuda' in rng_state and torch.cuda.is_available() and len(rng_state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+
+
+class CheckpointManager(object):
+    """
+        Asynchronous checkpoint writer: the state is snapshotted to the CPU on the training
+        thread, then serialized in a background thread to a temp file, which is fsync-ed and
+        atomically renamed, so that a crash never leaves a partially written checkpoint.
+
+        Retention: the newest `keep_last` checkpoints of the 'last' group and the `keep_best`
+        checkpoints with the highest metric of the 'best' group are kept (<= 0 keeps all).
+        The checkpoints of a resumed training written before the restart are tracked by the restore.
+    """
+    def __init__(self, keep_last=1, keep_best=1):
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.last_ckpts = []
+        self.best_ckpts = []
+        # time cost on the training thread & in the background
+        self.num_saved = 0
+        self.snapshot_time = 0.
+        self.write_time = 0.
+
+    def restore(self, path_to_save, model_name):
+        """
+            Track the checkpoints written before a resume, so that they are pruned as the new ones:
+            '{model}_epoch_{N}.pth' of the 'last' group & '{model}_best_epoch_{N}.pth' of the 'best' group.
+        """
+        if not os.path.isdir(path_to_save):
+            return
+        last_ckpts, best_ckpts = [], []
+        for file_name in os.listdir(path_to_save):
+            path = os.path.join(path_to_save, file_name)
+            match = re.fullmatch(re.escape(model_name) + r'_(best_)?epoch_(\d+)\.pth', file_name)
+            if match is None:
+                continue
+            if match.group(1) is None:
+                last_ckpts.append((int(match.group(2)), path))
+            else:
+                # the metric is read from the memory-mapped checkpoint, as saved by the trainers in %
+                metric = CheckpointReader.load(path).get('mAP', 0.) / 100.
+                best_ckpts.append((metric, path))
+        self.last_ckpts = [path for _, path in sorted(last_ckpts)]
+        self.best_ckpts = sorted(best_ckpts, key=lambda x: x[0], reverse=True)
+
+    def save(self, state_dicts, checkpoint_path, group=None, metric=None):
+        t0 = time.time()
+        snapshot = state_to_cpu(state_dicts)
+        # one write in flight at a time
+        self.wait()
+        self.pending = self.executor.submit(self._write, snapshot, checkpoint_path, group, metric)
+        self.snapshot_time += time.time() - t0
+
+    def _write(self, state_dicts, checkpoint_path, group, metric):
+        t0 = time.time()
+        tmp_path = checkpoint_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(state_dicts, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, checkpoint_path)
+
+        # retention
+        if group == 'last':
+            self.last_ckpts = [path for path in self.last_ckpts if path != checkpoint_path] + [checkpoint_path]
+            if self.keep_last > 0:
+                self.remove(self.last_ckpts[:-self.keep_last])
+                self.last_ckpts = self.last_ckpts[-self.keep_last:]
+        elif group == 'best':
+            self.best_ckpts = [(m, path) for m, path in self.best_ckpts if path != checkpoint_path] + [(metric, checkpoint_path)]
+            self.best_ckpts.sort(key=lambda x: x[0], reverse=True)
+            if self.keep_best > 0:
+                self.remove([path for _, path in self.best_ckpts[self.keep_best:]])
+                self.best_ckpts = self.best_ckpts[:self.keep_best]
+
+        self.num_saved += 1
+        self.write_time += time.time() - t0
+
+    def remove(self, checkpoint_paths):
+        for path in checkpoint_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def wait(self):
+        if self.pending is not None:
+            # re-raise the error of the background write, if any
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+        print('Saved {} checkpoints: {:.1f}s on the training thread, {:.1f}s of writing done in the background.'.format(
+            self.num_saved, self.snapshot_time, self.write_time))
+
+
+# ---------------------------- Slim weights for deployment ----------------------------
+## The layout of safetensors: [header size: 8 bytes][json header][tensor data]
+SLIM_DTYPES = {torch.float64: 'F64', torch.float32: 'F32', torch.float16: 'F16', torch.bfloat16: 'BF16',
+               torch.int64: 'I64', torch.int32: 'I32', torch.int16: 'I16', torch.int8: 'I8',
+               torch.uint8: 'U8', torch.bool: 'BOOL'}
+
+def save_slim_weights(state_dict, path, metadata=None):
+    """
+        Save the tensors only, with the string-valued metadata (e.g. the model config) in the header.
+    """
+    tensors = {k: v.detach().cpu().contiguous() for k, v in state_dict.items()}
+    # the larger elements first, so that every tensor is aligned in the file
+    names = sorted(tensors.keys(), key=lambda k: (-tensors[k].element_size(), k))
+    header = {'__metadata__': {k: str(v) for k, v in (metadata or {}).items()}}
+    offset = 0
+    for k in names:
+        nbytes = tensors[k].numel() * tensors[k].element_size()
+        header[k] = {'dtype': SLIM_DTYPES[tensors[k].dtype],
+                     'shape': list(tensors[k].shape),
+                     'data_offsets': [offset, offset + nbytes]}
+        offset += nbytes
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header += b' ' * (-len(header) % 8)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for k in names:
+            f.write(tensors[k].reshape(-1).view(torch.uint8).numpy())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def load_slim_weights(path):
+    """
+        Return the state dict & the metadata of the slim weights. The tensors are views of the memory-mapped
+        file (copy-on-write), whose pages are read on use and shared by all the processes loading the file.
+    """
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    metadata = header.pop('__metadata__', {})
+    dtypes = {v: k for k, v in SLIM_DTYPES.items()}
+    if os.path.getsize(path) == 8 + header_size:
+        return {k: torch.empty(v['shape'], dtype=dtypes[v['dtype']]) for k, v in header.items()}, metadata
+
+    buffer = torch.from_numpy(np.memmap(path, dtype=np.uint8, mode='c', offset=8 + header_size))
+    state_dict = {}
+    for k, v in header.items():
+        start, end = v['data_offsets']
+        state_dict[k] = buffer[start:end].view(dtypes[v['dtype']]).reshape(v['shape'])
+
+    return state_dict, metadata
+
+
+if __name__ == "__main__":
+    # Run from the yolo folder: python -m utils.checkpoint
+    # A training interrupted & resumed by the YoloTrainer should give the same losses & weights as an uninterrupted one,
+    # through the warmup, the progressive resizing (lr_ratio), the multi-scale batches, the BatchAugmentation,
+    # the ModelEMA updated every 2 steps (ema_pending_decay) & the second stage.
+    import tempfile
+    from types import SimpleNamespace
+    import torch.nn as nn
+    from engine import YoloTrainer
+    from dataset.voc import VOCDataset
+    from utils.ema import ModelEMA
+    from utils.misc import build_dataloader, CollateFunc
+
+    class ToyTransform(object):
+        img_size = 64
+        def set_img_size(self, img_size):
+            self.img_size = img_size
+
+    class ToyDataset(VOCDataset):
+        # uint8 samples of the random python, numpy & torch draws, seeded per sample by the VOCDataset
+        def __init__(self):
+            self.ids = np.arange(64)
+            self.is_train = True
+            self.transform = ToyTransform()
+            self.mosaic_augment = None
+            self.mixup_augment = None
+            self.mosaic_prob = 0.5
+            self.mixup_prob = 0.0
+            self.copy_paste = 0.0
+
+        def pull_item(self, index):
+            img_size = self.transform.img_size
+            mosaic = random.random() < self.mosaic_prob
+            image = torch.from_numpy(np.random.randint(0, 255, [3, img_size, img_size], dtype=np.uint8))
+            x1y1 = torch.rand(2, 2) * img_size / 2
+            target = {"boxes": torch.cat([x1y1, x1y1 + img_size / 4 + torch.rand(2, 2) * 8], dim=-1),
+                      "labels": torch.tensor([index % 3, 1]),
+                      "orig_size": [img_size, img_size],
+                      "mosaic": mosaic,
+                      "content_size": [img_size, img_size]}
+            return image, target, None
+
+    class ToyModel(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.conv = nn.Conv2d(3, 8, 3, 2, 1)
+            self.norm = nn.BatchNorm2d(8)
+            self.drop = nn.Dropout(0.2)
+            self.pred = nn.Linear(8, 5)
+
+        def forward(self, x):
+            return self.pred(self.drop(self.norm(self.conv(x)).relu().mean(dim=(2, 3))))
+
+    class ToyEvaluator(object):
+        map = 0.0
+        def evaluate(self, model):
+            pass
+
+    class Killed(Exception):
+        pass
+
+    class InterruptedTrainer(YoloTrainer):
+        # killed right after the resume checkpoint of (epoch, iteration)
+        stop_at = None
+        def save_resume_ckpt(self, model, iteration):
+            super().save_resume_ckpt(model, iteration)
+            if (self.epoch, iteration) == self.stop_at:
+                self.ckpt_manager.close()
+                raise Killed
+
+    def train(save_folder, stop_at=None, resume=False):
+        random.seed(0)
+        np.random.seed(0)
+        torch.manual_seed(0)
+        args = SimpleNamespace(save_folder=save_folder, dataset='toy', model='toy', seed=0, batch_size=4, num_workers=2,
+                               distributed=False, batch_augment=True, fp16=False, precision='fp32', ckpt_iters=1,
+                               keep_last=1, keep_best=1, vis_tgt=False, debug=False, target_map=0.)
+        cfg = SimpleNamespace(max_epoch=4, no_aug_epoch=1, eval_epoch=10, warmup_epoch=1, warmup_bias_lr=0.1,
+                              batch_size_base=4, base_lr=0.01, min_lr_ratio=0.01, optimizer='sgd', momentum=0.9,
+                              weight_decay=5e-4, lr_scheduler='cosine', clip_max_norm=10., train_img_size=64,
+                              resize_min_ratio=0.5, resize_ramp_epoch=3, resize_scale_batch=True, max_stride=32,
+                              multi_scale=[0.5, 1.5], aug_type='yolo', pixel_mean=[0., 0., 0.], pixel_std=[255., 255., 255.],
+                              affine_params={'degrees': 10.0, 'translate': 0.1, 'scale': [0.5, 1.5], 'shear': 2.0,
+                                             'perspective': 0.0, 'hsv_h': 0.015, 'hsv_s': 0.7, 'hsv_v': 0.4})
+        dataset = ToyDataset()
+        train_loader = build_dataloader(args, dataset, args.batch_size, CollateFunc())
+
+        losses = []
+        def criterion(outputs, targets):
+            tgts = torch.stack([torch.cat([tgt["boxes"].mean(dim=0) / 64, tgt["labels"].float().mean()[None]])
+                                if len(tgt["labels"]) > 0 else torch.zeros(5) for tgt in targets])
+            loss = (outputs - tgts).pow(2).mean()
+            losses.append(loss.item())
+            return {'losses': loss}
+
+        checkpoint = open_checkpoint(os.path.join(save_folder, 'toy', 'toy', 'toy_resume.pth') if resume else None)
+        model = ToyModel()
+        if checkpoint is not None:
+            model.load_state_dict(checkpoint['model'])
+        model_ema = ModelEMA(model, 0.9999, 2000, checkpoint, update_interval=2)
+        trainer = InterruptedTrainer(args, cfg, 'cpu', model, model_ema, criterion, None, None,
+                                     dataset, train_loader, ToyEvaluator(), checkpoint)
+        trainer.stop_at = stop_at
+        try:
+            trainer.train(model)
+        except Killed:
+            pass
+
+        return losses, model.state_dict(), model_ema.ema.state_dict()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        full_losses, full_weights, full_ema = train(os.path.join(tmp_dir, 'full'))
+        # in the warmup, after it, with the batch size scaled in the second stage & at the last epoch
+        for stop_at in [(0, 3), (1, 5), (2, 2), (3, 1)]:
+            save_folder = os.path.join(tmp_dir, 'stop_{}_{}'.format(*stop_at))
+            losses, _, _ = train(save_folder, stop_at=stop_at)
+            resumed_losses, weights, ema = train(save_folder, resume=True)
+            assert losses + resumed_losses == full_losses, stop_at
+            for k in full_weights:
+                assert torch.equal(weights[k], full_weights[k]) and torch.equal(ema[k], full_ema[k]), (stop_at, k)
+    print('The resumed training of the YoloTrainer is bit-identical to the uninterrupted one.')
+
+    # The slim weights should be restored exactly
+    state_dict = {'conv.weight': torch.randn(8, 3, 3, 3),
+                  'conv.bias': torch.randn(8).half(),
+                  'norm.num_batches_tracked': torch.tensor(7),
+                  'norm.running_mean': torch.randn(8).bfloat16(),
+                  'mask': torch.rand(5) > 0.5,
+                  'empty': torch.zeros(0, 4)}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'weights.safetensors')
+        save_slim_weights(state_dict, path, {'model': 'yolov8_n', 'fused': False})
+        loaded_state_dict, metadata = load_slim_weights(path)
+        assert metadata == {'model': 'yolov8_n', 'fused': 'False'}
+        for k, v in state_dict.items():
+            assert loaded_state_dict[k].dtype == v.dtype and torch.equal(loaded_state_dict[k], v), k
+    print('The slim weights are restored exactly.')
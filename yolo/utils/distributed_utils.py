@@ -2,9 +2,11 @@
 
 import torch
 import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 import os
 import subprocess
 import pickle
+import contextlib
 
 
 def all_gather(data):
@@ -164,3 +166,77 @@ def init_distributed_mode(args):
                                          world_size=args.world_size, rank=args.rank)
     torch.distributed.barrier()
     setup_for_distributed(args.rank == 0)
+
+
+class GradAccumulator(object):
+    """
+        Gradient accumulation over `accumulate` micro-batches. Under DDP, the micro-steps
+        before the boundary run in no_sync(), so the gradients are all-reduced once per step.
+    """
+    def __init__(self, model, accumulate=1):
+        self.model = model
+        self.accumulate = max(accumulate, 1)
+
+    def is_boundary(self, iter_i):
+        return (iter_i + 1) % self.accumulate == 0
+
+    def no_sync(self, iter_i):
+        """ Context of the forward & backward of the iter_i-th micro-batch. """
+        if isinstance(self.model, DDP) and not self.is_boundary(iter_i):
+            return self.model.no_sync()
+        return contextlib.nullcontext()
+
+    def scale(self, loss):
+        """ Normalize the loss of a micro-batch. """
+        return loss / self.accumulate
+
+
+if __name__ == "__main__":
+    import torch.nn as nn
+    import torch.multiprocessing as mp
+    from torch.distributed.algorithms.ddp_comm_hooks.default_hooks import allreduce_hook
+
+    world_size, accumulate, micro_bs, num_steps = 2, 4, 2, 3
+
+    def count_allreduce_hook(state, bucket):
+        state.append(1)
+        return allreduce_hook(None, bucket)
+
+    def train(rank, x, y, accumulate):
+        torch.manual_seed(0)
+        model = DDP(nn.Sequential(nn.Linear(8, 16), nn.ReLU(), nn.Linear(16, 1)))
+        num_allreduce = []
+        model.register_comm_hook(num_allreduce, count_allreduce_hook)
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+        accumulator = GradAccumulator(model, accumulate)
+
+        # each rank takes its shard of the batch of every step
+        x = x.view(num_steps, world_size, -1, 8)[:, rank].flatten(0, 1)
+        y = y.view(num_steps, world_size, -1, 1)[:, rank].flatten(0, 1)
+        for iter_i, (xi, yi) in enumerate(zip(x.chunk(num_steps * accumulate), y.chunk(num_steps * accumulate))):
+            with accumulator.no_sync(iter_i):
+                loss = accumulator.scale(nn.functional.mse_loss(model(xi), yi))
+                loss.backward()
+            if accumulator.is_boundary(iter_i):
+                optimizer.step()
+                optimizer.zero_grad()
+
+        return model.module.state_dict(), len(num_allreduce)
+
+    def worker(rank):
+        dist.init_process_group('gloo', init_method='tcp://127.0.0.1:29511', world_size=world_size, rank=rank)
+        torch.manual_seed(1)
+        x = torch.randn(num_steps * world_size * accumulate * micro_bs, 8)
+        y = torch.randn(num_steps * world_size * accumulate * micro_bs, 1)
+
+        # without accumulation, a micro-batch is the whole per-rank batch
+        ref_weights, ref_num_allreduce = train(rank, x, y, accumulate=1)
+        acc_weights, acc_num_allreduce = train(rank, x, y, accumulate=accumulate)
+        for k in ref_weights:
+            assert torch.allclose(ref_weights[k], acc_weights[k], atol=1e-6), k
+        assert acc_num_allreduce == ref_num_allreduce == num_steps
+        if rank == 0:
+            print('Identical weights, {} all-reduce for {} micro-batches.'.format(acc_num_allreduce, num_steps * accumulate))
+        dist.destroy_process_group()
+
+    mp.start_processes(worker, nprocs=world_size, start_method='fork')
@@ -13,7 +13,7 @@ import torch.nn as nn
 
 # Modified from the YOLOv5 project
 class ModelEMA(object):
-    def __init__(self, model, ema_decay=0.9999, ema_tau=2000, resume=None):
+    def __init__(self, model, ema_decay=0.9999, ema_tau=2000, checkpoint=None, update_interval=1, offload=False):
         # Create EMA
         self.ema = deepcopy(self.de_parallel(model)).eval()  # FP32 EMA
         self.updates = 0  # number of EMA updates
@@ -21,21 +21,35 @@ class ModelEMA(object):
         for p in self.ema.parameters():
             p.requires_grad_(False)
 
-        if resume is not None and resume.lower() != "none":
-            self.load_resume(resume)
+        if checkpoint is not None:
+            self.load_resume(checkpoint)
+
+        # The EMA is updated every `update_interval` steps, with the decays of the skipped steps compounded
+        self.update_interval = max(update_interval, 1)
+        self.pending_decay = 1.0
+        # Keep the EMA weights in pinned host memory, to save the device memory
+        self.offload = offload and torch.cuda.is_available()
+        if self.offload:
+            self.ema.cpu()
+            for v in list(self.ema.parameters()) + list(self.ema.buffers()):
+                v.data = v.data.pin_memory()
+        # Flat list of the floating EMA tensors, updated by the multi-tensor (foreach) kernels
+        self.ema_keys = [k for k, v in self.ema.state_dict().items() if v.dtype.is_floating_point]
+        ema_state_dict = self.ema.state_dict()
+        self.ema_tensors = [ema_state_dict[k] for k in self.ema_keys]
+        self.host_buffers = [torch.empty_like(v).pin_memory() for v in self.ema_tensors] if self.offload else None
 
         print("Initialize ModelEMA's updates: {}".format(self.updates))
 
-    def load_resume(self, resume):
-        checkpoint = torch.load(resume)
-        if 'model_ema' in checkpoint.keys():
-            print('--Load ModelEMA state dict from the checkpoint: ', resume)
+    def load_resume(self, checkpoint):
+        if 'model_ema' in checkpoint:
+            print('--Load ModelEMA state dict from the checkpoint: ', checkpoint.path)
             model_ema_state_dict = checkpoint["model_ema"]
             self.ema.load_state_dict(model_ema_state_dict)
-        if 'ema_updates' in checkpoint.keys():
-            print('--Load ModelEMA updates from the checkpoint: ', resume)
+        if 'ema_updates' in checkpoint:
+            print('--Load ModelEMA updates from the checkpoint: ', checkpoint.path)
             # checkpoint state dict
-            self.updates = checkpoint.pop("ema_updates")
+            self.updates = checkpoint["ema_updates"]
 
     def is_parallel(self, model):
         # Returns True if model is of type DP or DDP
@@ -56,14 +70,50 @@ class ModelEMA(object):
     def update(self, model):
         # Update EMA parameters
         self.updates += 1
-        d = self.decay(self.updates)
+        self.pending_decay *= self.decay(self.updates)
+        if self.updates % self.update_interval != 0:
+            return
+        d = self.pending_decay
+        self.pending_decay = 1.0
 
         msd = self.de_parallel(model).state_dict()  # model state_dict
-        for k, v in self.ema.state_dict().items():
-            if v.dtype.is_floating_point:  # true for FP16 and FP32
-                v *= d
-                v += (1 - d) * msd[k].detach()
+        model_tensors = [msd[k].detach() for k in self.ema_keys]
+        if self.offload:
+            for buffer, v in zip(self.host_buffers, model_tensors):
+                buffer.copy_(v, non_blocking=True)
+            torch.cuda.current_stream().synchronize()
+            model_tensors = self.host_buffers
+        torch._foreach_mul_(self.ema_tensors, d)
+        torch._foreach_add_(self.ema_tensors, model_tensors, alpha=1 - d)
+
+    def get_model(self, device):
+        # The EMA model on the device, which is a copy if the EMA weights are offloaded
+        return deepcopy(self.ema).to(device) if self.offload else self.ema
 
     def update_attr(self, model, include=(), exclude=('process_group', 'reducer')):
         # Update EMA attributes
         self.copy_attr(self.ema, model, include, exclude)
+
+
+if __name__ == "__main__":
+    # The foreach update should match the per-tensor update of the reference implementation
+    model = nn.Sequential(nn.Conv2d(3, 8, 3), nn.BatchNorm2d(8), nn.SiLU(), nn.Conv2d(8, 4, 1))
+    model_ema = ModelEMA(model, ema_decay=0.9998, ema_tau=20)
+    ref_ema = deepcopy(model).eval()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    for step in range(1, 51):
+        model(torch.randn(2, 3, 16, 16)).mean().backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        model_ema.update(model)
+
+        d = model_ema.decay(step)
+        msd = model.state_dict()
+        for k, v in ref_ema.state_dict().items():
+            if v.dtype.is_floating_point:
+                v *= d
+                v += (1 - d) * msd[k].detach()
+
+    for k, v in ref_ema.state_dict().items():
+        assert torch.allclose(v, model_ema.ema.state_dict()[k], atol=1e-6), k
+    print('ModelEMA matches the reference update.')
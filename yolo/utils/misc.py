@@ -6,14 +6,20 @@ from torch.utils.data import DataLoader, DistributedSampler
 
 import cv2
 import math
+import functools
+import itertools
+import contextlib
 import time
 import datetime
+import statistics
+import warnings
 import numpy as np
-from copy import deepcopy
 from thop import profile
+from scipy.optimize import linear_sum_assignment
 from collections import defaultdict, deque
 
 from .distributed_utils import is_dist_avail_and_initialized
+from .checkpoint import CheckpointReader, load_slim_weights
 
 
 # ---------------------------- Train tools ----------------------------
@@ -26,12 +32,17 @@ class SmoothedValue(object):
         if fmt is None:
             fmt = "{median:.4f} ({global_avg:.4f})"
         self.deque = deque(maxlen=window_size)
+        self.window_total = 0.0
         self.total = 0.0
         self.count = 0
         self.fmt = fmt
 
     def update(self, value, n=1):
+        # the window sum is updated incrementally
+        if len(self.deque) == self.deque.maxlen:
+            self.window_total -= self.deque[0]
         self.deque.append(value)
+        self.window_total += value
         self.count += n
         self.total += value * n
 
@@ -41,7 +52,8 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=device)
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -50,13 +62,11 @@ class SmoothedValue(object):
 
     @property
     def median(self):
-        d = torch.tensor(list(self.deque))
-        return d.median().item()
+        return statistics.median(self.deque)
 
     @property
     def avg(self):
-        d = torch.tensor(list(self.deque), dtype=torch.float32)
-        return d.mean().item()
+        return self.window_total / len(self.deque)
 
     @property
     def global_avg(self):
@@ -82,14 +92,38 @@ class MetricLogger(object):
     def __init__(self, delimiter="\t"):
         self.meters = defaultdict(SmoothedValue)
         self.delimiter = delimiter
+        # Running sums of the tensor values since the last flush, kept on their device
+        self.pending_sums = dict()
+        self.pending_counts = defaultdict(int)
 
     def update(self, **kwargs):
         for k, v in kwargs.items():
             if isinstance(v, torch.Tensor):
-                v = v.item()
+                v = v.detach().float().reshape(())
+                self.pending_sums[k] = self.pending_sums[k] + v if k in self.pending_sums else v
+                self.pending_counts[k] += 1
+                continue
             assert isinstance(v, (float, int))
             self.meters[k].update(v)
 
+    def flush(self):
+        """
+            Average the pending tensor values over the processes with a single
+            all-reduce and one host copy, and update the meters with them.
+        """
+        if len(self.pending_sums) == 0:
+            return
+        names = list(self.pending_sums.keys())
+        sums = torch.stack([self.pending_sums[k] for k in names])
+        if is_dist_avail_and_initialized():
+            dist.all_reduce(sums)
+            sums /= dist.get_world_size()
+        for k, v in zip(names, sums.tolist()):
+            n = self.pending_counts[k]
+            self.meters[k].update(v / n, n)
+        self.pending_sums.clear()
+        self.pending_counts.clear()
+
     def __getattr__(self, attr):
         if attr in self.meters:
             return self.meters[attr]
@@ -107,6 +141,7 @@ class MetricLogger(object):
         return self.delimiter.join(loss_str)
 
     def synchronize_between_processes(self):
+        self.flush()
         for meter in self.meters.values():
             meter.synchronize_between_processes()
 
@@ -147,6 +182,7 @@ class MetricLogger(object):
             yield obj
             iter_time.update(time.time() - end)
             if i % print_freq == 0 or i == len(iterable) - 1:
+                self.flush()
                 eta_seconds = iter_time.global_avg * (len(iterable) - i)
                 eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
                 if torch.cuda.is_available():
@@ -168,24 +204,272 @@ class MetricLogger(object):
             header, total_time_str, total_time / len(iterable)))
 
 
+## Mixed precision policy
+class PrecisionPolicy(object):
+    """
+        Mixed precision policy shared by the trainers, built on torch.autocast:
+        'fp32', 'fp16' (with a GradScaler) or 'bf16', on both the GPU and the CPU.
+    """
+    def __init__(self, precision='fp32', device=torch.device('cpu')):
+        assert precision in ['fp32', 'fp16', 'bf16']
+        self.device_type = torch.device(device).type
+        if precision == 'fp16' and self.device_type == 'cpu':
+            print('fp16 autocast is not supported on the CPU, use bf16 instead.')
+            precision = 'bf16'
+        self.precision = precision
+        self.dtype = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}[precision]
+        # Only fp16 needs the loss scaling, as bf16 has the dynamic range of fp32
+        self.scaler = torch.cuda.amp.GradScaler(enabled=precision == 'fp16')
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype, enabled=self.precision != 'fp32')
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def unscale_(self, optimizer):
+        self.scaler.unscale_(optimizer)
+
+    def step(self, optimizer):
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def state_dict(self):
+        return self.scaler.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.scaler.load_state_dict(state_dict)
+
+def _to_fp32(x):
+    if isinstance(x, torch.Tensor):
+        return x.float() if x.is_floating_point() else x
+    if isinstance(x, dict):
+        return {k: _to_fp32(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return type(x)(_to_fp32(v) for v in x)
+    return x
+
+def force_fp32(func):
+    """
+        Run the decorated function (e.g. a loss or a matcher) in fp32 under autocast,
+        with its floating tensor inputs cast to fp32.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(torch.autocast(device_type='cpu', enabled=False))
+            if torch.cuda.is_available():
+                stack.enter_context(torch.autocast(device_type='cuda', enabled=False))
+            return func(*_to_fp32(args), **_to_fp32(kwargs))
+
+    return wrapper
+
+
 # ---------------------------- For Dataset ----------------------------
 ## build dataloader
 def build_dataloader(args, dataset, batch_size, collate_fn=None):
     # distributed
     if args.distributed:
-        sampler = DistributedSampler(dataset)
+        sampler = DistributedSampler(dataset, seed=args.seed)
+    elif hasattr(dataset, 'shard_ids'):
+        # the packed dataset is read shard by shard
+        sampler = ShardShuffleSampler(dataset, seed=args.seed)
     else:
-        sampler = torch.utils.data.RandomSampler(dataset)
+        sampler = ResumableRandomSampler(dataset, seed=args.seed)
+
+    batch_sampler_train = ResumableBatchSampler(sampler, batch_size, drop_last=True)
 
-    batch_sampler_train = torch.utils.data.BatchSampler(sampler, batch_size, drop_last=True)
+    # seed the augmentations of each sample, see VOCDataset
+    if hasattr(dataset, 'sample_seed'):
+        dataset.sample_seed = args.seed
 
+    # the workers are seeded by their own generator, which leaves the global RNG untouched;
+    # they are kept across the epochs, as the epoch & the augmentation switches reach them by the
+    # shared AugmentControl of the dataset
     dataloader = DataLoader(dataset, batch_sampler=batch_sampler_train,
-                            collate_fn=collate_fn, num_workers=args.num_workers, pin_memory=True)
+                            collate_fn=collate_fn, num_workers=args.num_workers, pin_memory=True,
+                            generator=torch.Generator().manual_seed(args.seed),
+                            persistent_workers=args.num_workers > 0 and hasattr(dataset, 'control'))
     
     return dataloader
+
+def set_dataloader_epoch(dataloader, epoch, seed, start_iter=0):
+    """
+        The data order & the augmentations of an epoch only depend on (seed, epoch), as the samples are
+        seeded by the dataset, so that an interrupted epoch can be continued from its `start_iter`-th batch.
+    """
+    dataloader.batch_sampler.sampler.set_epoch(epoch)
+    dataloader.batch_sampler.set_start_iter(start_iter)
+    if dataloader.generator is not None:
+        dataloader.generator.manual_seed(seed + epoch)
+    if hasattr(dataloader.dataset, 'set_epoch'):
+        dataloader.dataset.set_epoch(epoch)
+
+## Resumable samplers
+class ResumableRandomSampler(torch.utils.data.Sampler):
+    """
+        Random sampler with the order set by (seed, epoch), as the DistributedSampler.
+    """
+    def __init__(self, dataset, seed=0):
+        self.dataset = dataset
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        return iter(torch.randperm(len(self.dataset), generator=g).tolist())
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+class ShardShuffleSampler(ResumableRandomSampler):
+    """
+        Shard-local shuffle of a packed dataset: the shards are visited in a random order, `window` shards
+        at a time, and the images of the shards in a window are shuffled together, so that the shard files
+        are read in sequence while the batches still mix several shards.
+    """
+    def __init__(self, dataset, seed=0, window=4):
+        super().__init__(dataset, seed)
+        self.window = window
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        shard_ids = torch.as_tensor(self.dataset.shard_ids)
+        shards = torch.unique(shard_ids)
+        shards = shards[torch.randperm(len(shards), generator=g)]
+        indices = []
+        for i in range(0, len(shards), self.window):
+            window_inds = torch.nonzero(torch.isin(shard_ids, shards[i: i + self.window])).flatten()
+            indices.extend(window_inds[torch.randperm(len(window_inds), generator=g)].tolist())
+
+        return iter(indices)
+
+class ResumableBatchSampler(torch.utils.data.BatchSampler):
+    """
+        Batch sampler which skips the first `start_iter` batches of the next epoch,
+        i.e. the batches already trained before the interruption.
+
+        For the multi-scale training, an img_size is drawn for each batch by (seed, epoch), and given
+        to the dataset with the indexes, i.e. [(index, img_size), ...], so that the samples are made
+        at that size directly.
+    """
+    def __init__(self, sampler, batch_size, drop_last):
+        super().__init__(sampler, batch_size, drop_last)
+        self.start_iter = 0
+        self.img_size = None
+        self.multi_scale = None
+        self.stride = 32
+
+    def set_start_iter(self, start_iter):
+        self.start_iter = start_iter
+
+    def set_multi_scale(self, img_size, multi_scale, stride):
+        self.img_size = img_size
+        self.multi_scale = multi_scale
+        self.stride = stride
+
+    def get_img_sizes(self, num_batches):
+        min_img_size = max(math.ceil(self.img_size * self.multi_scale[0] / self.stride) * self.stride, self.stride)
+        max_img_size = max(int(self.img_size * self.multi_scale[1]), min_img_size)
+        img_sizes = torch.arange(min_img_size, max_img_size + 1, self.stride)
+        # the same sizes on all the processes
+        g = torch.Generator()
+        g.manual_seed(getattr(self.sampler, 'seed', 0) + getattr(self.sampler, 'epoch', 0))
+        return img_sizes[torch.randint(len(img_sizes), [num_batches], generator=g)].tolist()
+
+    def __iter__(self):
+        start_iter, self.start_iter = self.start_iter, 0
+        batches = super().__iter__()
+        if self.img_size is not None and self.multi_scale is not None:
+            img_sizes = self.get_img_sizes(len(self))
+            batches = ([(index, img_size) for index in batch] for batch, img_size in zip(batches, img_sizes))
+        # the indexes are skipped without loading the samples
+        return itertools.islice(batches, start_iter, None)
     
+## Packed targets of a batch
+class PackedTargets(object):
+    """
+        Targets of a batch in a single [N, 6] float tensor of (batch_idx, cls, x1, y1, x2, y2), where the
+        boxes are in the box_format of the transform, with the number of targets of each image, so that the
+        targets are copied to the device at once & consumed by the vectorized code, e.g. the pad_targets.
+        The other keys of the targets, e.g. the orig_size, are kept per image in the meta.
+
+        For the legacy code, it is also a sequence of the per-image dicts {'boxes', 'labels', ...}.
+    """
+    def __init__(self, packed, counts, meta=None):
+        self.packed = packed                                      # [N, 6]
+        self.counts = torch.as_tensor(counts, dtype=torch.long)   # [B,], on CPU
+        self.meta   = meta if meta is not None else [{} for _ in range(len(self.counts))]
+        self.items  = None
+
+    @classmethod
+    def from_list(cls, targets):
+        device = targets[0]["boxes"].device
+        counts = [len(tgt["labels"]) for tgt in targets]
+        boxes  = torch.cat([tgt["boxes"].to(device, torch.float32).reshape(-1, 4) for tgt in targets])
+        labels = torch.cat([tgt["labels"].to(device, torch.float32).reshape(-1, 1) for tgt in targets])
+        batch_inds = torch.repeat_interleave(torch.arange(len(targets), device=device),
+                                             torch.as_tensor(counts, dtype=torch.long, device=device))
+        packed = torch.cat([batch_inds[:, None].float(), labels, boxes], dim=1)
+        meta = [{k: v for k, v in tgt.items() if k not in ("boxes", "labels")} for tgt in targets]
+
+        return cls(packed, counts, meta)
+
+    @property
+    def batch_inds(self):
+        return self.packed[:, 0].long()
+
+    @property
+    def labels(self):
+        return self.packed[:, 1].long()
+
+    @property
+    def boxes(self):
+        return self.packed[:, 2:]
+
+    def to(self, device, non_blocking=False):
+        packed = self.packed.to(device, non_blocking=non_blocking)
+        return PackedTargets(packed, self.counts, self.meta)
+
+    def pin_memory(self):
+        # called by the DataLoader with pin_memory=True
+        self.packed = self.packed.pin_memory()
+        return self
+
+    # ---------------- Legacy per-image targets ----------------
+    def to_list(self):
+        # the dicts are made once, so that the changes of the legacy code are kept
+        if self.items is None:
+            sizes = self.counts.tolist()
+            self.items = [dict(meta, boxes=boxes, labels=labels) for meta, boxes, labels in
+                          zip(self.meta, self.boxes.split(sizes), self.labels.split(sizes))]
+        return self.items
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getitem__(self, index):
+        return self.to_list()[index]
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+def pack_targets(targets):
+    """
+        The PackedTargets of a batch, from the legacy list of the per-image targets.
+    """
+    return targets if isinstance(targets, PackedTargets) else PackedTargets.from_list(targets)
+
 ## collate_fn for dataloader
 class CollateFunc(object):
+    """
+        Stack the images & pack the targets of a batch into the PackedTargets.
+    """
     def __call__(self, batch):
         targets = []
         images = []
@@ -199,8 +483,77 @@ class CollateFunc(object):
 
         images = torch.stack(images, 0) # [B, C, H, W]
 
+        return images, PackedTargets.from_list(targets)
+
+## Device prefetcher
+class DevicePrefetcher(object):
+    """
+        Iterate a dataloader with the next batch copied to the device on a side CUDA stream, while the current
+        batch is trained. The uint8 images of the workers are converted & normalized on the device, and the
+        float images are only converted. On CPU, the batches are preprocessed in place of the copy.
+    """
+    def __init__(self, loader, device, pixel_mean, pixel_std, batch_augment=None, move_targets=False):
+        self.loader = loader
+        # augmentations of the uint8 batches on the device, e.g. the BatchAugmentation
+        self.batch_augment = batch_augment
+        # copy the PackedTargets to the device too, in one copy, while the matchers of numpy keep them on CPU
+        self.move_targets = move_targets
+        self.device = torch.device(device)
+        self.pixel_mean = torch.as_tensor(pixel_mean, dtype=torch.float32, device=self.device).view(1, -1, 1, 1)
+        self.pixel_std  = torch.as_tensor(pixel_std, dtype=torch.float32, device=self.device).view(1, -1, 1, 1)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.start_iter = 0
+
+    def __len__(self):
+        # the batches of a resumed epoch before its start_iter are skipped by the batch sampler
+        return len(self.loader) - self.start_iter
+
+    def set_epoch(self, epoch, start_iter=0):
+        self.start_iter = start_iter
+        if self.batch_augment is not None:
+            self.batch_augment.set_epoch(epoch, start_iter)
+
+    def preprocess(self, images, targets):
+        images = images.to(self.device, non_blocking=True)
+        if images.dtype == torch.uint8:
+            images = images.float()
+            if self.batch_augment is not None:
+                images, targets = self.batch_augment(images, pack_targets(targets))
+            images = (images - self.pixel_mean) / self.pixel_std
+        else:
+            images = images.float()
+        if self.move_targets:
+            targets = pack_targets(targets).to(self.device, non_blocking=True)
+
         return images, targets
 
+    def load(self, loader_iter):
+        try:
+            images, targets = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self.preprocess(images, targets)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        if self.stream is None:
+            for images, targets in loader_iter:
+                yield self.preprocess(images, targets)
+            return
+
+        batch = self.load(loader_iter)
+        while batch is not None:
+            images, targets = batch
+            # the batch is made on the side stream, & used on the current stream
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            images.record_stream(current_stream)
+            if self.move_targets:
+                targets.packed.record_stream(current_stream)
+            batch = self.load(loader_iter)
+            yield images, targets
+
 
 # ---------------------------- For Loss ----------------------------
 ## FocalLoss
@@ -244,6 +597,179 @@ def varifocal_loss_with_logits(pred_logits,
         pred_logits, gt_score, weight=weight, reduction='none')
     return loss.mean(1).sum() / normalizer
 
+## pad the targets of a batch
+def pad_targets(targets, device=None):
+    """
+        Pad the per-image targets to a common number of boxes, so that
+        the label assignment could be done on the whole batch at once.
+
+        targets: (PackedTargets) or the legacy (List) [dict{'boxes': [...], 
+                                                            'labels': [...], 
+                                                            'orig_size': ...}, ...]
+        Return:
+            tgt_labels: (Tensor) [B, N]
+            tgt_bboxes: (Tensor) [B, N, 4]
+            tgt_mask:   (Tensor) [B, N], True for the valid targets
+    """
+    targets = pack_targets(targets)
+    bs = len(targets)
+    src_device = targets.packed.device
+    if device is None:
+        device = src_device
+    num_max = max(int(targets.counts.max()), 1)
+
+    # The targets are padded where they are and then moved to the device in one copy.
+    num_tgts = targets.counts.to(src_device)
+    batch_inds = targets.batch_inds
+    tgt_inds = torch.arange(len(batch_inds), device=src_device) - (torch.cumsum(num_tgts, 0) - num_tgts)[batch_inds]
+
+    tgt_labels = torch.zeros([bs, num_max], dtype=torch.long, device=src_device)
+    tgt_bboxes = torch.zeros([bs, num_max, 4], dtype=torch.float32, device=src_device)
+    tgt_mask   = torch.zeros([bs, num_max], dtype=torch.bool, device=src_device)
+    tgt_labels[batch_inds, tgt_inds] = targets.labels
+    tgt_bboxes[batch_inds, tgt_inds] = targets.boxes
+    tgt_mask[batch_inds, tgt_inds] = True
+
+    tgt_labels = tgt_labels.to(device, non_blocking=True)
+    tgt_bboxes = tgt_bboxes.to(device, non_blocking=True)
+    tgt_mask   = tgt_mask.to(device, non_blocking=True)
+
+    return tgt_labels, tgt_bboxes, tgt_mask
+
+## Batched solvers of the linear assignment problem
+@torch.no_grad()
+def batch_auction_assignment(cost, gt_mask, scale=1000, eps_factor=5, max_iter=10000):
+    """
+        ε-scaling auction algorithm solving the assignments of a batch at once.
+        The cost is rounded to multiples of 1 / scale, for which the result is optimal.
+
+        cost:    (Tensor) [B, Q, G], solved by the scipy_assignment if Q < G
+        gt_mask: (Tensor) [B, G], False for the padded GTs
+        Return the matched query index of each GT: [B, G], -1 for the padded GTs.
+    """
+    bs, num_queries, num_gts = cost.shape
+    if num_gts > num_queries:
+        # some GTs are left unmatched, which the auction does not handle
+        return scipy_assignment(cost, gt_mask)
+    device = cost.device
+    # ---------------- Integer benefits ----------------
+    # The GTs bid for the queries. The problem is made square with dummy bidders of zero benefit
+    # (padded GTs included), and the benefits are scaled by (Q + 1), so that ε = 1 is exact.
+    int_cost = torch.round(cost.double().transpose(1, 2) * scale).long() * (num_queries + 1)
+    benefit = torch.zeros([bs, num_queries, num_queries], dtype=torch.long, device=device)
+    benefit[:, :num_gts] = torch.where(gt_mask[..., None], -int_cost, torch.zeros_like(int_cost))
+
+    neg_inf = torch.iinfo(torch.long).min // 4
+    indexes = torch.arange(num_queries, device=device).expand(bs, -1)
+    prices = torch.zeros([bs, num_queries], dtype=torch.long, device=device)
+    eps = max(int(benefit.max() - benefit.min()) // eps_factor, 1)
+
+    # ---------------- ε-scaling phases ----------------
+    while True:
+        # object of each bidder, with an extra slot to drop the unused scatters
+        owner = torch.full([bs, num_queries + 1], -1, dtype=torch.long, device=device)
+        obj_owner = torch.full([bs, num_queries], -1, dtype=torch.long, device=device)
+        for _ in range(max_iter):
+            active = owner[:, :-1] < 0
+            if not active.any():
+                break
+            # Bidding: each unassigned bidder bids for its best object
+            values = benefit - prices[:, None, :]
+            top_values, top_objs = values.topk(min(2, num_queries), dim=-1)
+            best_objs = top_objs[..., 0]
+            bids = prices.gather(1, best_objs) + top_values[..., 0] - top_values[..., -1] + eps
+            bids = torch.where(active, bids, torch.full_like(bids, neg_inf))
+
+            # Assignment: each object goes to its highest bidder
+            max_bids = torch.full_like(prices, neg_inf).scatter_reduce(1, best_objs, bids, 'amax')
+            is_winner = active & (bids == max_bids.gather(1, best_objs))
+            winners = torch.full_like(prices, -1).scatter_reduce(
+                1, best_objs, torch.where(is_winner, indexes, torch.full_like(indexes, -1)), 'amax')
+            sold = winners >= 0
+
+            # The previous owners of the sold objects become unassigned
+            prev_owners = torch.where(sold & (obj_owner >= 0), obj_owner, torch.full_like(obj_owner, num_queries))
+            owner.scatter_(1, prev_owners, -1)
+            owner.scatter_(1, torch.where(sold, winners, torch.full_like(winners, num_queries)), indexes)
+            obj_owner = torch.where(sold, winners, obj_owner)
+            prices = torch.where(sold, max_bids, prices)
+
+        if (owner[:, :-1] < 0).any():
+            # the valid GTs left unassigned would be dropped from the loss
+            warnings.warn('The auction did not converge in {} iterations, '
+                          'the assignments are solved by scipy instead.'.format(max_iter))
+            return scipy_assignment(cost, gt_mask)
+        if eps == 1:
+            break
+        eps = max(eps // eps_factor, 1)
+
+    return torch.where(gt_mask, owner[:, :num_gts], torch.full_like(owner[:, :num_gts], -1))
+
+def scipy_assignment(cost, gt_mask):
+    """
+        The assignments of a batch solved image by image by the scipy, the fallback of the auction.
+        With more GTs than queries, the extra GTs are left unmatched.
+
+        cost:    (Tensor) [B, Q, G]
+        gt_mask: (Tensor) [B, G], False for the padded GTs
+        Return the matched query index of each GT: [B, G], -1 for the unmatched & padded GTs.
+    """
+    cost_cpu, gt_mask_cpu = cost.detach().double().cpu(), gt_mask.cpu()
+    assignment = torch.full(gt_mask.shape, -1, dtype=torch.long)
+    for b in range(cost.shape[0]):
+        gt_inds = torch.nonzero(gt_mask_cpu[b]).flatten()
+        query_inds, col_inds = linear_sum_assignment(cost_cpu[b][:, gt_inds].numpy())
+        assignment[b, gt_inds[col_inds]] = torch.as_tensor(query_inds, dtype=torch.long)
+
+    return assignment.to(cost.device)
+
+@torch.no_grad()
+def batch_sinkhorn_assignment(cost, gt_mask, eps=0.05, max_iter=50):
+    """
+        Entropic approximation of the assignments of a batch, solved by the
+        Sinkhorn iterations and rounded greedily to a one-to-one matching.
+
+        cost:    (Tensor) [B, Q, G], solved by the scipy_assignment if Q < G
+        gt_mask: (Tensor) [B, G], False for the padded GTs
+        Return the matched query index of each GT: [B, G], -1 for the padded GTs.
+    """
+    bs, num_queries, num_gts = cost.shape
+    if num_gts > num_queries:
+        # the background marginal Q - G would be negative
+        return scipy_assignment(cost, gt_mask)
+    valid_mask = gt_mask[:, None, :].expand_as(cost)
+    # Normalize the cost of each image to [0, 1], so that ε does not depend on the cost scale
+    cost = cost.float()
+    cost_min = cost.masked_fill(~valid_mask, float('inf')).flatten(1).min(dim=1)[0][:, None, None]
+    cost_max = cost.masked_fill(~valid_mask, -float('inf')).flatten(1).max(dim=1)[0][:, None, None]
+    cost = ((cost - cost_min) / (cost_max - cost_min).clamp(min=1e-6)).masked_fill(~valid_mask, 0.)
+
+    # Each query sends one unit to a GT or to the background, which takes the rest
+    mu = torch.ones([bs, num_queries], device=cost.device)
+    nu = torch.cat([gt_mask.float(), (num_queries - gt_mask.sum(-1, keepdim=True)).float()], dim=-1)
+    cost = torch.cat([cost, torch.zeros_like(cost[..., :1])], dim=-1)
+
+    # Sinkhorn iterations in the log domain
+    u, v = torch.zeros_like(mu), torch.zeros_like(nu)
+    for _ in range(max_iter):
+        v = eps * (torch.log(nu + 1e-8) - torch.logsumexp((-cost + u[..., None] + v[:, None]) / eps, dim=1)) + v
+        u = eps * (torch.log(mu + 1e-8) - torch.logsumexp((-cost + u[..., None] + v[:, None]) / eps, dim=2)) + u
+    pi = torch.exp((-cost + u[..., None] + v[:, None]) / eps)
+
+    # Greedy rounding on the transport plan
+    scores = pi[..., :num_gts].masked_fill(~valid_mask, -1.)
+    assignment = torch.full([bs, num_gts], -1, dtype=torch.long, device=cost.device)
+    batch_inds = torch.arange(bs, device=cost.device)
+    for _ in range(int(gt_mask.sum(-1).max())):
+        best = scores.flatten(1).argmax(dim=1)
+        query_inds, gt_inds = best // num_gts, best % num_gts
+        is_valid = scores[batch_inds, query_inds, gt_inds] >= 0
+        assignment[batch_inds, gt_inds] = torch.where(is_valid, query_inds, assignment[batch_inds, gt_inds])
+        scores[batch_inds, query_inds, :] = -1.
+        scores[batch_inds, :, gt_inds] = -1.
+
+    return assignment
+
 ## InverseSigmoid
 def inverse_sigmoid(x, eps=1e-5):
     x = x.clamp(min=0, max=1)
@@ -347,12 +873,33 @@ def load_weight(model, path_to_ckpt, fuse_cbn=False):
     # Check ckpt file
     if path_to_ckpt is None:
         print('no weight file ...')
+    elif path_to_ckpt.endswith('.safetensors'):
+        # slim weights exported for deployment, see export_weights.py
+        state_dict, metadata = load_slim_weights(path_to_ckpt)
+        print('--------------------------------------')
+        print('Slim weights infor: {}'.format(metadata))
+        print('--------------------------------------')
+        if metadata.get('fused') == 'True':
+            print('Fusing Conv & BN as the exported model ...')
+            model = fuse_conv_bn(model)
+            fuse_cbn = False
+        if all(v.dtype == state_dict[k].dtype for k, v in model.state_dict().items() if k in state_dict):
+            # the model shares the pages of the mapped file, instead of a copy
+            try:
+                model.load_state_dict(state_dict, assign=True)
+            except TypeError:
+                model.load_state_dict(state_dict)
+        else:
+            model.load_state_dict(state_dict)
+
+        print('Finished loading model!')
     else:
-        checkpoint = torch.load(path_to_ckpt, map_location='cpu')
+        # the optimizer state of the checkpoint is never read from the disk
+        checkpoint = CheckpointReader(path_to_ckpt)
         print('--------------------------------------')
         print('Best model infor:')
-        print('Epoch: {}'.format(checkpoint["epoch"]))
-        print('mAP: {}'.format(checkpoint["mAP"]))
+        print('Epoch: {}'.format(checkpoint.get("epoch")))
+        print('mAP: {}'.format(checkpoint.get("mAP")))
         print('--------------------------------------')
         if "model_ema" in checkpoint:
             print("Load the model from the ModelEMA state dict ...")
@@ -371,59 +918,6 @@ def load_weight(model, path_to_ckpt, fuse_cbn=False):
 
     return model
 
-## Model EMA
-class ModelEMA(object):
-    def __init__(self, model, ema_decay=0.9999, ema_tau=2000, resume=None):
-        # Create EMA
-        self.ema = deepcopy(self.de_parallel(model)).eval()  # FP32 EMA
-        self.updates = 0  # number of EMA updates
-        self.decay = lambda x: ema_decay * (1 - math.exp(-x / ema_tau))  # decay exponential ramp (to help early epochs)
-        for p in self.ema.parameters():
-            p.requires_grad_(False)
-
-        if resume is not None and resume.lower() != "none":
-            self.load_resume(resume)
-
-        print("Initialize ModelEMA's updates: {}".format(self.updates))
-
-    def load_resume(self, resume):
-        checkpoint = torch.load(resume)
-        if 'ema_updates' in checkpoint.keys():
-            print('--Load ModelEMA updates from the checkpoint: ', resume)
-            # checkpoint state dict
-            self.updates = checkpoint.pop("ema_updates")
-
-    def is_parallel(self, model):
-        # Returns True if model is of type DP or DDP
-        return type(model) in (nn.parallel.DataParallel, nn.parallel.DistributedDataParallel)
-
-    def de_parallel(self, model):
-        # De-parallelize a model: returns single-GPU model if model is of type DP or DDP
-        return model.module if self.is_parallel(model) else model
-
-    def copy_attr(self, a, b, include=(), exclude=()):
-        # Copy attributes from b to a, options to only include [...] and to exclude [...]
-        for k, v in b.__dict__.items():
-            if (len(include) and k not in include) or k.startswith('_') or k in exclude:
-                continue
-            else:
-                setattr(a, k, v)
-
-    def update(self, model):
-        # Update EMA parameters
-        self.updates += 1
-        d = self.decay(self.updates)
-
-        msd = self.de_parallel(model).state_dict()  # model state_dict
-        for k, v in self.ema.state_dict().items():
-            if v.dtype.is_floating_point:  # true for FP16 and FP32
-                v *= d
-                v += (1 - d) * msd[k].detach()
-
-    def update_attr(self, model, include=(), exclude=('process_group', 'reducer')):
-        # Update EMA attributes
-        self.copy_attr(self.ema, model, include, exclude)
-
 ## SiLU
 class SiLU(nn.Module):
     """export-friendly version of nn.SiLU()"""
@@ -24,7 +24,7 @@ class LinearWarmUpLrScheduler(object):
      
                            
 # ------------------------- LR Scheduler -------------------------
-def build_lr_scheduler(cfg, optimizer, resume=None):
+def build_lr_scheduler(cfg, optimizer, checkpoint=None):
     print('==============================')
     print('LR Scheduler: {}'.format(cfg.lr_scheduler))
 
@@ -36,12 +36,62 @@ def build_lr_scheduler(cfg, optimizer, resume=None):
     else:
         raise NotImplementedError("Unknown lr scheduler: {}".format(cfg.lr_scheduler))
         
-    if resume is not None and resume.lower() != "none":
-        checkpoint = torch.load(resume)
-        if 'lr_scheduler' in checkpoint.keys():
-            print('--Load lr scheduler from the checkpoint: ', resume)
-            # checkpoint state dict
-            checkpoint_state_dict = checkpoint.pop("lr_scheduler")
-            lr_scheduler.load_state_dict(checkpoint_state_dict)
-
-    return lr_scheduler
\ No newline at end of file
+    if checkpoint is not None and 'lr_scheduler' in checkpoint:
+        print('--Load lr scheduler from the checkpoint: ', checkpoint.path)
+        # checkpoint state dict
+        lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+
+    return lr_scheduler
+
+# ------------------------- Resolution Scheduler -------------------------
+## Progressive resizing
+class ProgressiveResizeScheduler(object):
+    """
+        The early epochs are trained at a reduced img_size, which ramps up linearly to the full img_size
+        in `ramp_epoch` epochs. With `scale_batch`, the batch size is enlarged as the images shrink, after
+        the warmup, and the lr follows the batch size by the linear scaling rule.
+    """
+    def __init__(self, img_size=640, min_ratio=1.0, ramp_epoch=0, stride=32, scale_batch=False, warmup_epoch=0, max_batch_ratio=4):
+        self.img_size = img_size
+        self.min_ratio = min_ratio
+        self.ramp_epoch = ramp_epoch
+        self.stride = stride
+        self.scale_batch = scale_batch
+        self.warmup_epoch = warmup_epoch
+        self.max_batch_ratio = max_batch_ratio
+        self.lr_ratio = 1.0
+
+    def get_img_size(self, epoch):
+        if epoch >= self.ramp_epoch or self.min_ratio >= 1.0:
+            return self.img_size
+        ratio = self.min_ratio + (1.0 - self.min_ratio) * epoch / self.ramp_epoch
+        return max(int(self.img_size * ratio) // self.stride * self.stride, self.stride)
+
+    def get_batch_ratio(self, epoch):
+        # the warmup sets the lr by itself, so the batch size is kept till its end
+        if not self.scale_batch or epoch <= self.warmup_epoch:
+            return 1
+        batch_ratio = int((self.img_size / self.get_img_size(epoch)) ** 2)
+        return max(min(batch_ratio, self.max_batch_ratio), 1)
+
+    def scale_lr(self, optimizer, lr_ratio):
+        """ Scale the lr of the epoch, reverted by scale_lr(optimizer, 1.0) before the lr scheduler steps. """
+        if lr_ratio == self.lr_ratio:
+            return
+        for param_group in optimizer.param_groups:
+            param_group['lr'] = param_group['lr'] / self.lr_ratio * lr_ratio
+        self.lr_ratio = lr_ratio
+
+
+def build_resize_scheduler(cfg):
+    print('==============================')
+    print('Progressive resizing: {} -> {} in {} epochs'.format(
+        int(cfg.train_img_size * cfg.resize_min_ratio), cfg.train_img_size, cfg.resize_ramp_epoch))
+
+    return ProgressiveResizeScheduler(img_size        = cfg.train_img_size,
+                                      min_ratio       = cfg.resize_min_ratio,
+                                      ramp_epoch      = cfg.resize_ramp_epoch,
+                                      stride          = cfg.max_stride,
+                                      scale_batch     = cfg.resize_scale_batch,
+                                      warmup_epoch    = cfg.warmup_epoch,
+                                      )
@@ -1,7 +1,7 @@
 import torch
 
 
-def build_yolo_optimizer(cfg, model, resume=None):
+def build_yolo_optimizer(cfg, model, checkpoint=None):
     print('==============================')
     print('Optimizer: {}'.format(cfg.optimizer))
     print('--base lr: {}'.format(cfg.base_lr))
@@ -36,26 +36,22 @@ def build_yolo_optimizer(cfg, model, resume=None):
 
     start_epoch = 0
     cfg.best_map = -1.
-    if resume and resume != 'None':
-        checkpoint = torch.load(resume)
+    if checkpoint is not None:
         # checkpoint state dict
-        try:
-            checkpoint_state_dict = checkpoint.pop("optimizer")
-            print('--Load optimizer from the checkpoint: ', resume)
-            optimizer.load_state_dict(checkpoint_state_dict)
-            start_epoch = checkpoint.pop("epoch") + 1
+        if "optimizer" in checkpoint:
+            print('--Load optimizer from the checkpoint: ', checkpoint.path)
+            optimizer.load_state_dict(checkpoint["optimizer"])
+            start_epoch = checkpoint["epoch"] + 1
             if "mAP" in checkpoint:
-                print('--Load best metric from the checkpoint: ', resume)
-                best_map = checkpoint["mAP"]
-                cfg.best_map = best_map
-            del checkpoint, checkpoint_state_dict
-        except:
+                print('--Load best metric from the checkpoint: ', checkpoint.path)
+                cfg.best_map = checkpoint["mAP"]
+        else:
             print("No optimzier in the given checkpoint.")
                                                         
     return optimizer, start_epoch
 
 
-def build_rtdetr_optimizer(cfg, model, resume=None):
+def build_rtdetr_optimizer(cfg, model, checkpoint=None):
     print('==============================')
     print('Optimizer: {}'.format(cfg.optimizer))
     print('--base lr: {}'.format(cfg.base_lr))
@@ -96,12 +92,10 @@ def build_rtdetr_optimizer(cfg, model, resume=None):
     optimizer.add_param_group({"params": param_dicts[5], "lr": backbone_lr, "weight_decay": cfg.weight_decay})
 
     start_epoch = 0
-    if resume and resume != 'None':
-        print('--Load optimizer from the checkpoint: ', resume)
-        checkpoint = torch.load(resume)
+    if checkpoint is not None:
+        print('--Load optimizer from the checkpoint: ', checkpoint.path)
         # checkpoint state dict
-        checkpoint_state_dict = checkpoint.pop("optimizer")
-        optimizer.load_state_dict(checkpoint_state_dict)
-        start_epoch = checkpoint.pop("epoch") + 1
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        start_epoch = checkpoint["epoch"] + 1
                                                         
     return optimizer, start_epoch